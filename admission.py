@@ -0,0 +1,133 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Any, Dict, Iterator
+
+from PIL import Image
+
+from config import DPI, MEMORY_BUDGET_BYTES, RENDER_LOOKAHEAD
+from image_encoding import EncodingPolicy
+from page_renderer import pdf_page_sizes
+
+# encoded page size as a share of the raw RGB bitmap, before base64
+ENCODED_RATIO = {"PNG": 0.15, "JPEG": 0.05, "WEBP": 0.04}
+BASE64_OVERHEAD = 4 / 3
+
+
+def estimate_document_bytes(doc_type: str, content: bytes, policy: EncodingPolicy, page_limit: int, dpi: int = DPI) -> int:
+    """
+    Rough peak memory of one document from its size, page sizes and the DPI.
+
+    Counts the downloaded bytes twice (the buffer and pdfium's parsed copy),
+    the full-resolution bitmaps of the pages rendering at once (pdfium's
+    BGRA bitmap plus the RGB PIL image) and the data URLs of every page,
+    which are all held until the extraction call returns.
+    """
+    if doc_type == "pdf":
+        scale = dpi / 72.0
+        sizes = [(width * scale, height * scale) for width, height in pdf_page_sizes(content, page_limit)]
+        rendering_at_once = max(RENDER_LOOKAHEAD, 1)
+    else:
+        with Image.open(BytesIO(content)) as img:
+            sizes = [img.size]
+        rendering_at_once = 1
+
+    if policy.max_edge:
+        encoded_sizes = [_fit(width, height, policy.max_edge) for width, height in sizes]
+    else:
+        encoded_sizes = sizes
+
+    bitmap_bytes = sorted((int(width * height * 7) for width, height in sizes), reverse=True)
+    encoded_bytes = sum(
+        int(width * height * 3 * ENCODED_RATIO.get(policy.format, 0.15) * BASE64_OVERHEAD)
+        for width, height in encoded_sizes
+    )
+    if policy.byte_budget:
+        encoded_bytes = min(encoded_bytes, policy.byte_budget)
+
+    return len(content) * 2 + sum(bitmap_bytes[:rendering_at_once]) + encoded_bytes
+
+
+def _fit(width: float, height: float, max_edge: int) -> tuple[float, float]:
+    longest = max(width, height)
+    if longest <= max_edge:
+        return width, height
+    return width * max_edge / longest, height * max_edge / longest
+
+
+class MemoryAdmission:
+    """
+    Holds documents back before rendering while the memory they are
+    estimated to need does not fit the budget of this worker process.
+
+    Waiting documents are admitted in arrival order, so a large scan is not
+    starved by a stream of small ones. A document larger than the whole
+    budget is admitted once nothing else is reserved. A budget of 0
+    disables the limit but still tracks the reservations.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._condition = threading.Condition()
+        self._waiting = deque()
+        self._reserved = 0
+        self._peak_reserved = 0
+        self._admitted = 0
+        self._held_back = 0
+        self._wait_seconds = 0.0
+
+    def _fits(self, amount: int) -> bool:
+        return self.budget <= 0 or self._reserved == 0 or self._reserved + amount <= self.budget
+
+    def acquire(self, amount: int) -> None:
+        """Block until `amount` fits; every acquire must be paired with a release of the same amount."""
+        ticket = object()
+        started_at = time.time()
+        with self._condition:
+            self._waiting.append(ticket)
+            if self._waiting[0] is not ticket or not self._fits(amount):
+                self._held_back += 1
+            try:
+                while self._waiting[0] is not ticket or not self._fits(amount):
+                    self._condition.wait()
+            except BaseException:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+                raise
+            self._waiting.popleft()
+            self._reserved += amount
+            self._peak_reserved = max(self._peak_reserved, self._reserved)
+            self._admitted += 1
+            self._wait_seconds += time.time() - started_at
+            # the next in line may fit as well
+            self._condition.notify_all()
+
+    def release(self, amount: int) -> None:
+        with self._condition:
+            self._reserved -= amount
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, amount: int) -> Iterator[None]:
+        self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "budget_bytes": self.budget,
+                "reserved_bytes": self._reserved,
+                "peak_reserved_bytes": self._peak_reserved,
+                "waiting": len(self._waiting),
+                "admitted": self._admitted,
+                "held_back": self._held_back,
+                "avg_wait_seconds": self._wait_seconds / self._admitted if self._admitted else 0.0
+            }
+
+
+memory_admission = MemoryAdmission(MEMORY_BUDGET_BYTES)
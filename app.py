@@ -1,72 +1,287 @@
 import time
-from flask import Flask, request, jsonify
+import logging
+from typing import Iterator
+from flask import Flask, Response, request, jsonify
 
-from config import (MAX_RETRIES, RETRY_DELAY, BATCH_SIZE)
+from config import (MAX_RETRIES, RETRY_DELAY, REQUEST_WINDOW)
 from batch_processor import create_dict_result
-from utils import fetch_document_links
+from cache import cache_stats
+from options import AnalysisOptions
+from jobs import job_manager, CapacityExceeded
+from streaming import stream_results, NDJSON_MIMETYPE, SSE_MIMETYPE
+from scheduler import scheduler
+from pipeline import pipeline_stats
+from page_renderer import page_cache
+from page_filter import skipped_page_totals
+from rate_limiter import rate_limiter
+from http_client import download_stats
+from singleflight import single_flight
+from admission import memory_admission
+from async_engine import async_engine
+from utils import fetch_document_links, afetch_document_links
+from logs import setup_logging, correlation_id, new_correlation_id
+from metrics import render_metrics
+
+setup_logging()
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# header carrying the correlation id; a caller or proxy that already set one keeps it across services
+CORRELATION_HEADER = "X-Request-ID"
+
+MAX_SYNC_DOCUMENTS = 50
+# documents on the asyncio engine cost a coroutine each, not a thread
+MAX_ASYNCIO_DOCUMENTS = 500
+
+
+def _analysis_response(result: dict, options: AnalysisOptions, processing_time: float, scheduling: dict) -> dict:
+    # successful vs failed documents
+    successful_count = sum(1 for res in result.values() if "error" not in res)
+    failed_count = len(result) - successful_count
+    retry_failures = sum(1 for res in result.values() if res.get("final_failure", False))
+
+    return {
+        "ok": True,
+        "result": result,
+        "processing_time_seconds": processing_time,
+        "document_count": len(result),
+        "successful_documents": successful_count,
+        "failed_documents": failed_count,
+        "retry_failures": retry_failures,
+        "scheduling": scheduling,
+        "retry_config": {
+            "max_retries": MAX_RETRIES,
+            "retry_delay": RETRY_DELAY
+        },
+        "cache": {
+            "used": options.use_cache,
+            **cache_stats()
+        },
+        "page_filter": {
+            "mode": options.page_filter,
+            "skipped_pages": skipped_page_totals(result)
+        }
+    }
+
+
+@app.before_request
+def _start_correlation():
+    correlation_id.set(request.headers.get(CORRELATION_HEADER) or new_correlation_id())
+
+
+@app.after_request
+def _return_correlation(response: Response) -> Response:
+    response.headers[CORRELATION_HEADER] = correlation_id.get()
+    return response
+
+
+@app.teardown_request
+def _end_correlation(exc) -> None:
+    # worker threads serve many requests; whatever the thread logs next is not part of this one
+    correlation_id.set(None)
+
+
+def _correlated(frames: Iterator[str], correlation: str) -> Iterator[str]:
+    # a streamed body is consumed after the request was torn down; its logs keep the request's id
+    correlation_id.set(correlation)
+    try:
+        yield from frames
+    finally:
+        correlation_id.set(None)
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     data = request.get_json(silent=True) or {}
     paths_url = data.get("paths_url")
     if not paths_url:
         return jsonify({"ok": False, "error": "Missing 'paths_url'"}), 400
+    try:
+        options = AnalysisOptions.from_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": f"Invalid options: {str(e)}"}), 400
+    run_async = data.get("async", False) is True
     
     try:
-        print(f"Starting analysis for URL: {paths_url}")
+        log.info(f"Starting analysis for URL: {paths_url}")
         start_time = time.time()
         
         try:
             links = fetch_document_links(paths_url)
             total_documents = len(links)
-            estimated_time = total_documents * 15
+            estimated_time = round(scheduler.estimate_seconds(total_documents))
             
-            print(f"Found {total_documents} documents to process")
-            print(f"Estimated processing time: {estimated_time} seconds ({estimated_time/60:.1f} minutes)")
+            log.info(f"Found {total_documents} documents to process")
+            log.info(f"Estimated processing time: {estimated_time} seconds ({estimated_time/60:.1f} minutes)")
             
-            if total_documents > 50:
+            # background jobs are bounded by the job queue capacity instead of the request timeout
+            if not run_async and total_documents > MAX_SYNC_DOCUMENTS:
                 return jsonify({
                     "ok": False, 
-                    "error": f"Too many documents ({total_documents}). Maximum is 50."
+                    "error": f"Too many documents ({total_documents}). Maximum is {MAX_SYNC_DOCUMENTS}."
                 }), 400
                 
         except Exception as e:
-            print(f"Error fetching document links: {str(e)}")
+            log.error(f"Error fetching document links: {str(e)}")
             return jsonify({"ok": False, "error": f"Failed to fetch document links: {str(e)}"}), 400
         
+        if run_async:
+            try:
+                job_id = job_manager.submit(paths_url, links, options=options)
+            except CapacityExceeded as e:
+                return jsonify({"ok": False, "error": str(e)}), 503
+
+            return jsonify({
+                "ok": True,
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "cancel_url": f"/jobs/{job_id}/cancel",
+                "document_count": total_documents,
+                "estimated_time_seconds": estimated_time
+            }), 202
+
         # process documents
-        result = create_dict_result(paths_url)
+        result = create_dict_result(paths_url, options=options, paths=links)
         
         end_time = time.time()
         processing_time = end_time - start_time
-        print(f"Total processing time: {processing_time:.2f} seconds")
-        
-        # successful vs failed documents
-        successful_count = sum(1 for res in result.values() if "error" not in res)
-        failed_count = len(result) - successful_count
-        retry_failures = sum(1 for res in result.values() if res.get("final_failure", False))
+        log.info(f"Total processing time: {processing_time:.2f} seconds")
+
+        return jsonify(_analysis_response(result, options, processing_time, {
+            "engine": "threads",
+            "request_window": REQUEST_WINDOW,
+            "global_max_in_flight": scheduler.max_in_flight
+        }))
         
+    except Exception as e:
+        log.error(f"Error in /analyze endpoint main method: {str(e)}")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.route("/analyze/asyncio", methods=["POST"])
+def analyze_asyncio():
+    """
+    /analyze on the asyncio engine: this view only waits while the index
+    fetch, downloads and extraction calls run as coroutines on the worker's
+    event loop, so one worker can keep hundreds of documents in flight.
+    """
+    data = request.get_json(silent=True) or {}
+    paths_url = data.get("paths_url")
+    if not paths_url:
+        return jsonify({"ok": False, "error": "Missing 'paths_url'"}), 400
+    try:
+        options = AnalysisOptions.from_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": f"Invalid options: {str(e)}"}), 400
+
+    log.info(f"Starting asyncio analysis for URL: {paths_url}")
+    start_time = time.time()
+    try:
+        links = async_engine.run(afetch_document_links(paths_url))
+    except Exception as e:
+        log.error(f"Error fetching document links: {str(e)}")
+        return jsonify({"ok": False, "error": f"Failed to fetch document links: {str(e)}"}), 400
+
+    total_documents = len(links)
+    log.info(f"Found {total_documents} documents to process")
+    if total_documents > MAX_ASYNCIO_DOCUMENTS:
         return jsonify({
-            "ok": True, 
-            "result": result,
-            "processing_time_seconds": processing_time,
-            "document_count": len(result),
-            "successful_documents": successful_count,
-            "failed_documents": failed_count,
-            "retry_failures": retry_failures,
-            "batch_processing": True,
-            "batch_size": BATCH_SIZE,
-            "retry_config": {
-                "max_retries": MAX_RETRIES,
-                "retry_delay": RETRY_DELAY
-            }
-        })
-        
+            "ok": False,
+            "error": f"Too many documents ({total_documents}). Maximum is {MAX_ASYNCIO_DOCUMENTS}."
+        }), 400
+
+    try:
+        result = async_engine.run(async_engine.create_dict_result(paths_url, options=options, paths=links))
     except Exception as e:
-        print(f"Error in /analyze endpoint main method: {str(e)}")
+        log.error(f"Error in /analyze/asyncio endpoint: {str(e)}")
         return jsonify({"ok": False, "error": str(e)}), 500
 
+    processing_time = time.time() - start_time
+    log.info(f"Total processing time: {processing_time:.2f} seconds")
+
+    return jsonify(_analysis_response(result, options, processing_time, {
+        "engine": "asyncio",
+        "request_window": async_engine.request_window,
+        "global_max_in_flight": async_engine.max_in_flight
+    }))
+
+@app.route("/analyze/stream", methods=["POST"])
+def analyze_stream():
+    data = request.get_json(silent=True) or {}
+    paths_url = data.get("paths_url")
+    if not paths_url:
+        return jsonify({"ok": False, "error": "Missing 'paths_url'"}), 400
+    try:
+        options = AnalysisOptions.from_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": f"Invalid options: {str(e)}"}), 400
+
+    fmt = data.get("format")
+    if fmt is None:
+        fmt = "sse" if SSE_MIMETYPE in request.headers.get("Accept", "") else "ndjson"
+    if fmt not in ("ndjson", "sse"):
+        return jsonify({"ok": False, "error": "'format' must be 'ndjson' or 'sse'"}), 400
+
+    log.info(f"Starting streaming analysis for URL: {paths_url}")
+    try:
+        links = fetch_document_links(paths_url)
+    except Exception as e:
+        log.error(f"Error fetching document links: {str(e)}")
+        return jsonify({"ok": False, "error": f"Failed to fetch document links: {str(e)}"}), 400
+
+    total_documents = len(links)
+    log.info(f"Found {total_documents} documents to stream")
+    if total_documents > MAX_SYNC_DOCUMENTS:
+        return jsonify({
+            "ok": False,
+            "error": f"Too many documents ({total_documents}). Maximum is {MAX_SYNC_DOCUMENTS}."
+        }), 400
+
+    return Response(
+        _correlated(stream_results(paths_url, links, options=options, fmt=fmt), correlation_id.get()),
+        mimetype=SSE_MIMETYPE if fmt == "sse" else NDJSON_MIMETYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    include_results = request.args.get("results", "true").lower() != "false"
+    job = job_manager.get(job_id, include_results=include_results)
+    if job is None:
+        return jsonify({"ok": False, "error": f"Unknown job '{job_id}'"}), 404
+    return jsonify({"ok": True, **job})
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = job_manager.get(job_id, include_results=False)
+    if job is None:
+        return jsonify({"ok": False, "error": f"Unknown job '{job_id}'"}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({"ok": False, "error": f"Job '{job_id}' already {job['status']}"}), 409
+    return jsonify({"ok": True, "job_id": job_id, "status": job["status"], "cancel_requested": True}), 202
+
+@app.route("/pipeline/stats", methods=["GET"])
+def get_pipeline_stats():
+    return jsonify({
+        "ok": True,
+        "stages": pipeline_stats(),
+        "scheduler": scheduler.stats(),
+        "page_cache": page_cache.stats(),
+        "openai_rate_limiter": rate_limiter.stats(),
+        "downloads": download_stats(),
+        "singleflight": single_flight.stats(),
+        "memory": memory_admission.stats(),
+        "asyncio_engine": async_engine.stats()
+    })
+
+@app.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    return jsonify({"ok": True, "cache": cache_stats()})
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    payload, content_type = render_metrics()
+    return Response(payload, headers={"Content-Type": content_type})
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,406 @@
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional, Tuple
+
+from config import (
+    MAX_RETRIES, RETRY_DELAY, DOCUMENT_TIMEOUT, OPENAI_MAX_RETRIES, SINGLEFLIGHT_MODE,
+    ASYNC_MAX_IN_FLIGHT, ASYNC_REQUEST_WINDOW, ASYNC_DOWNLOAD_CONCURRENCY, ASYNC_LLM_CONCURRENCY
+)
+from document_processor import get_document_type, aload_document_bytes
+from http_client import ARETRYABLE_DOWNLOAD_ERRORS
+from openai_service import asummarize_document, RetryableAPIError
+from extraction import aextract_pages, aclassify_document
+from chunking import split_chunks, chunk_page_range
+from page_filter import PageFilter
+from admission import memory_admission, estimate_document_bytes
+from options import AnalysisOptions, default_options
+from cache import result_cache, make_cache_key
+from pipeline import render_stage
+from stages import STAGES, StageError, stage_error, arun_stage, stage_attempts, render_pages
+from results import (
+    merge_chunks, apply_summary, should_cache, log_start, log_request, failure_result, success_result, finalize_results
+)
+from utils import afetch_document_links
+from logs import log_context
+from metrics import DOCUMENT_FAILURES, DOCUMENTS_IN_FLIGHT
+
+log = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """
+    Processes documents as coroutines on one event loop per worker process.
+
+    Downloads go through the async HTTP client and extraction through
+    AsyncOpenAI, so a document waiting on the network costs a coroutine
+    instead of a thread. Rendering still runs in the render stage's process
+    pool, reached through a few threads that also wait for the memory
+    budget, so nothing blocking runs on the loop. The loop lives on its own
+    thread for the life of the process, which keeps the pooled connections
+    of both clients warm across requests; views hand work to it with run().
+
+    Identical documents and requests in flight are coalesced on the loop;
+    coalescing across worker processes is left to the threaded engine.
+    """
+
+    def __init__(self, max_in_flight: int, request_window: int, download_concurrency: int, llm_concurrency: int):
+        self.max_in_flight = max_in_flight
+        self.request_window = request_window
+        self._loop = None
+        self._lock = threading.Lock()
+        # as many threads as the render stage admits, so a thread never waits on the stage's own queue
+        self._render_threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=render_stage.workers + render_stage.queue_size, thread_name_prefix="async-render"
+        )
+        self._documents = asyncio.Semaphore(max_in_flight)
+        self._downloads = asyncio.Semaphore(download_concurrency)
+        self._llm_calls = asyncio.Semaphore(llm_concurrency)
+        self._in_flight_work: Dict[str, asyncio.Future] = {}
+
+        self.download_concurrency = download_concurrency
+        self.llm_concurrency = llm_concurrency
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.llm_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        # started on first use, so each gunicorn worker gets its own loop after the fork
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="asyncio-engine", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro: Coroutine) -> Any:
+        """Run a coroutine on the engine's loop and wait for it from the calling thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    async def _coalesce(
+        self, key: str, attempts: Dict[str, int], stages: Tuple[str, ...], fn: Callable[..., Awaitable], *args: Any
+    ) -> Tuple[Any, bool]:
+        """
+        Return (result, shared); a caller that finds `key` in flight awaits that
+        work instead and takes the leader's attempts at `stages`. single_flight
+        blocks its callers' threads, so the loop keeps its own futures.
+        """
+        if SINGLEFLIGHT_MODE == "off":
+            return await fn(*args), False
+
+        future = self._in_flight_work.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                result, leader_attempts = await asyncio.shield(future)
+            except StageError as e:
+                if e.attempts is not None:
+                    attempts.update(e.attempts)
+                raise
+            attempts.update(leader_attempts)
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        # nobody may be waiting; retrieving the exception keeps the loop from logging it as lost
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._in_flight_work[key] = future
+        try:
+            result = await fn(*args)
+            future.set_result((result, stage_attempts(attempts, stages)))
+            return result, False
+        except asyncio.CancelledError:
+            future.set_exception(StageError("coalesced", "Processing error: the identical work this document waited for was cancelled", "cancelled"))
+            raise
+        except StageError as e:
+            e.attempts = stage_attempts(attempts, stages)
+            future.set_exception(e)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight_work[key]
+
+    async def _download(self, path: str) -> bytes:
+        async with self._downloads:
+            return await aload_document_bytes(path)
+
+    def _admit_and_render(self, estimated_bytes: int, doc_type: str, content: bytes, options: AnalysisOptions) -> Tuple[list[dict], str]:
+        # runs on a render thread: waiting for the memory budget or a render slot never blocks the loop
+        memory_admission.acquire(estimated_bytes)
+        try:
+            return render_pages(doc_type, content, options)
+        except BaseException:
+            memory_admission.release(estimated_bytes)
+            raise
+
+    async def _render(self, estimated_bytes: int, doc_type: str, content: bytes, options: AnalysisOptions) -> Tuple[list[dict], str]:
+        """Render on a render thread; on success the memory reservation is released by the caller."""
+        future = self._render_threads.submit(
+            contextvars.copy_context().run, self._admit_and_render, estimated_bytes, doc_type, content, options
+        )
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # a render already running cannot be interrupted; give its reservation back once it finishes
+            future.add_done_callback(
+                lambda done: done.cancelled() or done.exception() is not None or memory_admission.release(estimated_bytes)
+            )
+            raise
+
+    async def _llm(self, fn: Callable[..., Awaitable], *args: Any) -> dict:
+        async with self._llm_calls:
+            self.llm_in_flight += 1
+            try:
+                return await fn(*args)
+            finally:
+                self.llm_in_flight -= 1
+
+    async def _call_llm(self, document_name: str, attempts: Dict[str, int], fn: Callable[..., Awaitable], *args: Any) -> dict:
+        return await arun_stage(
+            document_name, "llm", attempts, self._llm, fn, *args,
+            retry_on=(RetryableAPIError,), max_retries=OPENAI_MAX_RETRIES
+        )
+
+    async def _extract(self, document_name: str, pages: list[dict], options: AnalysisOptions, attempts: Dict[str, int]) -> Tuple[dict, int]:
+        chunks = split_chunks(pages, options.chunk_pages)
+        if len(chunks) == 1:
+            return await self._call_llm(document_name, attempts, aextract_pages, pages, None, options.extraction), 1
+
+        log.info(f"[{document_name}] Extracting {len(pages)} pages in {len(chunks)} chunks of up to {options.chunk_pages} pages")
+        mode, flags = options.extraction, None
+        if mode == "two_step":
+            flags = await self._call_llm(document_name, attempts, aclassify_document, pages)
+            mode = "two_step" if flags is not None else "single"
+
+        chunk_attempts = [{} for _ in chunks]
+        tasks = [
+            asyncio.ensure_future(self._call_llm(
+                f"{document_name} p{chunk_page_range(chunk)}", chunk_attempts[index], aextract_pages, chunk, len(pages),
+                mode, flags
+            ))
+            for index, chunk in enumerate(chunks)
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            attempts["llm"] = max([attempts.get("llm", 0)] + [chunk.get("llm", 0) for chunk in chunk_attempts])
+
+        merged, partial_summaries = merge_chunks(results)
+        if partial_summaries:
+            log.info(f"[{document_name}] Summarising {len(partial_summaries)} partial summaries")
+            summary_attempts = {}
+            summary = await self._call_llm(document_name, summary_attempts, asummarize_document, partial_summaries)
+            attempts["llm"] = max(attempts["llm"], summary_attempts["llm"])
+            apply_summary(merged, partial_summaries, summary)
+
+        return merged, len(chunks)
+
+    async def _analyse_content(
+        self,
+        document_name: str,
+        doc_type: str,
+        content: bytes,
+        options: AnalysisOptions,
+        attempts: Dict[str, int],
+        page_filter: PageFilter,
+        cache_key: Optional[str]
+    ) -> dict:
+        loop = asyncio.get_running_loop()
+        try:
+            estimated_bytes = await loop.run_in_executor(
+                self._render_threads, estimate_document_bytes, doc_type, content, options.encoding, options.page_limit
+            )
+        except Exception as e:
+            raise stage_error(e, "render")
+
+        log.info(f"[{document_name}] Estimated memory {estimated_bytes / (1024 * 1024):.1f} MB")
+        log.info(f"[{document_name}] Rendering {doc_type} document")
+        pages, extraction_path = await arun_stage(
+            document_name, "render", attempts, self._render, estimated_bytes, doc_type, content, options,
+            retry_on=(BrokenProcessPool,)
+        )
+
+        # the reservation taken on the render thread lasts until the extraction call returns
+        try:
+            # pixel comparisons; not on the render threads, which may be waiting for the memory these pages hold
+            pages, skipped_pages = await asyncio.to_thread(page_filter.filter_pages, pages)
+            if any(skipped_pages.values()):
+                log.info(f"[{document_name}] Skipped pages: {skipped_pages['blank']} blank, {skipped_pages['duplicate']} duplicate, "
+                      f"{skipped_pages['cross_document_duplicate']} repeated from another document and still sent")
+            text_pages = sum(1 for page in pages if "text" in page)
+            image_pages = sum(1 for page in pages if "image_url" in page)
+
+            log.info(f"[{document_name}] Calling OpenAI via {extraction_path} path with {image_pages} images and {text_pages} text pages...")
+            result, chunk_count = await self._extract(document_name, pages, options, attempts)
+        finally:
+            memory_admission.release(estimated_bytes)
+
+        result["processing"] = {
+            "extraction_path": extraction_path,
+            "text_pages": text_pages,
+            "image_pages": image_pages,
+            "chunks": chunk_count,
+            "extraction": options.extraction,
+            "skipped_pages": skipped_pages,
+            "memory_estimate_bytes": estimated_bytes
+        }
+        if should_cache(result, cache_key):
+            await asyncio.to_thread(result_cache.set, cache_key, result)
+        return result
+
+    async def _process_document_core(
+        self, path: str, options: AnalysisOptions, attempts: Dict[str, int], page_filter: PageFilter
+    ) -> Tuple[dict, bool, bool]:
+        document_name = Path(path).name
+        doc_type = get_document_type(path)
+
+        if doc_type not in ("pdf", "image"):
+            raise StageError("input", f"Processing error: Unsupported file type: {path}", "unsupported_type")
+
+        # an oversized or missing file stays that way, only connection errors, timeouts and 5xx / 429 are retried
+        content = await arun_stage(
+            document_name, "download", attempts, self._download, path, retry_on=ARETRYABLE_DOWNLOAD_ERRORS
+        )
+
+        # hashing tens of megabytes and the SQLite lookup stay off the loop
+        content_key = await asyncio.to_thread(make_cache_key, content, options)
+        cache_key = content_key if result_cache is not None else None
+        if cache_key is not None and options.use_cache:
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            if cached is not None:
+                log.info(f"[{document_name}] Cache hit, skipping rendering and OpenAI call")
+                return cached, True, False
+
+        result, shared = await self._coalesce(
+            f"content:{content_key}|filter:{page_filter.scope}", attempts, ("render", "llm"), self._analyse_content,
+            document_name, doc_type, content, options, attempts, page_filter, cache_key
+        )
+        if shared:
+            log.info(f"[{document_name}] Reused the result of an identical document processed concurrently")
+        return result, False, shared
+
+    async def process_single_document(
+        self, path: str, options: AnalysisOptions = default_options, page_filter: Optional[PageFilter] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        document_name = Path(path).name
+        with log_context(document=document_name):
+            log_start(document_name)
+
+            start_time = time.time()
+            attempts = {stage: 0 for stage in STAGES}
+
+            try:
+                if page_filter is None:
+                    page_filter = PageFilter(options.page_filter)
+                (result, cache_hit, coalesced), shared = await self._coalesce(
+                    f"document:{path}|{options.fingerprint()}|cache:{int(options.use_cache)}|filter:{page_filter.scope}",
+                    attempts, STAGES, self._process_document_core, path, options, attempts, page_filter
+                )
+                coalesced = coalesced or shared
+            except StageError as e:
+                return document_name, failure_result(document_name, e, attempts, start_time)
+
+            return document_name, success_result(document_name, result, cache_hit, coalesced, attempts, start_time)
+
+    async def process_documents(
+        self, paths: list[str], options: AnalysisOptions = default_options, request_name: str = "request"
+    ) -> Dict[str, Any]:
+        window = asyncio.Semaphore(self.request_window)
+        log.info(f"Scheduling {len(paths)} documents on the asyncio engine with {self.request_window} in flight for {request_name}")
+
+        # the same per-document allowance as the threaded engine, counted from when the document starts
+        max_time_per_doc = DOCUMENT_TIMEOUT * (MAX_RETRIES + 1) + (MAX_RETRIES * RETRY_DELAY)
+        page_filter = PageFilter(options.page_filter)
+
+        async def run(path: str) -> Tuple[str, Dict[str, Any]]:
+            async with window, self._documents:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                DOCUMENTS_IN_FLIGHT.labels("asyncio").set(self.in_flight)
+                try:
+                    return await asyncio.wait_for(
+                        self.process_single_document(path, options, page_filter), max_time_per_doc
+                    )
+                except asyncio.TimeoutError:
+                    DOCUMENT_FAILURES.labels("document", "timeout").inc()
+                    return Path(path).name, {"error": f"Processing timeout after {max_time_per_doc} seconds"}
+                except Exception as e:
+                    log.error(f"Document coroutine failed for {path}: {str(e)}")
+                    DOCUMENT_FAILURES.labels("document", "processing").inc()
+                    return Path(path).name, {"error": f"Future execution error: {str(e)}"}
+                finally:
+                    self.in_flight -= 1
+                    DOCUMENTS_IN_FLIGHT.labels("asyncio").set(self.in_flight)
+
+        results = dict()
+        for finished in asyncio.as_completed([run(path) for path in paths]):
+            filename, result = await finished
+            results[filename] = result
+            if "error" in result:
+                self.failed += 1
+                if "final_failure" in result:
+                    log.warning(f"Failed permanently after {result.get('attempts', 'unknown')} attempts: {filename}")
+                else:
+                    log.warning(f"Failed: {filename}")
+            else:
+                self.completed += 1
+                log.info(f"Successfully processed: {filename}")
+
+        log.info(f"Completed {len(results)} of {len(paths)} documents, page filter: {page_filter.stats()}")
+        return results
+
+    async def _run_documents(self, paths: list[str], options: AnalysisOptions, paths_url: str) -> Dict[str, Any]:
+        try:
+            return await self.process_documents(paths, options, request_name=paths_url)
+        except Exception as e:
+            log.error(f"Error processing documents: {str(e)}")
+            return {Path(path).name: {"error": f"Document processing failed: {str(e)}"} for path in paths}
+
+    async def create_dict_result(
+        self, paths_url: str, options: AnalysisOptions = default_options, paths: Optional[list[str]] = None
+    ) -> Dict[str, Any]:
+        """create_dict_result on the event loop; the index is fetched with the async client when `paths` is not given."""
+        if paths is None:
+            paths = await afetch_document_links(paths_url)
+
+        if not paths:
+            log.info("No documents found to process")
+            return dict()
+
+        log_request(len(paths), options)
+        openai_results, shared = await self._coalesce(
+            f"request:{paths_url}|{options.fingerprint()}|cache:{int(options.use_cache)}", {}, (),
+            self._run_documents, paths, options, paths_url
+        )
+        if shared:
+            log.info(f"Reused the results of an identical request for {paths_url} already in flight")
+        return finalize_results(openai_results)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._loop is not None,
+            "max_in_flight": self.max_in_flight,
+            "request_window": self.request_window,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "download_concurrency": self.download_concurrency,
+            "llm_concurrency": self.llm_concurrency,
+            "llm_calls_in_flight": self.llm_in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "coalesced": self.coalesced
+        }
+
+
+async_engine = AsyncEngine(ASYNC_MAX_IN_FLIGHT, ASYNC_REQUEST_WINDOW, ASYNC_DOWNLOAD_CONCURRENCY, ASYNC_LLM_CONCURRENCY)
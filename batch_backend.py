@@ -0,0 +1,111 @@
+import json
+import time
+import uuid
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from openai_service import client, BATCH_ENDPOINT
+
+BACKENDS = ("openai", "fake")
+# batch states after which the output and error files are final
+_OPENAI_FINISHED = ("completed", "failed", "expired", "cancelled")
+
+
+class OpenAIBatchBackend:
+    """
+    OpenAI Batch API: the input JSONL is uploaded as a file and the batch
+    finishes within its 24h completion window. Requests of an expired or
+    cancelled batch that did answer are in its output file like any other.
+    """
+
+    def submit(self, input_path: Path) -> str:
+        with open(input_path, "rb") as input_file:
+            uploaded = client.files.create(file=input_file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT, completion_window="24h",
+            metadata={"source": "bulk", "input": input_path.name}
+        )
+        return batch.id
+
+    def poll(self, batch_id: str) -> Tuple[str, list[Dict[str, Any]], Optional[str]]:
+        """Return (status, output lines, error); status is "running", "completed" or "failed"."""
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in _OPENAI_FINISHED:
+            return "running", [], None
+
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(json.loads(line) for line in client.files.content(file_id).text.splitlines() if line.strip())
+
+        error = None
+        if batch.status != "completed":
+            details = [item.message for item in (batch.errors.data if batch.errors and batch.errors.data else [])]
+            error = f"Batch {batch.status}" + (f": {'; '.join(details)}" if details else "")
+        return ("completed" if batch.status == "completed" else "failed"), lines, error
+
+
+class FakeBatchBackend:
+    """
+    Local stand-in for the Batch API, for tests and dry runs. A batch
+    finishes `delay` seconds after it was submitted and every request is
+    answered with a fixed extraction instead of a model call. Batches live
+    in `work_dir`, so an interrupted run can still collect them.
+    """
+
+    def __init__(self, work_dir: str, delay: float = 0.0):
+        self.dir = Path(work_dir) / "fake_batches"
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.delay = delay
+
+    def submit(self, input_path: Path) -> str:
+        batch_id = f"fake_batch_{uuid.uuid4().hex[:16]}"
+        shutil.copyfile(input_path, self.dir / f"{batch_id}.jsonl")
+        return batch_id
+
+    def poll(self, batch_id: str) -> Tuple[str, list[Dict[str, Any]], Optional[str]]:
+        input_path = self.dir / f"{batch_id}.jsonl"
+        if not input_path.exists():
+            return "failed", [], f"Unknown batch {batch_id}"
+        if time.time() - input_path.stat().st_mtime < self.delay:
+            return "running", [], None
+
+        with open(input_path, encoding="utf-8") as input_file:
+            lines = [self._answer(json.loads(line)) for line in input_file if line.strip()]
+        return "completed", lines, None
+
+    @staticmethod
+    def _answer(request: Dict[str, Any]) -> Dict[str, Any]:
+        content = request["body"]["messages"][-1]["content"]
+        images = sum(1 for part in content if part.get("type") == "image_url")
+        texts = sum(1 for part in content if part.get("type") == "text")
+        extraction = {
+            "titlu_document": None,
+            "nume_prenume_pacient": None,
+            "variabila_booleana_diagnostic_curent": False,
+            "variabila_booleana_analize_medicale": False,
+            "variabila_booleana_examen_hispotatologic": False,
+            "variabila_booleana_interpretari_ale_imagisticii": False,
+            "sumar_document": f"Extractie de test din {images} imagini si {texts} blocuri de text."
+        }
+        return {
+            "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(extraction, ensure_ascii=False)}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+                }
+            },
+            "error": None
+        }
+
+
+def make_backend(name: str, work_dir: str):
+    if name == "openai":
+        return OpenAIBatchBackend()
+    if name == "fake":
+        return FakeBatchBackend(work_dir)
+    raise ValueError(f"Batch backend must be one of {', '.join(BACKENDS)}")
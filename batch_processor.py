@@ -1,200 +1,344 @@
 import time
+import logging
+import contextvars
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Tuple, Dict, Any
-from datetime import datetime
+from typing import Tuple, Dict, Any, Callable, Optional
 
-import requests
-
-from config import (
-    MAX_RETRIES, RETRY_DELAY, DOCUMENT_TIMEOUT, MAX_WORKERS, BATCH_SIZE,
-    REQUEST_TIMEOUT, OPENAI_TIMEOUT
-)
-from document_processor import (
-    process_pdf_document, process_image_document, get_document_type
+from config import MAX_RETRIES, RETRY_DELAY, DOCUMENT_TIMEOUT, OPENAI_MAX_RETRIES, LLM_CONCURRENCY
+from document_processor import get_document_type, load_document_bytes
+from http_client import RETRYABLE_DOWNLOAD_ERRORS
+from openai_service import summarize_document, RetryableAPIError
+from extraction import extract_pages, classify_document
+from chunking import split_chunks, chunk_page_range
+from page_filter import PageFilter
+from singleflight import single_flight
+from admission import memory_admission, estimate_document_bytes
+from options import AnalysisOptions, default_options
+from cache import result_cache, make_cache_key
+from scheduler import scheduler
+from pipeline import download_stage, llm_stage
+from stages import STAGES, StageError, stage_error, run_stage, stage_attempts, render_pages
+from results import (
+    merge_chunks, apply_summary, should_cache, log_start, log_request, failure_result, success_result, finalize_results
 )
-from openai_service import call_openai_with_images
-from utils import fetch_document_links, parse_date
+from utils import fetch_document_links
+from logs import log_context
+from metrics import DOCUMENT_FAILURES
+
+log = logging.getLogger(__name__)
+
+# extraction calls for the chunks of long documents; they only wait on the llm stage, so sharing the pool cannot deadlock
+_chunk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix="chunk")
+
+
+def _call_llm(document_name: str, attempts: Dict[str, int], fn: Callable, *args: Any) -> dict:
+    # only rate limits, timeouts and 5xx come back as exceptions; other API errors are part of the result
+    return run_stage(
+        document_name, "llm", attempts, llm_stage.run, fn, *args,
+        retry_on=(RetryableAPIError,), max_retries=OPENAI_MAX_RETRIES
+    )
+
+
+def _extract(document_name: str, pages: list[dict], options: AnalysisOptions, attempts: Dict[str, int]) -> Tuple[dict, int]:
+    """Run the extraction in one call, or per chunk concurrently with the partial results merged."""
+    chunks = split_chunks(pages, options.chunk_pages)
+    if len(chunks) == 1:
+        return _call_llm(document_name, attempts, extract_pages, pages, None, options.extraction), 1
+
+    log.info(f"[{document_name}] Extracting {len(pages)} pages in {len(chunks)} chunks of up to {options.chunk_pages} pages")
+    mode, flags = options.extraction, None
+    if mode == "two_step":
+        # the title is on the first page of the document, not of each chunk; without flags every chunk asks for all fields
+        flags = _call_llm(document_name, attempts, classify_document, pages)
+        mode = "two_step" if flags is not None else "single"
+
+    # each chunk retries on its own; the document reports the most attempts any chunk needed
+    chunk_attempts = [{} for _ in chunks]
+    futures = [
+        _chunk_executor.submit(
+            contextvars.copy_context().run, _call_llm, f"{document_name} p{chunk_page_range(chunk)}", chunk_attempts[index],
+            extract_pages, chunk, len(pages), mode, flags
+        )
+        for index, chunk in enumerate(chunks)
+    ]
+    try:
+        results = [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+        attempts["llm"] = max([attempts.get("llm", 0)] + [chunk.get("llm", 0) for chunk in chunk_attempts])
+
+    merged, partial_summaries = merge_chunks(results)
+    if partial_summaries:
+        log.info(f"[{document_name}] Summarising {len(partial_summaries)} partial summaries")
+        summary_attempts = {}
+        summary = _call_llm(document_name, summary_attempts, summarize_document, partial_summaries)
+        attempts["llm"] = max(attempts["llm"], summary_attempts["llm"])
+        apply_summary(merged, partial_summaries, summary)
+
+    return merged, len(chunks)
+
+
+def _analyse_content(
+    document_name: str,
+    doc_type: str,
+    content: bytes,
+    options: AnalysisOptions,
+    attempts: Dict[str, int],
+    page_filter: PageFilter,
+    cache_key: Optional[str]
+) -> dict:
+    try:
+        estimated_bytes = estimate_document_bytes(doc_type, content, options.encoding, options.page_limit)
+    except Exception as e:
+        raise stage_error(e, "render")
+
+    log.info(f"[{document_name}] Estimated memory {estimated_bytes / (1024 * 1024):.1f} MB")
+    # rendered pages stay in memory until the extraction call returns, so the reservation covers both
+    with memory_admission.reserve(estimated_bytes):
+        result = _render_and_extract(document_name, doc_type, content, options, attempts, page_filter, cache_key)
+    result["processing"]["memory_estimate_bytes"] = estimated_bytes
+    return result
+
 
+def _render_and_extract(
+    document_name: str,
+    doc_type: str,
+    content: bytes,
+    options: AnalysisOptions,
+    attempts: Dict[str, int],
+    page_filter: PageFilter,
+    cache_key: Optional[str]
+) -> dict:
+    log.info(f"[{document_name}] Rendering {doc_type} document")
+    # rendering is deterministic, only a crashed render process is worth another attempt
+    pages, extraction_path = run_stage(
+        document_name, "render", attempts, render_pages, doc_type, content, options, retry_on=(BrokenProcessPool,)
+    )
+    pages, skipped_pages = page_filter.filter_pages(pages)
+    if any(skipped_pages.values()):
+        log.info(f"[{document_name}] Skipped pages: {skipped_pages['blank']} blank, {skipped_pages['duplicate']} duplicate, "
+              f"{skipped_pages['cross_document_duplicate']} repeated from another document and still sent")
+    text_pages = sum(1 for page in pages if "text" in page)
+    image_pages = sum(1 for page in pages if "image_url" in page)
 
-def _process_document_core(path: str) -> dict:
+    log.info(f"[{document_name}] Calling OpenAI via {extraction_path} path with {image_pages} images and {text_pages} text pages...")
+    result, chunk_count = _extract(document_name, pages, options, attempts)
+    result["processing"] = {
+        "extraction_path": extraction_path,
+        "text_pages": text_pages,
+        "image_pages": image_pages,
+        "chunks": chunk_count,
+        "extraction": options.extraction,
+        "skipped_pages": skipped_pages
+    }
+
+    if should_cache(result, cache_key):
+        result_cache.set(cache_key, result)
+
+    return result
+
+
+def _coalesce(key: str, attempts: Dict[str, int], stages: Tuple[str, ...], fn: Callable, *args: Any) -> Tuple[Any, bool]:
+    """single_flight.do that also gives the callers that waited the leader's attempts at `stages`."""
+    def run() -> Tuple[Any, Dict[str, int]]:
+        try:
+            return fn(*args), stage_attempts(attempts, stages)
+        except StageError as e:
+            e.attempts = stage_attempts(attempts, stages)
+            raise
+
+    try:
+        (result, leader_attempts), shared = single_flight.do(key, run)
+    except StageError as e:
+        if e.attempts is not None:
+            attempts.update(e.attempts)
+        raise
+    if shared:
+        attempts.update(leader_attempts)
+    return result, shared
+
+
+def _process_document_core(
+    path: str, options: AnalysisOptions, attempts: Dict[str, int], page_filter: PageFilter
+) -> Tuple[dict, bool, bool]:
+    """Return (result, cache_hit, coalesced), coalesced when another document with the same bytes did the work."""
     document_name = Path(path).name
     doc_type = get_document_type(path)
     
-    if doc_type == "pdf":
-        print(f"[{document_name}] Processing PDF document")
-        data_urls = process_pdf_document(path)
-        print(f"[{document_name}] Calling OpenAI with {len(data_urls)} images...")
-        return call_openai_with_images(data_urls)
-        
-    elif doc_type == "image":
-        print(f"[{document_name}] Processing image document")
-        data_url = process_image_document(path)
-        print(f"[{document_name}] Calling OpenAI with image...")
-        return call_openai_with_images([data_url])
-        
-    else:
-        raise RuntimeError(f"Unsupported file type: {path}")
+    if doc_type not in ("pdf", "image"):
+        raise StageError("input", f"Processing error: Unsupported file type: {path}", "unsupported_type")
+
+    # an oversized or missing file stays that way, only connection errors, timeouts and 5xx / 429 are retried
+    content = run_stage(
+        document_name, "download", attempts, download_stage.run, load_document_bytes, path,
+        retry_on=RETRYABLE_DOWNLOAD_ERRORS
+    )
+
+    content_key = make_cache_key(content, options)
+    cache_key = content_key if result_cache is not None else None
+    if cache_key is not None and options.use_cache:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            log.info(f"[{document_name}] Cache hit, skipping rendering and OpenAI call")
+            return cached, True, False
 
+    # the same bytes under another URL may already be rendering or waiting on OpenAI
+    result, shared = _coalesce(
+        f"content:{content_key}|filter:{page_filter.scope}", attempts, ("render", "llm"), _analyse_content,
+        document_name, doc_type, content, options, attempts, page_filter, cache_key
+    )
+    if shared:
+        log.info(f"[{document_name}] Reused the result of an identical document processed concurrently")
+    return result, False, shared
 
-def process_single_document(path: str) -> Tuple[str, Dict[str, Any]]:
+
+def process_single_document(
+    path: str, options: AnalysisOptions = default_options, page_filter: Optional[PageFilter] = None
+) -> Tuple[str, Dict[str, Any]]:
     document_name = Path(path).name
-    print(f"[{document_name}] Starting processing...")
-    print(f"[{document_name}] Timeouts - Request: {REQUEST_TIMEOUT}s, OpenAI: {OPENAI_TIMEOUT}s, Document: {DOCUMENT_TIMEOUT}s")
-    print(f"[{document_name}] Retry configuration - Max retries: {MAX_RETRIES}, Retry delay: {RETRY_DELAY}s")
-    
-    start_time = time.time()
-    last_error = None
-    
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            attempt_start = time.time()
-            
-            if attempt > 0:
-                print(f"[{document_name}] Retry attempt {attempt}/{MAX_RETRIES}")
-                time.sleep(RETRY_DELAY)
-            else:
-                print(f"[{document_name}] Initial attempt")
-            
-            result = _process_document_core(path)
-            
-            attempt_time = time.time() - attempt_start
-            total_time = time.time() - start_time
-            
-            if attempt > 0:
-                print(f"[{document_name}] Successfully processed on retry {attempt} in {attempt_time:.2f}s (total: {total_time:.2f}s)")
-            else:
-                print(f"[{document_name}] Successfully processed on first attempt in {attempt_time:.2f}s")
-            
-            return document_name, result
-            
-        except requests.exceptions.Timeout as e:
-            last_error = f"Network timeout: {str(e)}"
-            print(f"[{document_name}] Attempt {attempt + 1} failed - {last_error}")
-        except requests.exceptions.RequestException as e:
-            last_error = f"Network error: {str(e)}"
-            print(f"[{document_name}] Attempt {attempt + 1} failed - {last_error}")
-        except Exception as e:
-            last_error = f"Processing error: {str(e)}"
-            print(f"[{document_name}] Attempt {attempt + 1} failed - {last_error}")
-        
-
-        if attempt < MAX_RETRIES:
-            print(f"[{document_name}] Will retry in {RETRY_DELAY} seconds...")
-        else:
-            total_time = time.time() - start_time
-            print(f"[{document_name}] All {MAX_RETRIES + 1} attempts failed after {total_time:.2f}s")
-    
-    return document_name, {
-        "error": last_error,
-        "attempts": MAX_RETRIES + 1,
-        "final_failure": True
-    }
+    with log_context(document=document_name):
+        log_start(document_name)
 
+        start_time = time.time()
+        attempts = {stage: 0 for stage in STAGES}
 
-def process_document_batch(paths_batch: list[str], batch_number: int) -> Dict[str, Any]:
-    batch_results = dict()
-    print(f"Processing batch {batch_number} with {len(paths_batch)} documents")
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_path = {executor.submit(process_single_document, path): path for path in paths_batch}
-
-        # per document --> DOCUMENT_TIMEOUT * (MAX_RETRIES + 1) + (MAX_RETRIES * RETRY_DELAY)
-        max_time_per_doc = DOCUMENT_TIMEOUT * (MAX_RETRIES + 1) + (MAX_RETRIES * RETRY_DELAY)
-        batch_timeout = max_time_per_doc * len(paths_batch)
-        print(f"Batch timeout set to {batch_timeout} seconds ({max_time_per_doc}s per document including retries)")
-        
         try:
-            for future in concurrent.futures.as_completed(future_to_path, timeout=batch_timeout):
-                try:
-                    filename, result = future.result(timeout=10)
-                    batch_results[filename] = result
-                    
-                    if "error" in result:
-                        if "final_failure" in result:
-                            print(f"Failed permanently after {result.get('attempts', 'unknown')} attempts: {filename}")
-                        else:
-                            print(f"Failed: {filename}")
+            if page_filter is None:
+                page_filter = PageFilter(options.page_filter)
+            # a URL already in flight, e.g. from a parallel request for the same patient, is not processed twice
+            (result, cache_hit, coalesced), shared = _coalesce(
+                f"document:{path}|{options.fingerprint()}|cache:{int(options.use_cache)}|filter:{page_filter.scope}",
+                attempts, STAGES, _process_document_core, path, options, attempts, page_filter
+            )
+            coalesced = coalesced or shared
+        except StageError as e:
+            return document_name, failure_result(document_name, e, attempts, start_time)
+
+        return document_name, success_result(document_name, result, cache_hit, coalesced, attempts, start_time)
+
+
+def process_documents(
+    paths: list[str],
+    options: AnalysisOptions = default_options,
+    on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    request_name: str = "request"
+) -> Dict[str, Any]:
+    results = dict()
+    ticket = scheduler.open_request(request_name)
+    log.info(f"Scheduling {len(paths)} documents with {ticket.window} in flight for this request")
+
+    # per document --> DOCUMENT_TIMEOUT * (MAX_RETRIES + 1) + (MAX_RETRIES * RETRY_DELAY)
+    max_time_per_doc = DOCUMENT_TIMEOUT * (MAX_RETRIES + 1) + (MAX_RETRIES * RETRY_DELAY)
+    # the window refills continuously, so the request needs about len(paths) / window document slots
+    request_timeout = max_time_per_doc * -(-len(paths) // ticket.window)
+    log.info(f"Request timeout set to {request_timeout} seconds ({max_time_per_doc}s per document including retries)")
+
+    # shared by the request's documents so pages repeated across them are sent only once
+    page_filter = PageFilter(options.page_filter)
+    future_to_path = {ticket.submit(process_single_document, path, options, page_filter): path for path in paths}
+
+    def record(filename: str, result: Dict[str, Any]) -> None:
+        results[filename] = result
+        if on_result is not None:
+            on_result(filename, result)
+
+    try:
+        for future in concurrent.futures.as_completed(future_to_path, timeout=request_timeout):
+            if future.cancelled():
+                continue
+
+            try:
+                filename, result = future.result()
+                record(filename, result)
+
+                if "error" in result:
+                    if "final_failure" in result:
+                        log.warning(f"Failed permanently after {result.get('attempts', 'unknown')} attempts: {filename}")
                     else:
-                        print(f"Successfully processed: {filename}")
-                        
-                except Exception as e:
-                    path = future_to_path[future]
-                    print(f"Future execution failed for {path}: {str(e)}")
-                    batch_results[Path(path).name] = {"error": f"Future execution error: {str(e)}"}
-                    
-        except concurrent.futures.TimeoutError:
-            print(f"Batch {batch_number} timed out after {batch_timeout} seconds")
-            for future, path in future_to_path.items():
-                if not future.done():
-                    future.cancel()
-                    filename = Path(path).name
-                    if filename not in batch_results:
-                        batch_results[filename] = {"error": f"Processing timeout after {batch_timeout} seconds"}
-                elif future.done() and Path(path).name not in batch_results:
-                    try:
-                        filename, result = future.result()
-                        batch_results[filename] = result
-                    except Exception as e:
-                        batch_results[Path(path).name] = {"error": str(e)}
-    
-    print(f"Completed batch {batch_number}: processed {len(batch_results)} documents")
-    return batch_results
+                        log.warning(f"Failed: {filename}")
+                else:
+                    log.info(f"Successfully processed: {filename}")
+
+            except Exception as e:
+                path = future_to_path[future]
+                log.error(f"Future execution failed for {path}: {str(e)}")
+                DOCUMENT_FAILURES.labels("document", "processing").inc()
+                record(Path(path).name, {"error": f"Future execution error: {str(e)}"})
 
+            if should_cancel is not None and should_cancel():
+                cancelled = ticket.cancel_pending()
+                if cancelled:
+                    log.warning(f"Request cancelled, dropped {cancelled} queued documents")
 
-def create_dict_result(paths_url: str) -> Dict[str, Any]:
-    openai_results = dict()
-    paths = fetch_document_links(paths_url)
+    except concurrent.futures.TimeoutError:
+        log.warning(f"Request timed out after {request_timeout} seconds")
+        ticket.cancel_pending()
+        for future, path in future_to_path.items():
+            filename = Path(path).name
+            if filename in results or future.cancelled():
+                continue
+            if not future.done():
+                DOCUMENT_FAILURES.labels("document", "timeout").inc()
+                record(filename, {"error": f"Processing timeout after {request_timeout} seconds"})
+                continue
+            try:
+                filename, result = future.result()
+                record(filename, result)
+            except Exception as e:
+                record(filename, {"error": str(e)})
+
+    finally:
+        ticket.close()
+
+    log.info(f"Completed {len(results)} of {len(paths)} documents, page filter: {page_filter.stats()}")
+    return results
+
+
+def _run_documents(
+    paths: list[str],
+    options: AnalysisOptions,
+    paths_url: str,
+    on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None
+) -> Dict[str, Any]:
+    try:
+        return process_documents(paths, options, on_result, should_cancel, request_name=paths_url)
+    except Exception as e:
+        log.error(f"Error processing documents: {str(e)}")
+        return {Path(path).name: {"error": f"Document processing failed: {str(e)}"} for path in paths}
+
+
+def create_dict_result(
+    paths_url: str,
+    options: AnalysisOptions = default_options,
+    on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    paths: Optional[list[str]] = None
+) -> Dict[str, Any]:
+    """Process the documents listed at `paths_url`; callers that already fetched the index pass `paths`."""
+    if paths is None:
+        paths = fetch_document_links(paths_url)
     
     if not paths:
-        print("No documents found to process")
-        return openai_results
-    
-    total_documents = len(paths)
-    batch_size = BATCH_SIZE
-    total_batches = (total_documents + batch_size - 1) // batch_size
-    
-    print(f"Total documents to process: {total_documents}")
-    print(f"Processing in {total_batches} batches of {batch_size} documents each")
-    print(f"Configuration: Request timeout: {REQUEST_TIMEOUT}s, OpenAI timeout: {OPENAI_TIMEOUT}s, Document timeout: {DOCUMENT_TIMEOUT}s")
-    print(f"Retry configuration: Max retries: {MAX_RETRIES}, Retry delay: {RETRY_DELAY}s")
+        log.info("No documents found to process")
+        return dict()
     
-    for batch_num in range(total_batches):
-        start_idx = batch_num * batch_size
-        end_idx = min(start_idx + batch_size, total_documents)
-        
-        batch_paths = paths[start_idx:end_idx]
-        print(f"\n--- Starting Batch {batch_num + 1}/{total_batches} ---")
-        print(f"Documents in this batch: {[Path(p).name for p in batch_paths]}")
-        
-        try:
-            batch_results = process_document_batch(batch_paths, batch_num + 1)
-            openai_results.update(batch_results)
-            
-            if batch_num < total_batches - 1:
-                print(f"Waiting 2 seconds before next batch...")
-                time.sleep(2)
-                
-        except Exception as e:
-            print(f"Error processing batch {batch_num + 1}: {str(e)}")
-            for path in batch_paths:
-                openai_results[Path(path).name] = {"error": f"Batch processing failed: {str(e)}"}
-
-    openai_results_sorted = dict(sorted(
-        openai_results.items(),
-        key=lambda item: parse_date(
-            item[1].get("data_introducere_document") or item[1].get("data_rezultat", "")
-        ) if "error" not in item[1] else datetime.min,
-        reverse=True
-    ))
-    
-    successful_count = sum(1 for r in openai_results_sorted.values() if "error" not in r)
-    failed_count = len(openai_results_sorted) - successful_count
-    retry_failures = sum(1 for r in openai_results_sorted.values() if r.get("final_failure", False))
-    
-    print(f"\nProcessing complete! Total results: {len(openai_results_sorted)}")
-    print(f"Successful: {successful_count}, Failed: {failed_count}")
-    if retry_failures > 0:
-        print(f"Failed after all retries: {retry_failures}")
-    
-    return openai_results_sorted
\ No newline at end of file
+    log_request(len(paths), options)
+
+    if on_result is None and should_cancel is None:
+        # a plain /analyze for a paths_url already in flight waits for that run instead of starting its own;
+        # streams and jobs report documents as they finish, so they only share work per document
+        openai_results, shared = single_flight.do(
+            f"request:{paths_url}|{options.fingerprint()}|cache:{int(options.use_cache)}",
+            _run_documents, paths, options, paths_url
+        )
+        if shared:
+            log.info(f"Reused the results of an identical request for {paths_url} already in flight")
+    else:
+        openai_results = _run_documents(paths, options, paths_url, on_result, should_cancel)
+
+    return finalize_results(openai_results)
@@ -0,0 +1,168 @@
+"""
+Synthetic document corpus and a local server for it.
+
+The corpus mixes scanned PDFs, born-digital PDFs with a text layer and
+single-page PNG / JPEG scans, with page counts spread up to --max-pages.
+Every document names its own patient, so no two documents share pages.
+The server answers GET /index.json like the document index the app reads,
+optionally split with ?part=i&parts=n, and serves the files under /files/.
+
+    python benchmarks/document_server.py --directory /tmp/corpus --documents 200 --port 8090
+    curl -X POST localhost:5000/analyze -d '{"paths_url": "http://127.0.0.1:8090/index.json"}' -H 'Content-Type: application/json'
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw, ImageFilter
+
+KINDS = ("scan", "text", "png", "jpeg")
+PAGE_SIZE = (1240, 1754)
+
+
+def _scan_page(document: int, page: int, lines: int) -> Image.Image:
+    img = Image.effect_noise(PAGE_SIZE, 18).convert("RGB").point(lambda value: 200 + value // 5)
+    draw = ImageDraw.Draw(img)
+    draw.text((80, 60), f"SCRISOARE MEDICALA - PACIENT TEST{document:05d} - CNP 1800101{document:06d}", fill=(20, 20, 20))
+    for line in range(lines):
+        draw.text((80, 110 + line * 26), f"Pagina {page + 1} rand {line}: hemoglobina {11 + (document + line) % 5}.{page} g/dL", fill=(20, 20, 20))
+    return img.filter(ImageFilter.GaussianBlur(0.6))
+
+
+def _text_pdf(document: int, pages: int) -> bytes:
+    """A minimal born-digital PDF whose pages carry a real text layer."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for page in range(pages):
+        lines = [f"Scrisoare medicala pacient TEST{document:05d} pagina {page + 1} rand {line} hemoglobina 13.{line} g/dL"
+                 for line in range(40)]
+        stream = "BT /F1 10 Tf 40 800 Td 14 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * page} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+def generate_corpus(directory: str, documents: int, max_pages: int = 6, seed: int = 0) -> list[dict]:
+    """Write the corpus into `directory` and return its manifest; an existing manifest with the same parameters is reused."""
+    root = Path(directory)
+    root.mkdir(parents=True, exist_ok=True)
+    manifest_path = root / "manifest.json"
+    parameters = {"documents": documents, "max_pages": max_pages, "seed": seed}
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["parameters"] == parameters:
+            return manifest["files"]
+
+    rng = random.Random(seed)
+    files = []
+    for document in range(documents):
+        kind = KINDS[rng.randrange(len(KINDS))]
+        pages = 1 if kind in ("png", "jpeg") else rng.randint(1, max_pages)
+        if kind == "scan":
+            name = f"doc_{document:05d}_scan.pdf"
+            images = [_scan_page(document, page, rng.randint(10, 60)) for page in range(pages)]
+            buf = BytesIO()
+            images[0].save(buf, format="PDF", save_all=True, append_images=images[1:], resolution=150)
+            content = buf.getvalue()
+        elif kind == "text":
+            name = f"doc_{document:05d}_text.pdf"
+            content = _text_pdf(document, pages)
+        else:
+            name = f"doc_{document:05d}_scan.{'png' if kind == 'png' else 'jpg'}"
+            buf = BytesIO()
+            _scan_page(document, 0, rng.randint(10, 60)).save(buf, format="PNG" if kind == "png" else "JPEG", quality=85)
+            content = buf.getvalue()
+        (root / name).write_bytes(content)
+        files.append({"name": name, "kind": kind, "pages": pages, "bytes": len(content)})
+
+    manifest_path.write_text(json.dumps({"parameters": parameters, "files": files}, indent=2))
+    return files
+
+
+def make_handler(directory: Path, names: list[str], latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, payload: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/index.json":
+                query = parse_qs(url.query)
+                parts = int(query.get("parts", ["1"])[0])
+                part = int(query.get("part", ["0"])[0])
+                host = self.headers.get("Host")
+                documents = [
+                    {"document_url": f"http://{host}/files/{name}"} for index, name in enumerate(names) if index % parts == part
+                ]
+                self._send(200, json.dumps({"documents": documents}).encode("utf-8"), "application/json")
+                return
+
+            name = url.path.removeprefix("/files/")
+            if name not in names:
+                self._send(404, b"not found", "text/plain")
+                return
+            if latency:
+                time.sleep(latency)
+            self._send(200, (directory / name).read_bytes(), "application/octet-stream")
+
+    return Handler
+
+
+def serve(host: str, port: int, directory: str, names: list[str], latency: float = 0.0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(Path(directory), names, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", required=True)
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--max-pages", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every file download")
+    args = parser.parse_args()
+
+    files = generate_corpus(args.directory, args.documents, args.max_pages, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(Path(args.directory), [f["name"] for f in files], args.latency))
+    server.daemon_threads = True
+    print(f"Serving {len(files)} documents, index at http://{args.host}:{args.port}/index.json")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+End-to-end benchmark over a synthetic corpus and the fake OpenAI server.
+
+The corpus (benchmarks/document_server.py) and the fake OpenAI server
+(benchmarks/fake_openai_server.py) run in this process. Every cell of the
+parameter matrix runs in a fresh subprocess, because config.py reads the
+environment on import, and is driven through one of these modes:
+
+    create_dict_result  one call over the whole corpus
+    analyze             --clients concurrent POST /analyze, each for a slice of the corpus
+    asyncio             the same against POST /analyze/asyncio
+
+For each cell it reports the throughput, p50/p95/p99 latency (of documents
+for create_dict_result, of requests for the endpoints), the peak RSS, the
+per-stage timings from /pipeline/stats, the tokens of every kind of OpenAI
+call, the extraction time per extraction mode and the 429/5xx the server
+sent. Put EXTRACTION_MODE in the matrix to compare "single" and "two_step".
+Results are saved as JSON; --compare flags cells that got slower than a
+saved baseline.
+
+    python benchmarks/e2e_benchmark.py --documents 60 --matrix '{"MAX_WORKERS": [4, 8], "DPI": [100, 150]}' \\
+        --output bench/e2e_new.json --compare bench/e2e_baseline.json
+
+The app's settings come from the matrix and the defaults below, not from .env.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import itertools
+import subprocess
+import tempfile
+import threading
+import statistics
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+MODES = ("create_dict_result", "analyze", "asyncio")
+
+# settings every cell starts from; the matrix overrides them
+BASE_SETTINGS = {
+    "MODEL": "fake-model",
+    "DPI": "100",
+    "MAX_PAGES": "6",
+    "REQUEST_TIMEOUT": "30",
+    "OPENAI_TIMEOUT": "60",
+    "DOCUMENT_TIMEOUT": "300",
+    "MAX_RETRIES": "2",
+    "RETRY_DELAY": "1",
+    "BATCH_SIZE": "8",
+    "MAX_WORKERS": "8",
+    "OPENAI_LIMITER_PROCESSES": "1",
+    "CACHE_ENABLED": "False",
+    "DOWNLOAD_CACHE_ENABLED": "False",
+    "SINGLEFLIGHT_MODE": "off"
+}
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": round(cuts[49], 3), "p95": round(cuts[94], 3), "p99": round(cuts[98], 3)}
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in kilobytes on Linux; children are the render processes that have exited
+    return {
+        "process": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "render_children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    }
+
+
+def _counter_totals(metric, *labels: str) -> dict:
+    totals = {}
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name.endswith("_total"):
+                key = "/".join(sample.labels[label] for label in labels)
+                totals[key] = totals.get(key, 0) + int(sample.value)
+    return totals
+
+
+def _histogram_summary(metric, label: str) -> dict:
+    summary = {}
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name.endswith(("_sum", "_count")):
+                entry = summary.setdefault(sample.labels[label], {})
+                entry[sample.name.rsplit("_", 1)[1]] = sample.value
+    return {
+        key: {"calls": int(entry["count"]), "avg_seconds": round(entry["sum"] / entry["count"], 3) if entry["count"] else None}
+        for key, entry in summary.items()
+    }
+
+
+def openai_usage() -> dict:
+    """Tokens by call and kind, and timings of the OpenAI calls and of each extraction mode."""
+    from metrics import OPENAI_TOKENS, OPENAI_REQUEST_SECONDS, EXTRACTION_SECONDS
+
+    return {
+        "tokens": _counter_totals(OPENAI_TOKENS, "call", "kind"),
+        "requests": _histogram_summary(OPENAI_REQUEST_SECONDS, "call"),
+        "extraction": _histogram_summary(EXTRACTION_SECONDS, "mode")
+    }
+
+
+def run_cell(mode: str, index_url: str, clients: int) -> dict:
+    """Runs inside the cell's subprocess, after the environment has been set up."""
+    from batch_processor import create_dict_result
+    from pipeline import pipeline_stats, render_stage
+    from admission import memory_admission
+    from rate_limiter import rate_limiter
+    from app import app
+    from async_engine import async_engine
+
+    latencies = []
+    results = {}
+    start = time.time()
+
+    if mode == "create_dict_result":
+        def on_result(name, result):
+            latencies.append(time.time() - start)
+
+        results = create_dict_result(index_url, on_result=on_result)
+        latency_of = "document"
+    else:
+        endpoint = "/analyze" if mode == "analyze" else "/analyze/asyncio"
+        lock = threading.Lock()
+
+        def client(part: int) -> None:
+            request_start = time.time()
+            response = app.test_client().post(endpoint, json={"paths_url": f"{index_url}?part={part}&parts={clients}"})
+            body = response.get_json() or {}
+            with lock:
+                latencies.append(time.time() - request_start)
+                results.update(body.get("result") or {f"request_{part}": {"error": body.get("error", response.status)}})
+
+        threads = [threading.Thread(target=client, args=(part,)) for part in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latency_of = "request"
+
+    elapsed = time.time() - start
+    succeeded = sum(1 for result in results.values() if "error" not in result)
+    stages = pipeline_stats()
+    # render workers are only counted in RUSAGE_CHILDREN once the pool has shut down
+    render_stage.shutdown()
+
+    return {
+        "documents": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_per_minute": round(succeeded / elapsed * 60, 1) if elapsed else None,
+        "latency_of": latency_of,
+        "latency_seconds": percentiles(sorted(latencies)),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {
+            name: {key: stats[key] for key in ("avg_busy_seconds", "avg_wait_seconds", "utilisation", "peak_queue_depth", "failed")}
+            for name, stats in stages.items() if isinstance(stats, dict)
+        },
+        "bottleneck": stages.get("bottleneck"),
+        "asyncio_engine": async_engine.stats() if mode == "asyncio" else None,
+        "memory": {key: memory_admission.stats()[key] for key in ("peak_reserved_bytes", "held_back")},
+        "limiter": {key: rate_limiter.stats()[key] for key in ("throttled_calls", "waited_seconds", "rate_limited_responses")},
+        "openai": openai_usage(),
+        "seconds_per_document": round(elapsed / len(results), 3) if results else None
+    }
+
+
+def _fake_server_counts(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+
+def _expand_matrix(matrix: dict) -> list[dict]:
+    keys = list(matrix)
+    values = [value if isinstance(value, list) else [value] for value in matrix.values()]
+    return [{key: str(value) for key, value in zip(keys, combination)} for combination in itertools.product(*values)]
+
+
+def _cell_key(cell: dict) -> str:
+    return f"{cell['mode']} {json.dumps(cell['settings'], sort_keys=True)}"
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Return one line per cell whose throughput dropped or p95 latency grew by more than `threshold`."""
+    previous = {_cell_key(cell): cell for cell in baseline["cells"]}
+    regressions = []
+    for cell in current["cells"]:
+        before = previous.get(_cell_key(cell))
+        if before is None or "error" in cell["metrics"] or "error" in before["metrics"]:
+            continue
+        now, then = cell["metrics"], before["metrics"]
+        line = (f"{_cell_key(cell)}: throughput {then['throughput_per_minute']} -> {now['throughput_per_minute']}/min, "
+                f"p95 {then['latency_seconds']['p95']} -> {now['latency_seconds']['p95']}s, "
+                f"rss {then['peak_rss_mb']['process']} -> {now['peak_rss_mb']['process']} MB")
+        print(line)
+        slower = now["throughput_per_minute"] < then["throughput_per_minute"] * (1 - threshold)
+        p95_now, p95_then = now["latency_seconds"]["p95"], then["latency_seconds"]["p95"]
+        if slower or (p95_now and p95_then and p95_now > p95_then * (1 + threshold)):
+            regressions.append(line)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=40)
+    parser.add_argument("--max-pages", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="corpus directory, reused across runs with the same parameters")
+    parser.add_argument("--matrix", default='{"MAX_WORKERS": [4, 8]}', help="JSON object of setting -> value or list of values")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--clients", type=int, default=4, help="concurrent requests for the endpoint modes")
+    parser.add_argument("--latency", type=float, default=1.0, help="fake OpenAI mean latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.01, help="fake OpenAI seconds per completion token")
+    parser.add_argument("--rpm", type=int, default=10000, help="fake OpenAI quota before it answers 429")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--download-latency", type=float, default=0.0)
+    parser.add_argument("--openai-port", type=int, default=8083)
+    parser.add_argument("--documents-port", type=int, default=8084)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--cell", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell:
+        cell = json.loads(args.cell)
+        print(json.dumps(run_cell(cell["mode"], cell["index_url"], cell["clients"])))
+        return
+
+    from fake_openai_server import FakeOpenAIState, serve as serve_openai
+    from document_server import generate_corpus, serve as serve_documents
+
+    corpus = args.corpus or str(Path(tempfile.gettempdir()) / f"e2e_corpus_{args.documents}_{args.max_pages}_{args.seed}")
+    print(f"Generating corpus of {args.documents} documents in {corpus}")
+    files = generate_corpus(corpus, args.documents, args.max_pages, args.seed)
+    serve_documents("127.0.0.1", args.documents_port, corpus, [f["name"] for f in files], args.download_latency)
+    fake_openai = FakeOpenAIState(
+        args.rpm, 10_000_000, args.latency, args.jitter, args.rate_429, args.rate_5xx, args.token_latency
+    )
+    serve_openai("127.0.0.1", args.openai_port, fake_openai)
+    index_url = f"http://127.0.0.1:{args.documents_port}/index.json"
+
+    workdir = Path(tempfile.mkdtemp(prefix="e2e_benchmark_"))
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "corpus": {
+            "documents": len(files),
+            "pages": sum(f["pages"] for f in files),
+            "bytes": sum(f["bytes"] for f in files),
+            "kinds": {kind: sum(1 for f in files if f["kind"] == kind) for kind in {f["kind"] for f in files}}
+        },
+        "fake_openai": {
+            "latency": args.latency, "jitter": args.jitter, "token_latency": args.token_latency, "rpm": args.rpm,
+            "rate_429": args.rate_429, "rate_5xx": args.rate_5xx
+        },
+        "cells": []
+    }
+
+    for settings in _expand_matrix(json.loads(args.matrix)):
+        for mode in args.modes.split(","):
+            env = {
+                **os.environ, **BASE_SETTINGS, **settings,
+                "OPENAI_BASE_URL": f"http://127.0.0.1:{args.openai_port}/v1",
+                "OPENAI_API_KEY": "fake",
+                "OPENAI_RPM": str(args.rpm),
+                "JOB_DB_PATH": str(workdir / "jobs.sqlite3"),
+                "CACHE_PATH": str(workdir / "results.sqlite3"),
+                "DOWNLOAD_CACHE_PATH": str(workdir / "downloads.sqlite3")
+            }
+            cell = {"mode": mode, "index_url": index_url, "clients": args.clients}
+            print(f"Running {mode} with {settings}")
+            # every cell starts with a cold prompt cache, or later cells would hit on the pages of earlier ones
+            with fake_openai.lock:
+                fake_openai.seen_parts.clear()
+            before = _fake_server_counts(args.openai_port)
+            completed = subprocess.run(
+                [sys.executable, __file__, "--cell", json.dumps(cell)], env=env, capture_output=True, text=True
+            )
+            after = _fake_server_counts(args.openai_port)
+
+            try:
+                metrics = json.loads(completed.stdout.strip().splitlines()[-1])
+            except (IndexError, ValueError):
+                metrics = {"error": (completed.stderr or completed.stdout)[-2000:]}
+            metrics["server"] = {outcome: after[outcome] - before.get(outcome, 0) for outcome in after}
+            report["cells"].append({"mode": mode, "settings": settings, "metrics": metrics})
+            if "error" in metrics:
+                print(f"  failed: {metrics['error'][-300:]}")
+            else:
+                print(f"  {metrics['succeeded']}/{metrics['documents']} documents, {metrics['throughput_per_minute']}/min, "
+                      f"{metrics['latency_of']} latency {metrics['latency_seconds']}, peak RSS {metrics['peak_rss_mb']} MB, "
+                      f"bottleneck {metrics['bottleneck']}")
+                print(f"  tokens {metrics['openai']['tokens']}, extraction {metrics['openai']['extraction']}")
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Saved results to {args.output}")
+
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} cells regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compare page encoding policies on sample documents.
+
+For every document and encoding setting this reports the render + encode
+time, the payload size sent to OpenAI and, with --call-openai, the
+end-to-end extraction latency.
+
+    python benchmarks/encoding_benchmark.py scans/*.pdf --call-openai --output bench_output.json
+
+Without documents a synthetic two-page scan is generated. The usual
+environment (.env) must be present because config.py reads it on import.
+"""
+import sys
+import json
+import time
+import argparse
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from config import DPI, MAX_PAGES
+from document_processor import get_document_type, render_document
+from image_encoding import EncodingPolicy
+
+DEFAULT_SETTINGS = [
+    {"format": "PNG"},
+    {"format": "PNG", "grayscale": True},
+    {"format": "JPEG", "quality": 85},
+    {"format": "JPEG", "quality": 60, "max_edge": 1600},
+    {"format": "JPEG", "quality": 75, "grayscale": True, "max_edge": 1600},
+    {"format": "WEBP", "quality": 75},
+    {"format": "WEBP", "quality": 60, "max_edge": 1600, "grayscale": True},
+    {"format": "PNG", "binarize": True, "max_edge": 2000},
+    {"format": "PNG", "byte_budget": 1_500_000},
+]
+
+
+def synthetic_scan(pages: int = 2) -> bytes:
+    """A noisy, slightly blurred text page, closer to a real scan than a clean render."""
+    images = []
+    for page in range(pages):
+        img = Image.effect_noise((1240, 1754), 18).convert("RGB").point(lambda value: 200 + value // 5)
+        draw = ImageDraw.Draw(img)
+        for line in range(60):
+            draw.text((80, 80 + line * 26), f"Pagina {page + 1} rand {line}: hemoglobina 13.2 g/dL (12.0 - 15.5)", fill=(20, 20, 20))
+        images.append(img.filter(ImageFilter.GaussianBlur(0.6)))
+
+    buf = BytesIO()
+    images[0].save(buf, format="PDF", save_all=True, append_images=images[1:], resolution=150)
+    return buf.getvalue()
+
+
+def load_documents(paths: list[str]) -> list[tuple[str, str, bytes]]:
+    if not paths:
+        return [("synthetic_scan.pdf", "pdf", synthetic_scan())]
+
+    documents = []
+    for path in paths:
+        doc_type = get_document_type(path)
+        if doc_type == "unknown":
+            print(f"Skipping unsupported file: {path}")
+            continue
+        documents.append((Path(path).name, doc_type, Path(path).read_bytes()))
+    return documents
+
+
+def run(documents, settings, call_openai: bool, repeat: int) -> list[dict]:
+    if call_openai:
+        from openai_service import call_openai_with_images
+
+    rows = []
+    for name, doc_type, content in documents:
+        for setting in settings:
+            policy = EncodingPolicy.from_dict(setting)
+
+            encode_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data_urls = render_document(doc_type, content, policy)
+                encode_times.append(time.perf_counter() - start)
+
+            row = {
+                "document": name,
+                "setting": policy.fingerprint(),
+                "pages": len(data_urls),
+                "encode_seconds": min(encode_times),
+                "payload_bytes": sum(len(url) for url in data_urls),
+                "openai_seconds": None
+            }
+
+            if call_openai:
+                start = time.perf_counter()
+                result = call_openai_with_images(data_urls)
+                row["openai_seconds"] = time.perf_counter() - start
+                row["openai_error"] = result.get("api_error") or result.get("json_error")
+
+            rows.append(row)
+            print_row(row)
+
+    return rows
+
+
+def print_row(row: dict) -> None:
+    latency = f"{row['openai_seconds']:8.2f}s" if row["openai_seconds"] is not None else "       -"
+    print(
+        f"{row['document'][:28]:<28} {row['setting']:<36} {row['pages']:>3}p "
+        f"{row['encode_seconds']:7.3f}s {row['payload_bytes'] / 1024:10.1f} KiB {latency}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("documents", nargs="*", help="PDF or image files (default: synthetic scan)")
+    parser.add_argument("--settings", help="JSON list of encoding settings (default: built-in matrix)")
+    parser.add_argument("--call-openai", action="store_true", help="also measure the extraction call (costs tokens)")
+    parser.add_argument("--repeat", type=int, default=3, help="encode repetitions, the fastest is reported")
+    parser.add_argument("--output", help="write the rows as JSON to this file")
+    args = parser.parse_args()
+
+    settings = json.loads(args.settings) if args.settings else DEFAULT_SETTINGS
+    documents = load_documents(args.documents)
+
+    print(f"DPI={DPI}, MAX_PAGES={MAX_PAGES}")
+    print(f"{'document':<28} {'setting':<36} {'pg':>4} {'encode':>8} {'payload':>14} {'openai':>9}")
+    rows = run(documents, settings, args.call_openai, max(args.repeat, 1))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({"dpi": DPI, "max_pages": MAX_PAGES, "rows": rows}, indent=2))
+        print(f"Wrote {len(rows)} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+It answers POST /v1/chat/completions with a canned extraction after a
+configurable latency and enforces its own requests-per-minute quota. Over
+quota it answers 429 with Retry-After and x-ratelimit-* headers like the
+real API, and it can inject random 429 and 5xx responses.
+
+The answer holds only the fields the prompt asks for, with the summary as
+long as the prompt requests, and the reported usage follows the prompt:
+about four characters per text token, 1105 tokens per image or 85 with
+"detail": "low", and cached prompt tokens for a repeated prefix of text
+parts once it reaches 1024 tokens, like the provider's prompt cache.
+--token-latency adds generation time per completion token.
+
+    python benchmarks/fake_openai_server.py --port 8081 --rpm 120 --latency 1.5 --jitter 0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 OPENAI_API_KEY=fake python app.py
+"""
+import re
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_EXTRACTION = {
+    "titlu_document": "Scrisoare Medicala",
+    "nume_prenume_pacient": "POPESCU ION",
+    "variabila_booleana_diagnostic_curent": True,
+    "variabila_booleana_analize_medicale": False,
+    "variabila_booleana_examen_hispotatologic": False,
+    "variabila_booleana_interpretari_ale_imagisticii": False,
+    "cod_numeric_personal_cod_unic_asigurare_pacient": "1800101123456",
+    "data_introducere_document": "08.10.2022",
+    "data_rezultat": None,
+    "diagnostic_pacient": "Hipertensiune arteriala",
+    "rezultat_analize_medicale": None,
+    "sumar_document": "Pacient internat pentru evaluare, tratament ajustat, externat ameliorat."
+}
+FIELD_PATTERN = re.compile(r"^- (\w+)$", re.MULTILINE)
+SUMMARY_LENGTH_PATTERN = re.compile(r"(\d+) de caractere")
+IMAGE_TOKENS = 1105
+LOW_DETAIL_IMAGE_TOKENS = 85
+# the provider caches prompt prefixes of at least 1024 tokens, in steps of 128
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+
+class FakeOpenAIState:
+    def __init__(
+        self, rpm: int, tpm: int, latency: float, jitter: float, rate_429: float, rate_5xx: float, token_latency: float = 0.0
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.token_latency = token_latency
+        self.lock = threading.Lock()
+        self.window = []
+        self.seen_parts = set()
+        self.counts = {"ok": 0, "429": 0, "5xx": 0}
+
+    def admit(self) -> tuple[bool, float, int]:
+        """Sliding one-minute window. Returns (admitted, seconds until a slot frees, remaining)."""
+        with self.lock:
+            now = time.monotonic()
+            self.window = [stamp for stamp in self.window if now - stamp < 60]
+            if len(self.window) >= self.rpm:
+                return False, 60 - (now - self.window[0]), 0
+            self.window.append(now)
+            return True, 0.0, self.rpm - len(self.window)
+
+    def count(self, outcome: str) -> None:
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def cached_tokens(self, texts: list[str]) -> int:
+        """Tokens of the leading text parts already sent in an earlier request."""
+        prefix_chars = 0
+        with self.lock:
+            for text in texts:
+                digest = hashlib.sha256(text.encode("utf-8")).digest()
+                if digest not in self.seen_parts:
+                    break
+                prefix_chars += len(text)
+            self.seen_parts.update(hashlib.sha256(text.encode("utf-8")).digest() for text in texts)
+        prefix_tokens = prefix_chars // 4
+        return prefix_tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS if prefix_tokens >= CACHE_MIN_TOKENS else 0
+
+
+def fake_answer(prompt: str) -> dict:
+    """The fields the prompt lists, in its order, with a summary of the requested length."""
+    fields = FIELD_PATTERN.findall(prompt) or list(FAKE_EXTRACTION)
+    answer = {name: FAKE_EXTRACTION.get(name) for name in fields}
+    if "sumar_document" in answer:
+        length = SUMMARY_LENGTH_PATTERN.search(prompt)
+        summary = FAKE_EXTRACTION["sumar_document"]
+        if length:
+            summary = (summary + " ") * (int(length.group(1)) // len(summary) + 1)
+            answer["sumar_document"] = summary[:int(length.group(1))].strip()
+    return answer
+
+
+def make_handler(state: FakeOpenAIState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: dict, headers: dict) -> None:
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with state.lock:
+                    self._send(200, dict(state.counts), {})
+                return
+            self._send(404, {"error": {"message": "not found"}}, {})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            if not self.path.endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}}, {})
+                return
+
+            admitted, reset, remaining = state.admit()
+            limit_headers = {
+                "x-ratelimit-limit-requests": str(state.rpm),
+                "x-ratelimit-remaining-requests": str(remaining),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+                "x-ratelimit-limit-tokens": str(state.tpm),
+                "x-ratelimit-remaining-tokens": str(state.tpm)
+            }
+
+            if not admitted or random.random() < state.rate_429:
+                state.count("429")
+                retry_after = max(reset, 1.0)
+                self._send(429, {
+                    "error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+                }, {**limit_headers, "retry-after": f"{retry_after:.0f}"})
+                return
+
+            time.sleep(max(0.0, random.gauss(state.latency, state.jitter)))
+
+            if random.random() < state.rate_5xx:
+                state.count("5xx")
+                self._send(503, {"error": {"message": "The server is overloaded", "type": "server_error"}}, limit_headers)
+                return
+
+            # leading text parts (system message, instruction, notes) form the prefix the cache can reuse
+            texts, prompt_tokens, in_prefix = [], 0, True
+            for message in request.get("messages", []):
+                parts = message.get("content")
+                if isinstance(parts, str):
+                    parts = [{"type": "text", "text": parts}]
+                for part in parts or []:
+                    if part.get("type") == "image_url":
+                        in_prefix = False
+                        detail = part["image_url"].get("detail")
+                        prompt_tokens += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else IMAGE_TOKENS
+                    else:
+                        if in_prefix:
+                            texts.append(part.get("text", ""))
+                        prompt_tokens += len(part.get("text", "")) // 4
+            cached_tokens = state.cached_tokens(texts)
+
+            prompt = "".join(texts)
+            content = json.dumps(fake_answer(prompt), ensure_ascii=False)
+            completion_tokens = len(content) // 4
+            if state.token_latency:
+                time.sleep(completion_tokens * state.token_latency)
+
+            state.count("ok")
+            self._send(200, {
+                "id": f"chatcmpl-fake-{time.time_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content}
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens}
+                }
+            }, limit_headers)
+
+    return Handler
+
+
+def serve(host: str, port: int, state: FakeOpenAIState) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rpm", type=int, default=60, help="requests per minute before answering 429")
+    parser.add_argument("--tpm", type=int, default=200000, help="tokens per minute reported in headers")
+    parser.add_argument("--latency", type=float, default=1.0, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.3, help="standard deviation of the latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of a random 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="probability of a random 503")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds added per completion token")
+    args = parser.parse_args()
+
+    state = FakeOpenAIState(
+        args.rpm, args.tpm, args.latency, args.jitter, args.rate_429, args.rate_5xx, args.token_latency
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
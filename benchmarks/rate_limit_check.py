@@ -0,0 +1,86 @@
+"""
+Drive the real document path against the fake OpenAI server at a fixed quota.
+
+This starts benchmarks/fake_openai_server.py in-process. It then pushes
+--documents small image documents through process_single_document from
+--threads threads and reports the throughput, the 429s the server sent and
+the time the client-side limiter spent waiting. With the limiter working,
+throughput stays close to --rpm and only a few 429s get through.
+
+    python benchmarks/rate_limit_check.py --rpm 60 --documents 120 --threads 16
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import urllib.request
+import concurrent.futures
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--documents", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--rate-5xx", type=float, default=0.02)
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+
+    from fake_openai_server import FakeOpenAIState, serve
+    serve("127.0.0.1", args.port, FakeOpenAIState(args.rpm, 10_000_000, args.latency, args.latency / 4, 0.0, args.rate_5xx))
+
+    # configure the app for the fake server before config.py is imported
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "fake",
+        "OPENAI_RPM": str(args.rpm),
+        "OPENAI_LIMITER_PROCESSES": "1",
+        "RENDER_PROCESSES": "0",
+        "CACHE_ENABLED": "False"
+    })
+    for name, default in (("MODEL", "fake-model"), ("DPI", "72"), ("MAX_PAGES", "1"), ("REQUEST_TIMEOUT", "30"),
+                          ("OPENAI_TIMEOUT", "60"), ("DOCUMENT_TIMEOUT", "600"), ("MAX_RETRIES", "2"),
+                          ("RETRY_DELAY", "1"), ("BATCH_SIZE", "10"), ("MAX_WORKERS", str(args.threads))):
+        os.environ.setdefault(name, default)
+
+    from PIL import Image
+    from batch_processor import process_single_document
+    from rate_limiter import rate_limiter
+
+    workdir = Path(tempfile.mkdtemp(prefix="rate_limit_check_"))
+    paths = []
+    for index in range(args.documents):
+        path = workdir / f"doc_{index:04d}.png"
+        Image.new("RGB", (200, 200), (255, 255, 255)).save(path)
+        paths.append(str(path))
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = [result for _, result in executor.map(process_single_document, paths)]
+    elapsed = time.time() - start
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{args.port}/stats") as response:
+        server_counts = json.load(response)
+
+    succeeded = sum(1 for result in results if "error" not in result)
+    report = {
+        "documents": args.documents,
+        "succeeded": succeeded,
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_per_minute": round(succeeded / elapsed * 60, 1),
+        "quota_per_minute": args.rpm,
+        "server": server_counts,
+        "limiter": rate_limiter.stats()
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+import argparse
+import contextvars
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+from config import (
+    BULK_BACKEND, BULK_WORK_DIR, BULK_PREPARE_WORKERS, BULK_BATCH_MAX_REQUESTS, BULK_BATCH_MAX_BYTES,
+    BULK_POLL_INTERVAL, BULK_MAX_ATTEMPTS
+)
+from stages import STAGES, StageError, run_stage, render_pages
+from results import merge_chunks, apply_summary, failure_result
+from batch_backend import BACKENDS, make_backend
+from document_processor import get_document_type, load_document_bytes
+from http_client import RETRYABLE_DOWNLOAD_ERRORS
+from openai_service import build_page_content, build_summary_content, batch_request_line, parse_batch_output_line
+from chunking import split_chunks
+from page_filter import PageFilter
+from admission import memory_admission, estimate_document_bytes
+from options import AnalysisOptions
+from cache import result_cache, make_cache_key, is_cacheable
+from pipeline import download_stage
+from utils import fetch_document_links
+from logs import setup_logging, log_context, new_correlation_id
+
+log = logging.getLogger(__name__)
+
+DOCUMENT_SUFFIXES = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+class BulkState:
+    """
+    SQLite checkpoint of a bulk run: every document, every extraction
+    request and every submitted batch with its state. Each step commits
+    before the next one starts, so a run interrupted at any point resumes
+    from the last committed state.
+
+    Documents move pending -> prepared -> done or failed; requests move
+    queued -> submitted -> done, and back to queued when their batch lost
+    them and they have attempts left.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " path TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " cache_key TEXT,"
+                " processing TEXT,"
+                " result TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                " custom_id TEXT PRIMARY KEY,"
+                " path TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " status TEXT NOT NULL,"
+                " batch_id TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_path ON requests (path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_batch ON requests (batch_id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " request_count INTEGER NOT NULL,"
+                " submitted_at REAL NOT NULL,"
+                " finished_at REAL)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_documents(self, paths: list[str]) -> int:
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO documents (path, status, updated_at) VALUES (?, 'pending', ?)",
+                [(path, time.time()) for path in paths]
+            )
+            return conn.total_changes - before
+
+    def documents_with_status(self, status: str) -> list[str]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT path FROM documents WHERE status = ? ORDER BY path", (status,))]
+
+    def mark_prepared(self, path: str, cache_key: str, processing: Dict[str, Any], custom_ids: list[str]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE documents SET status = 'prepared', cache_key = ?, processing = ?, updated_at = ? WHERE path = ?",
+                (cache_key, json.dumps(processing), time.time(), path)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO requests (custom_id, path, kind, position, status) VALUES (?, ?, 'chunk', ?, 'queued')",
+                [(custom_id, path, position) for position, custom_id in enumerate(custom_ids)]
+            )
+
+    def finish_document(self, path: str, result: Dict[str, Any]) -> None:
+        status = "failed" if "error" in result else "done"
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE documents SET status = ?, result = ?, updated_at = ? WHERE path = ?",
+                (status, json.dumps(result, ensure_ascii=False), time.time(), path)
+            )
+
+    def document(self, path: str) -> Dict[str, Any]:
+        with self._connect() as conn:
+            status, cache_key, processing = conn.execute(
+                "SELECT status, cache_key, processing FROM documents WHERE path = ?", (path,)
+            ).fetchone()
+        return {"status": status, "cache_key": cache_key, "processing": json.loads(processing) if processing else {}}
+
+    def add_summary_request(self, path: str, custom_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO requests (custom_id, path, kind, position, status) VALUES (?, ?, 'summary', 0, 'queued')",
+                (custom_id, path)
+            )
+
+    def document_requests(self, path: str) -> list[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT custom_id, kind, status, result FROM requests WHERE path = ? ORDER BY kind, position", (path,)
+            ).fetchall()
+        return [
+            {"custom_id": custom_id, "kind": kind, "status": status, "result": json.loads(result) if result else None}
+            for custom_id, kind, status, result in rows
+        ]
+
+    def queued_requests(self) -> list[str]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT custom_id FROM requests WHERE status = 'queued' ORDER BY path, kind, position")]
+
+    def mark_submitted(self, batch_id: str, custom_ids: list[str]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO batches (id, status, request_count, submitted_at) VALUES (?, 'submitted', ?, ?)",
+                (batch_id, len(custom_ids), time.time())
+            )
+            conn.executemany(
+                "UPDATE requests SET status = 'submitted', batch_id = ?, attempts = attempts + 1 WHERE custom_id = ?",
+                [(batch_id, custom_id) for custom_id in custom_ids]
+            )
+
+    def open_batches(self) -> list[str]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM batches WHERE status = 'submitted' ORDER BY submitted_at")]
+
+    def finish_batch(self, batch_id: str, answers: Dict[str, tuple], error: Optional[str], max_attempts: int) -> list[str]:
+        """Record a finished batch's answers, requeue what it lost and return the affected documents."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT custom_id, path, attempts FROM requests WHERE batch_id = ? AND status = 'submitted'", (batch_id,)
+            ).fetchall()
+            for custom_id, path, attempts in rows:
+                result, retryable = answers.get(custom_id, (None, True))
+                if (result is None or retryable) and attempts < max_attempts:
+                    conn.execute("UPDATE requests SET status = 'queued', batch_id = NULL WHERE custom_id = ?", (custom_id,))
+                    continue
+                if result is None:
+                    result = {"api_error": error or "Request missing from the batch output"}
+                conn.execute(
+                    "UPDATE requests SET status = 'done', result = ? WHERE custom_id = ?",
+                    (json.dumps(result, ensure_ascii=False), custom_id)
+                )
+            conn.execute("UPDATE batches SET status = 'finished', finished_at = ? WHERE id = ?", (time.time(), batch_id))
+        return sorted({path for _, path, _ in rows})
+
+    def finished_documents(self) -> Iterator[tuple[str, Dict[str, Any]]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path, result FROM documents WHERE status IN ('done', 'failed') ORDER BY path").fetchall()
+        for path, result in rows:
+            yield path, json.loads(result)
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM documents GROUP BY status").fetchall())
+            counts["open_batches"] = conn.execute("SELECT COUNT(*) FROM batches WHERE status = 'submitted'").fetchone()[0]
+            counts["queued_requests"] = conn.execute("SELECT COUNT(*) FROM requests WHERE status = 'queued'").fetchone()[0]
+        return counts
+
+
+def _request_id(path: str, suffix: str) -> str:
+    return f"{hashlib.sha1(path.encode('utf-8')).hexdigest()[:20]}-{suffix}"
+
+
+class BulkRun:
+    """
+    One resumable bulk extraction: documents are downloaded and rendered in
+    parallel, their requests written to `work_dir/requests`, grouped into
+    batch input files and submitted through the backend, which is then
+    polled until every document has a result.
+
+    Long documents send one request per chunk; when their partial summaries
+    need condensing, the summary request goes out in a later batch.
+    Documents are filtered on their own, since across thousands of archived
+    documents cross-document duplicates would make results order-dependent.
+    """
+
+    def __init__(self, work_dir: str, backend_name: str, options: AnalysisOptions, poll_interval: int):
+        self.work_dir = Path(work_dir)
+        self.requests_dir = self.work_dir / "requests"
+        self.batches_dir = self.work_dir / "batches"
+        self.requests_dir.mkdir(parents=True, exist_ok=True)
+        self.batches_dir.mkdir(parents=True, exist_ok=True)
+        self.state = BulkState(self.work_dir / "state.sqlite3")
+        self.backend = make_backend(backend_name, work_dir)
+        self.options = options
+        self.poll_interval = poll_interval
+
+    def _write_request(self, custom_id: str, user_content: list[dict]) -> None:
+        request_path = self.requests_dir / f"{custom_id}.json"
+        tmp_path = request_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(batch_request_line(custom_id, user_content), ensure_ascii=False) + "\n", encoding="utf-8")
+        os.replace(tmp_path, request_path)
+
+    def _prepare_document(self, path: str) -> None:
+        document_name = Path(path).name
+        with log_context(document=document_name):
+            self._prepare(path, document_name)
+
+    def _prepare(self, path: str, document_name: str) -> None:
+        attempts = {stage: 0 for stage in STAGES}
+        start_time = time.time()
+        try:
+            doc_type = get_document_type(path)
+            if doc_type not in ("pdf", "image"):
+                raise StageError("input", f"Processing error: Unsupported file type: {path}")
+
+            content = run_stage(
+                document_name, "download", attempts, download_stage.run, load_document_bytes, path,
+                retry_on=RETRYABLE_DOWNLOAD_ERRORS
+            )
+            cache_key = make_cache_key(content, self.options)
+            if result_cache is not None and self.options.use_cache:
+                cached = result_cache.get(cache_key)
+                if cached is not None:
+                    log.info(f"[{document_name}] Cache hit, no request needed")
+                    self.state.finish_document(path, {**cached, "processing": {**cached.get("processing", {}), "cache_hit": True}})
+                    return
+
+            try:
+                estimated_bytes = estimate_document_bytes(doc_type, content, self.options.encoding, self.options.page_limit)
+            except Exception as e:
+                raise StageError("render", f"Processing error: {str(e)}")
+            with memory_admission.reserve(estimated_bytes):
+                pages, extraction_path = run_stage(
+                    document_name, "render", attempts, render_pages, doc_type, content, self.options, retry_on=(BrokenProcessPool,)
+                )
+                pages, skipped_pages = PageFilter("off" if self.options.page_filter == "off" else "document").filter_pages(pages)
+
+                chunks = split_chunks(pages, self.options.chunk_pages)
+                custom_ids = [_request_id(path, str(index)) for index in range(len(chunks))]
+                for custom_id, chunk in zip(custom_ids, chunks):
+                    user_content, _ = build_page_content(chunk, len(pages) if len(chunks) > 1 else None)
+                    self._write_request(custom_id, user_content)
+
+        except StageError as e:
+            self.state.finish_document(path, failure_result(document_name, e, attempts, start_time))
+            return
+
+        processing = {
+            "extraction_path": extraction_path,
+            "text_pages": sum(1 for page in pages if "text" in page),
+            "image_pages": sum(1 for page in pages if "image_url" in page),
+            "chunks": len(chunks),
+            "skipped_pages": skipped_pages,
+            "cache_hit": False,
+            "stage_attempts": attempts
+        }
+        self.state.mark_prepared(path, cache_key, processing, custom_ids)
+        log.info(f"[{document_name}] Prepared {len(custom_ids)} requests in {time.time() - start_time:.2f}s")
+
+    def prepare(self) -> None:
+        pending = self.state.documents_with_status("pending")
+        if not pending:
+            return
+        log.info(f"Preparing {len(pending)} documents with {BULK_PREPARE_WORKERS} workers")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_PREPARE_WORKERS, thread_name_prefix="bulk-prepare") as pool:
+            futures = {pool.submit(contextvars.copy_context().run, self._prepare_document, path): path for path in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # the document stays pending and is prepared again by the next run
+                    log.warning(f"[{Path(futures[future]).name}] Preparation failed, left for the next run - {str(e)}")
+
+    def submit_queued(self) -> None:
+        queued = self.state.queued_requests()
+        group, group_bytes = [], 0
+        for custom_id in queued:
+            size = (self.requests_dir / f"{custom_id}.json").stat().st_size
+            if group and (len(group) >= BULK_BATCH_MAX_REQUESTS or group_bytes + size > BULK_BATCH_MAX_BYTES):
+                self._submit(group)
+                group, group_bytes = [], 0
+            group.append(custom_id)
+            group_bytes += size
+        if group:
+            self._submit(group)
+
+    def _submit(self, custom_ids: list[str]) -> None:
+        input_path = self.batches_dir / f"input-{uuid.uuid4().hex[:12]}.jsonl"
+        with open(input_path, "wb") as input_file:
+            for custom_id in custom_ids:
+                input_file.write((self.requests_dir / f"{custom_id}.json").read_bytes())
+        batch_id = self.backend.submit(input_path)
+        self.state.mark_submitted(batch_id, custom_ids)
+        input_path.unlink()
+        log.info(f"Submitted batch {batch_id} with {len(custom_ids)} requests")
+
+    def poll_batches(self) -> None:
+        for batch_id in self.state.open_batches():
+            status, lines, error = self.backend.poll(batch_id)
+            if status == "running":
+                continue
+
+            answers = {}
+            for line in lines:
+                custom_id, result, retryable = parse_batch_output_line(line)
+                answers[custom_id] = (result, retryable)
+            if error:
+                log.warning(f"Batch {batch_id} {status} with {len(answers)} answers - {error}")
+            else:
+                log.info(f"Batch {batch_id} {status} with {len(answers)} answers")
+            for path in self.state.finish_batch(batch_id, answers, error, BULK_MAX_ATTEMPTS):
+                self._complete_document(path)
+
+    def _complete_document(self, path: str) -> None:
+        with log_context(document=Path(path).name):
+            self._complete(path)
+
+    def _complete(self, path: str) -> None:
+        document = self.state.document(path)
+        if document["status"] != "prepared":
+            return
+        document_requests = self.state.document_requests(path)
+        if any(request["status"] != "done" for request in document_requests):
+            return
+
+        results = [request["result"] for request in document_requests if request["kind"] == "chunk"]
+        if len(results) == 1:
+            result = results[0]
+        else:
+            result, partial_summaries = merge_chunks(results)
+            if partial_summaries:
+                summary = next((request for request in document_requests if request["kind"] == "summary"), None)
+                if summary is None:
+                    custom_id = _request_id(path, "summary")
+                    self._write_request(custom_id, build_summary_content(partial_summaries)[0])
+                    self.state.add_summary_request(path, custom_id)
+                    log.info(f"[{Path(path).name}] Queued a summary of {len(partial_summaries)} partial summaries")
+                    return
+                apply_summary(result, partial_summaries, summary["result"])
+
+        result["processing"] = document["processing"]
+        if result_cache is not None and is_cacheable(result):
+            result_cache.set(document["cache_key"], result)
+        self.state.finish_document(path, result)
+        for request in document_requests:
+            (self.requests_dir / f"{request['custom_id']}.json").unlink(missing_ok=True)
+
+    def run(self, paths: list[str]) -> None:
+        # one correlation id per invocation, so the records of a resumed run can be told apart
+        with log_context(correlation=new_correlation_id()):
+            self._run(paths)
+
+    def _run(self, paths: list[str]) -> None:
+        added = self.state.add_documents(paths)
+        log.info(f"Bulk run in {self.work_dir}: {len(paths)} documents listed, {added} new")
+        self.prepare()
+        # documents whose last answers arrived just before an interruption
+        for path in self.state.documents_with_status("prepared"):
+            self._complete_document(path)
+        while True:
+            self.submit_queued()
+            if not self.state.open_batches():
+                break
+            self.poll_batches()
+            counts = self.state.counts()
+            log.info(f"Progress: {counts}")
+            if counts["open_batches"] and not counts["queued_requests"]:
+                time.sleep(self.poll_interval)
+
+    def export(self, output: str) -> int:
+        """Write every finished document as one JSON line; the file is replaced whole, so re-running never duplicates lines."""
+        output_path = Path(output)
+        tmp_path = output_path.with_name(output_path.name + ".tmp")
+        written = 0
+        with open(tmp_path, "w", encoding="utf-8") as output_file:
+            for path, result in self.state.finished_documents():
+                output_file.write(json.dumps({"document": Path(path).name, "path": path, "result": result}, ensure_ascii=False) + "\n")
+                written += 1
+        os.replace(tmp_path, output_path)
+        return written
+
+
+def list_documents(paths_url: Optional[str], directory: Optional[str]) -> list[str]:
+    if paths_url:
+        return fetch_document_links(paths_url)
+    return sorted(
+        str(path) for path in Path(directory).rglob("*")
+        if path.is_file() and path.suffix.lower() in DOCUMENT_SUFFIXES
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Extract a large document list through a batch backend; run the same command again to resume."
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--paths-url", help="document index, as posted to /analyze")
+    source.add_argument("--directory", help="local directory searched for PDF and image files")
+    parser.add_argument("--output", required=True, help="JSONL file written with one line per finished document")
+    parser.add_argument("--work-dir", default=BULK_WORK_DIR, help="checkpoint database, prepared requests and batch files")
+    parser.add_argument("--backend", choices=BACKENDS, default=BULK_BACKEND)
+    parser.add_argument("--poll-interval", type=int, default=BULK_POLL_INTERVAL, help="seconds between batch status checks")
+    parser.add_argument("--options", default="{}", help="JSON processing options, as in the /analyze request body")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    try:
+        options = AnalysisOptions.from_request(json.loads(args.options))
+    except (TypeError, ValueError) as e:
+        parser.error(f"Invalid options: {str(e)}")
+    if options.extraction != "single":
+        # every document is one prepared request, or one per chunk, so there is no second step to route
+        parser.error("Batch extraction is single-step; pass \"extraction\": \"single\" in --options")
+
+    bulk_run = BulkRun(args.work_dir, args.backend, options, args.poll_interval)
+    try:
+        bulk_run.run(list_documents(args.paths_url, args.directory))
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume")
+        return 130
+    finally:
+        written = bulk_run.export(args.output)
+        print(f"Wrote {written} documents to {args.output}")
+
+    counts = bulk_run.state.counts()
+    print(f"Done: {counts.get('done', 0)} extracted, {counts.get('failed', 0)} failed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+from config import (
+    MODEL, DPI, MAX_PAGES, CACHE_ENABLED, CACHE_PATH, CACHE_MAX_BYTES, CACHE_TTL
+)
+from openai_service import PROMPT_FINGERPRINT
+from options import AnalysisOptions
+from metrics import CACHE_HITS, CACHE_MISSES
+
+
+def make_cache_key(content: bytes, options: AnalysisOptions) -> str:
+    """Build the cache key from the document bytes and every setting that shapes the extraction."""
+    digest = hashlib.sha256()
+    digest.update(content)
+    digest.update(f"|{MODEL}|{DPI}|{MAX_PAGES}|{PROMPT_FINGERPRINT}|{options.fingerprint()}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_cacheable(result: Dict[str, Any]) -> bool:
+    """Only clean extractions are cached; API and JSON failures, including those of single chunks, must be retried next time."""
+    return not any(key in result for key in ("error", "api_error", "json_error", "chunk_errors"))
+
+
+class ResultCache:
+    """
+    Persistent SQLite cache of extraction results.
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    evicted once the stored payloads exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " payload TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_accessed ON results (accessed_at)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # one short-lived connection per call keeps this safe across threads and gunicorn workers
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT payload FROM results WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_MISSES.labels("result").inc()
+                return None
+            conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            CACHE_HITS.labels("result").inc()
+        return json.loads(row[0])
+
+    def set(self, key: str, result: Dict[str, Any]) -> None:
+        payload = json.dumps(result, ensure_ascii=False)
+        size = len(payload.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, payload, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, size, now, now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in conn.execute("SELECT key, size FROM results ORDER BY accessed_at ASC").fetchall():
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock, self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            hits, misses = self.hits, self.misses
+
+        lookups = hits + misses
+        return {
+            "enabled": True,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl
+        }
+
+
+result_cache = ResultCache(CACHE_PATH, CACHE_MAX_BYTES, CACHE_TTL) if CACHE_ENABLED else None
+
+
+def cache_stats() -> Dict[str, Any]:
+    if result_cache is None:
+        return {"enabled": False}
+    return result_cache.stats()
@@ -0,0 +1,84 @@
+from typing import Any, Dict, Optional
+
+BOOLEAN_PREFIX = "variabila_booleana_"
+CONCAT_FIELDS = ("rezultat_analize_medicale",)
+SUMMARY_FIELD = "sumar_document"
+ERROR_KEYS = ("error", "api_error", "json_error")
+
+
+def split_chunks(pages: list[dict], chunk_pages: int) -> list[list[dict]]:
+    """Split the ordered pages into windows of `chunk_pages`; 0 keeps them in one window."""
+    if chunk_pages <= 0 or len(pages) <= chunk_pages:
+        return [pages]
+    return [pages[start:start + chunk_pages] for start in range(0, len(pages), chunk_pages)]
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def _as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+
+def _as_list(value: Any) -> list:
+    if _is_missing(value):
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def merge_chunk_results(results: list[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the partial extractions of a document's chunks, given in page order.
+
+    Identity fields and any other field take the first non-null value, the
+    variabila_booleana_* flags are OR-ed, rezultat_analize_medicale is
+    concatenated and sumar_document keeps the partial summaries under
+    "partial_summaries" for the caller to condense. A chunk whose call failed is reported under
+    "chunk_errors" and contributes nothing else.
+    """
+    merged: Dict[str, Any] = {}
+    partial_summaries = []
+    chunk_errors = []
+
+    for index, result in enumerate(results):
+        error = next((result[key] for key in ERROR_KEYS if key in result), None)
+        if error is not None:
+            chunk_errors.append({"chunk": index, "error": error})
+            continue
+
+        for key, value in result.items():
+            if key == "processing":
+                continue
+            if key == SUMMARY_FIELD:
+                if not _is_missing(value):
+                    partial_summaries.append(value)
+            elif key.startswith(BOOLEAN_PREFIX):
+                merged[key] = merged.get(key, False) or _as_bool(value)
+            elif key in CONCAT_FIELDS:
+                merged[key] = merged.get(key) or []
+                merged[key].extend(_as_list(value))
+            elif _is_missing(merged.get(key)):
+                # identity fields (title, patient, CNP, dates, diagnosis): the first chunk that names them wins
+                merged[key] = value
+
+    for key in CONCAT_FIELDS:
+        if key in merged and not merged[key]:
+            merged[key] = None
+
+    merged[SUMMARY_FIELD] = partial_summaries[0] if len(partial_summaries) == 1 else None
+    if len(partial_summaries) > 1:
+        merged["partial_summaries"] = partial_summaries
+    if chunk_errors:
+        merged["chunk_errors"] = chunk_errors
+    return merged
+
+
+def chunk_page_range(chunk: list[dict]) -> Optional[str]:
+    if not chunk:
+        return None
+    return f"{chunk[0]['page'] + 1}-{chunk[-1]['page'] + 1}"
@@ -20,6 +20,138 @@ RETRY_DELAY = int(os.getenv("RETRY_DELAY"))
 BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
 MAX_WORKERS = int(os.getenv("MAX_WORKERS"))
 
+# OpenAI client-side rate limiting and retry backoff
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+# gunicorn workers sharing the quota; each process gets an equal slice
+OPENAI_LIMITER_PROCESSES = int(os.getenv("OPENAI_LIMITER_PROCESSES", os.getenv("WEB_CONCURRENCY", "1")))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", "1.0"))
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", "60.0"))
+IMAGE_TOKEN_ESTIMATE = int(os.getenv("IMAGE_TOKEN_ESTIMATE", "1105"))
+OPENAI_EXPECTED_OUTPUT_TOKENS = int(os.getenv("OPENAI_EXPECTED_OUTPUT_TOKENS", "1500"))
+# sent as prompt_cache_key (suffixed with the kind of call) to keep requests sharing a prompt prefix on the same cache
+OPENAI_PROMPT_CACHE_KEY = os.getenv("OPENAI_PROMPT_CACHE_KEY", "")
+
+# Sliding-window scheduler: documents in flight per request and across the whole worker process
+REQUEST_WINDOW = int(os.getenv("REQUEST_WINDOW", str(min(BATCH_SIZE, MAX_WORKERS))))
+GLOBAL_MAX_IN_FLIGHT = int(os.getenv("GLOBAL_MAX_IN_FLIGHT", str(MAX_WORKERS * 4)))
+# document run time assumed for estimates until one has been measured; benchmarks/e2e_benchmark.py
+# reports seconds_per_document for a given configuration
+ESTIMATED_DOCUMENT_SECONDS = float(os.getenv("ESTIMATED_DOCUMENT_SECONDS", "15"))
+
+# Pipeline stages: I/O stages run on document threads, rendering runs in a process pool
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", str(MAX_WORKERS * 2)))
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(os.cpu_count() or 1)))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", str(MAX_WORKERS * 2)))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", str(MAX_WORKERS * 2)))
+# pages of one document rendering in parallel ahead of the consumer
+RENDER_LOOKAHEAD = int(os.getenv("RENDER_LOOKAHEAD", str(max(RENDER_PROCESSES, 1))))
+# in-memory cache of encoded pages, per worker process
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# Memory reserved by documents between rendering and the end of their extraction call, per worker process;
+# documents whose estimate does not fit wait before rendering. 0 only tracks the reservations.
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Shared HTTP client for the document index and downloads
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", str(DOWNLOAD_CONCURRENCY)))
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(50 * 1024 * 1024)))
+# downloads larger than this spill from memory to a temporary file
+DOWNLOAD_SPOOL_BYTES = int(os.getenv("DOWNLOAD_SPOOL_BYTES", str(8 * 1024 * 1024)))
+# Stored copies of documents served with ETag / Last-Modified, revalidated instead of re-downloaded.
+# Off by default: the store keeps the full bytes of the medical documents on disk, keyed by URL. A copy
+# is deleted once it has not been used for DOWNLOAD_CACHE_MAX_AGE seconds, or earlier, least recently
+# used first, when the store outgrows DOWNLOAD_CACHE_MAX_BYTES.
+DOWNLOAD_CACHE_ENABLED = os.getenv("DOWNLOAD_CACHE_ENABLED", "False").lower() == "true"
+DOWNLOAD_CACHE_PATH = os.getenv("DOWNLOAD_CACHE_PATH", ".cache/downloads.sqlite3")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+DOWNLOAD_CACHE_MAX_AGE = int(os.getenv("DOWNLOAD_CACHE_MAX_AGE", str(24 * 3600)))
+
+# asyncio engine (POST /analyze/asyncio): documents run as coroutines on one event loop per worker process,
+# so these limits are not tied to thread counts; rendering still goes through the render stage
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "256"))
+ASYNC_REQUEST_WINDOW = int(os.getenv("ASYNC_REQUEST_WINDOW", "64"))
+ASYNC_DOWNLOAD_CONCURRENCY = int(os.getenv("ASYNC_DOWNLOAD_CONCURRENCY", "32"))
+ASYNC_LLM_CONCURRENCY = int(os.getenv("ASYNC_LLM_CONCURRENCY", "64"))
+
+# Offline bulk mode (python bulk.py): extraction requests go through the OpenAI Batch API, or the local
+# "fake" backend, and every document's progress is checkpointed in SQLite under BULK_WORK_DIR
+BULK_BACKEND = os.getenv("BULK_BACKEND", "openai")
+BULK_WORK_DIR = os.getenv("BULK_WORK_DIR", ".cache/bulk")
+BULK_PREPARE_WORKERS = int(os.getenv("BULK_PREPARE_WORKERS", str(MAX_WORKERS)))
+BULK_BATCH_MAX_REQUESTS = int(os.getenv("BULK_BATCH_MAX_REQUESTS", "1000"))
+# the Batch API accepts input files up to 200 MB
+BULK_BATCH_MAX_BYTES = int(os.getenv("BULK_BATCH_MAX_BYTES", str(150 * 1024 * 1024)))
+BULK_POLL_INTERVAL = int(os.getenv("BULK_POLL_INTERVAL", "60"))
+# submissions of a request whose batch failed, expired or answered with a retryable error
+BULK_MAX_ATTEMPTS = int(os.getenv("BULK_MAX_ATTEMPTS", "3"))
+
+# Page image encoding defaults, overridable per request with "encoding": {...}
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "PNG")
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "0"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "False").lower() == "true"
+IMAGE_BINARIZE = os.getenv("IMAGE_BINARIZE", "False").lower() == "true"
+IMAGE_BYTE_BUDGET = int(os.getenv("IMAGE_BYTE_BUDGET", "0"))
+
+# Text-layer fast path for born-digital PDFs
+TEXT_LAYER_ENABLED = os.getenv("TEXT_LAYER_ENABLED", "True").lower() == "true"
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "200"))
+TEXT_LAYER_MIN_ALNUM_RATIO = float(os.getenv("TEXT_LAYER_MIN_ALNUM_RATIO", "0.6"))
+# long edge of the thumbnail sent next to text pages, 0 sends text only
+TEXT_LAYER_THUMBNAIL_EDGE = int(os.getenv("TEXT_LAYER_THUMBNAIL_EDGE", "0"))
+
+# Long documents: pages per extraction call, windows run concurrently and their results are merged.
+# The default 0 truncates at MAX_PAGES in a single call; requests opt in with "chunk_pages".
+CHUNK_PAGES = int(os.getenv("CHUNK_PAGES", "0"))
+# page limit for chunked documents
+CHUNK_MAX_PAGES = int(os.getenv("CHUNK_MAX_PAGES", "100"))
+
+# Blank and near-duplicate page filter: "off", "document" or "request" (also counts pages repeated across the documents
+# of one request; those are still sent with every document they belong to)
+PAGE_FILTER = os.getenv("PAGE_FILTER", "document")
+# "single" asks for every field in one call; "two_step" classifies the document first and asks only for its fields
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "single")
+# share of ink pixels below which a page counts as blank
+BLANK_PAGE_INK_RATIO = float(os.getenv("BLANK_PAGE_INK_RATIO", "0.0001"))
+# near-duplicates: differing bits out of 256 in the page hashes, then the largest grey-level
+# difference between 8x8 pixel cells; the defaults only collapse re-encoded copies of a page
+DUPLICATE_PAGE_MAX_DISTANCE = int(os.getenv("DUPLICATE_PAGE_MAX_DISTANCE", "8"))
+DUPLICATE_PAGE_MAX_DIFF = int(os.getenv("DUPLICATE_PAGE_MAX_DIFF", "2"))
+
+# Coalescing of identical documents and requests in flight: "off", "thread" (within a worker)
+# or "file" (also across gunicorn workers, through lock files in SINGLEFLIGHT_DIR)
+SINGLEFLIGHT_MODE = os.getenv("SINGLEFLIGHT_MODE", "thread")
+SINGLEFLIGHT_DIR = os.getenv("SINGLEFLIGHT_DIR", ".cache/singleflight")
+
+# Extraction result cache
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "True").lower() == "true"
+CACHE_PATH = os.getenv("CACHE_PATH", ".cache/results.sqlite3")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+
+# Background jobs (POST /analyze with "async": true)
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", ".cache/jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# counted over every worker sharing JOB_DB_PATH
+JOB_MAX_PENDING_DOCUMENTS = int(os.getenv("JOB_MAX_PENDING_DOCUMENTS", "500"))
+# a worker refreshes the heartbeat of its jobs every JOB_HEARTBEAT_INTERVAL seconds; a job whose
+# owner has exited or not been heard from in JOB_STALE_AFTER seconds is marked failed
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "60"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(24 * 3600)))
+
+# Streaming results (POST /analyze/stream)
+STREAM_HEARTBEAT_INTERVAL = int(os.getenv("STREAM_HEARTBEAT_INTERVAL", "15"))
+
+# Logging and metrics: LOG_FORMAT is "json" (one object per line) or "text"; under gunicorn,
+# PROMETHEUS_MULTIPROC_DIR holds the metrics of every worker for /metrics (see gunicorn.conf.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
 # Flask Configuration
 # FLASK_PORT = int(os.getenv("PORT", "5000"))
 # FLASK_HOST = os.getenv("HOST", "0.0.0.0")
@@ -1,74 +1,182 @@
-import pypdfium2 as pdfium
+import asyncio
+import logging
 from io import BytesIO
 from pathlib import Path
 from PIL import Image
-from config import DPI, MAX_PAGES
-from utils import img_to_data_url, download_file_from_url
+from config import DPI, MAX_PAGES, TEXT_LAYER_THUMBNAIL_EDGE
+from image_encoding import EncodingPolicy, default_policy, encode_page, per_page_budget
+from page_renderer import iter_document_pages, iter_rendered_pages, extract_page_texts, is_usable_text
+from utils import download_file_from_url
+from http_client import adownload
 
+log = logging.getLogger(__name__)
 
-def pdf_to_data_urls(pdf_source, dpi=None, limit=None):
+
+def pdf_to_data_urls(pdf_source, dpi=None, limit=None, policy: EncodingPolicy | None = None):
     if dpi is None:
         dpi = DPI
     if limit is None:
         limit = MAX_PAGES
-        
-    scale = float(dpi) / 72.0
 
     # Load the document from path or memory
     if isinstance(pdf_source, (str, Path)):
-        pdf = pdfium.PdfDocument(str(pdf_source))
+        content = Path(pdf_source).read_bytes()
     elif isinstance(pdf_source, BytesIO):
-        pdf = pdfium.PdfDocument(pdf_source.getvalue())
+        content = pdf_source.getvalue()
     elif isinstance(pdf_source, (bytes, bytearray)):
-        pdf = pdfium.PdfDocument(pdf_source)
+        content = bytes(pdf_source)
+    elif hasattr(pdf_source, "read"):
+        content = pdf_source.read()
     else:
-        raise TypeError("pdf_source must be a path (str/PathLike), BytesIO, or bytes")
+        raise TypeError("pdf_source must be a path (str/PathLike), BytesIO, a file object, or bytes")
 
-    total_pages = len(pdf)
-    pages_to_render = total_pages if limit is None else min(limit, total_pages)
+    return list(iter_document_pages("pdf", content, policy, dpi=dpi, limit=limit))
 
-    data_urls = []
-    for i in range(pages_to_render):
-        page = pdf[i]
-        bitmap = page.render(scale=scale)
-        pil_img = bitmap.to_pil().convert("RGB")
-        data_urls.append(img_to_data_url(pil_img))
 
-    return data_urls
+def load_document_bytes(path: str) -> bytes:
+    document_name = Path(path).name
 
+    if path.startswith("http"):
+        log.info(f"[{document_name}] Downloading document from URL...")
+        with download_file_from_url(path) as downloaded:
+            return downloaded.read()
+
+    log.info(f"[{document_name}] Reading local document...")
+    return Path(path).read_bytes()
 
-def process_pdf_document(path: str) -> list[str]:
+
+async def aload_document_bytes(path: str) -> bytes:
     document_name = Path(path).name
-    
+
     if path.startswith("http"):
-        print(f"[{document_name}] Downloading PDF from URL...")
-        temp_pdf = download_file_from_url(path)
-        print(f"[{document_name}] PDF downloaded, converting to images...")
-        data_urls = pdf_to_data_urls(temp_pdf, dpi=DPI, limit=MAX_PAGES)
+        log.info(f"[{document_name}] Downloading document from URL...")
+        return await adownload(path)
+
+    log.info(f"[{document_name}] Reading local document...")
+    return await asyncio.to_thread(Path(path).read_bytes)
+
+
+def process_pdf_document(path: str, content: bytes | None = None, policy: EncodingPolicy | None = None) -> list[str]:
+    document_name = Path(path).name
+    
+    if content is not None:
+        log.info(f"[{document_name}] Converting PDF to images...")
+        data_urls = pdf_to_data_urls(content, dpi=DPI, limit=MAX_PAGES, policy=policy)
+    elif path.startswith("http"):
+        log.info(f"[{document_name}] Downloading PDF from URL...")
+        with download_file_from_url(path) as temp_pdf:
+            log.info(f"[{document_name}] PDF downloaded, converting to images...")
+            data_urls = pdf_to_data_urls(temp_pdf, dpi=DPI, limit=MAX_PAGES, policy=policy)
     else:
-        print(f"[{document_name}] Converting local PDF to images...")
-        data_urls = pdf_to_data_urls(str(path), dpi=DPI, limit=MAX_PAGES)
+        log.info(f"[{document_name}] Converting local PDF to images...")
+        data_urls = pdf_to_data_urls(str(path), dpi=DPI, limit=MAX_PAGES, policy=policy)
         
     if not data_urls:
         raise RuntimeError("PDF to image conversion failed or document has no pages.")
     
-    print(f"[{document_name}] Converted to {len(data_urls)} images")
+    log.info(f"[{document_name}] Converted to {len(data_urls)} images")
     return data_urls
 
 
-def process_image_document(path: str) -> str:
+def process_image_document(path: str, content: bytes | None = None, policy: EncodingPolicy | None = None) -> str:
     document_name = Path(path).name
     
-    if path.startswith("http"):
-        print(f"[{document_name}] Downloading image from URL...")
-        img_data = download_file_from_url(path)
-        img = Image.open(img_data).convert("RGB")
+    if content is not None:
+        img = Image.open(BytesIO(content)).convert("RGB")
+    elif path.startswith("http"):
+        log.info(f"[{document_name}] Downloading image from URL...")
+        with download_file_from_url(path) as img_data:
+            img = Image.open(img_data).convert("RGB")
     else:
-        print(f"[{document_name}] Loading local image...")
+        log.info(f"[{document_name}] Loading local image...")
         img = Image.open(path).convert("RGB")
         
-    print(f"[{document_name}] Image loaded")
-    return img_to_data_url(img)
+    log.info(f"[{document_name}] Image loaded")
+    policy = policy or default_policy
+    return encode_page(img, policy, per_page_budget(policy, 1))
+
+
+def render_document(
+    doc_type: str,
+    content: bytes,
+    policy: EncodingPolicy | None = None,
+    executor=None,
+    limit: int = MAX_PAGES,
+    pages_per_request: int | None = None
+) -> list[str]:
+    """Render and encode downloaded bytes into data URLs, in parallel when given the render pool."""
+    data_urls = list(iter_document_pages(
+        doc_type, content, policy, executor=executor, dpi=DPI, limit=limit, pages_per_request=pages_per_request
+    ))
+    if not data_urls:
+        raise RuntimeError("PDF to image conversion failed or document has no pages.")
+    return data_urls
+
+
+def prepare_document_pages(
+    doc_type: str,
+    content: bytes,
+    policy: EncodingPolicy | None = None,
+    use_text_layer: bool = True,
+    executor=None,
+    limit: int = MAX_PAGES,
+    pages_per_request: int | None = None
+) -> tuple[list[dict], str]:
+    """
+    Build the ordered pages sent to OpenAI and report which path was taken.
+
+    Born-digital PDF pages with a usable text layer are sent as
+    {"page", "text"} (plus a small "image_url" thumbnail when
+    TEXT_LAYER_THUMBNAIL_EDGE is set); scanned pages are rendered as
+    {"page", "image_url", "signature"}, the signature being what the page
+    filter needs. The path is "text", "image" or "mixed".
+    """
+    if doc_type != "pdf" or not use_text_layer:
+        rendered = iter_rendered_pages(
+            doc_type, content, policy, executor=executor, dpi=DPI, limit=limit, pages_per_request=pages_per_request
+        )
+        pages = [
+            {"page": index, "image_url": url, "signature": signature}
+            for index, (url, signature) in enumerate(rendered)
+        ]
+        if not pages:
+            raise RuntimeError("PDF to image conversion failed or document has no pages.")
+        return pages, "image"
+
+    if executor is None:
+        texts = extract_page_texts(content, limit)
+    else:
+        texts = executor.submit(extract_page_texts, content, limit).result()
+    if not texts:
+        raise RuntimeError("PDF to image conversion failed or document has no pages.")
+
+    text_indexes = [index for index, text in enumerate(texts) if is_usable_text(text)]
+    pages_with_text = set(text_indexes)
+    scan_indexes = [index for index in range(len(texts)) if index not in pages_with_text]
+    pages = {index: {"page": index, "text": texts[index].strip()} for index in text_indexes}
+
+    if scan_indexes:
+        rendered = iter_rendered_pages(
+            "pdf", content, policy, executor=executor, dpi=DPI, page_indexes=scan_indexes, pages_per_request=pages_per_request
+        )
+        for index, (url, signature) in zip(scan_indexes, rendered):
+            pages[index] = {"page": index, "image_url": url, "signature": signature}
+
+    if text_indexes and TEXT_LAYER_THUMBNAIL_EDGE:
+        thumbnail_policy = EncodingPolicy(format="JPEG", quality=60, max_edge=TEXT_LAYER_THUMBNAIL_EDGE, grayscale=True)
+        thumbnails = iter_document_pages(
+            "pdf", content, thumbnail_policy, executor=executor, dpi=min(DPI, 72), page_indexes=text_indexes
+        )
+        for index, url in zip(text_indexes, thumbnails):
+            pages[index]["image_url"] = url
+
+    if not scan_indexes:
+        path = "text"
+    elif not text_indexes:
+        path = "image"
+    else:
+        path = "mixed"
+    return [pages[index] for index in range(len(texts))], path
 
 
 def get_document_type(path: str) -> str:
@@ -0,0 +1,162 @@
+"""
+Extraction modes. "single" asks for every field in one call. "two_step"
+first decides the document type flags, with a keyword pass over the text
+layer when every page has one or a low-detail call otherwise, then asks
+only for the fields that type needs: the lab results table only for
+analyses, the detailed summary only for discharge letters.
+"""
+import re
+import logging
+import unicodedata
+from typing import Any, Dict, Optional
+
+from openai_service import (
+    INSTRUCTION_HEADER, FIELD_SPECS, SHORT_SUMMARY_SPEC,
+    call_openai_with_pages, acall_openai_with_pages, classify_pages, aclassify_pages
+)
+from chunking import BOOLEAN_PREFIX, ERROR_KEYS, _as_bool
+from metrics import EXTRACTION_SECONDS
+
+log = logging.getLogger(__name__)
+
+EXTRACTION_MODES = ("single", "two_step")
+FLAG_FIELDS = tuple(name for name in FIELD_SPECS if name.startswith(BOOLEAN_PREFIX))
+# asked for whatever the document type
+BASE_FIELDS = (
+    "titlu_document", "nume_prenume_pacient", "cod_numeric_personal_cod_unic_asigurare_pacient",
+    "data_introducere_document", "data_rezultat", "diagnostic_pacient"
+)
+
+# the keyword lists of the flag prompts; lower case words match at a word start
+# ignoring case and diacritics, upper case abbreviations only as whole words
+FLAG_KEYWORDS = {
+    "variabila_booleana_analize_medicale": ("hemoglobina", "hematocrit", "hemoleucograma"),
+    "variabila_booleana_examen_hispotatologic": (
+        "histopatologic", "microscopie", "macroscopie", "imunohistochimi", "biopsi", "oncotype", "IHC", "EHP"
+    ),
+    "variabila_booleana_interpretari_ale_imagisticii": (
+        "ecografi", "explorare ecografica", "substanta de contrast", "rezonanta magnetica", "computer tomograf",
+        "scintigrafi", "coronarografi", "mamografi", "SC", "CT"
+    ),
+}
+TITLE_KEYWORDS = ("scrisoare medicala", "bilet de iesire", "bilet de externare")
+# the title is looked for in the first lines of the first page
+TITLE_LINES = 10
+
+
+def _fold(text: str) -> str:
+    return "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+
+def _keyword_pattern(keywords: tuple) -> re.Pattern:
+    words = [rf"\b{re.escape(keyword)}" for keyword in keywords if not keyword.isupper()]
+    abbreviations = [rf"\b{re.escape(keyword)}\b" for keyword in keywords if keyword.isupper()]
+    parts = []
+    if words:
+        parts.append(f"(?i:{'|'.join(words)})")
+    parts.extend(abbreviations)
+    return re.compile("|".join(parts))
+
+
+_FLAG_PATTERNS = {name: _keyword_pattern(keywords) for name, keywords in FLAG_KEYWORDS.items()}
+_TITLE_PATTERN = _keyword_pattern(TITLE_KEYWORDS)
+
+
+def keyword_flags(pages: list[dict]) -> Optional[Dict[str, bool]]:
+    """
+    The document type flags from the text layer, or None when a page has no
+    text to search. `pages` starts at the first page of the document, where
+    the title is looked for.
+    """
+    if not pages or any(not page.get("text") for page in pages):
+        return None
+
+    text = _fold("\n".join(page["text"] for page in pages))
+    head = "\n".join(_fold(pages[0]["text"]).splitlines()[:TITLE_LINES])
+    flags = {name: bool(pattern.search(text)) for name, pattern in _FLAG_PATTERNS.items()}
+    flags["variabila_booleana_diagnostic_curent"] = bool(_TITLE_PATTERN.search(head))
+    return {name: flags[name] for name in FLAG_FIELDS}
+
+
+def targeted_instruction(flags: Dict[str, bool]) -> str:
+    # a handful of distinct prompts, each a stable prefix the provider can cache
+    fields = list(BASE_FIELDS)
+    if flags["variabila_booleana_analize_medicale"]:
+        fields.append("rezultat_analize_medicale")
+    summary = FIELD_SPECS["sumar_document"] if flags["variabila_booleana_diagnostic_curent"] else SHORT_SUMMARY_SPEC
+    return INSTRUCTION_HEADER + "".join(FIELD_SPECS[name] for name in fields) + summary
+
+
+def _classified_flags(result: dict) -> Optional[Dict[str, bool]]:
+    if any(key in result for key in ERROR_KEYS):
+        return None
+    return {name: _as_bool(result.get(name)) for name in FLAG_FIELDS}
+
+
+def _combine(flags: Dict[str, bool], result: Dict[str, Any]) -> Dict[str, Any]:
+    """The targeted result laid out like a single-call one, with the flags of the first step."""
+    if any(key in result for key in ERROR_KEYS):
+        return result
+    combined = {name: flags[name] if name in flags else result.get(name) for name in FIELD_SPECS}
+    combined.update((key, value) for key, value in result.items() if key not in combined)
+    return combined
+
+
+def classify_document(pages: list[dict]) -> Optional[Dict[str, bool]]:
+    """
+    The document type flags of a whole document, from its text layer or a
+    low-detail call; None when the call failed. A chunked document is
+    classified once and its flags passed to every chunk.
+    """
+    flags = keyword_flags(pages)
+    if flags is None:
+        flags = _classified_flags(classify_pages(pages))
+    if flags is None:
+        log.warning("Classification failed, extracting all fields in one call")
+    return flags
+
+
+async def aclassify_document(pages: list[dict]) -> Optional[Dict[str, bool]]:
+    flags = keyword_flags(pages)
+    if flags is None:
+        flags = _classified_flags(await aclassify_pages(pages))
+    if flags is None:
+        log.warning("Classification failed, extracting all fields in one call")
+    return flags
+
+
+def extract_pages(
+    pages: list[dict], total_pages: Optional[int] = None, mode: str = "single", flags: Optional[Dict[str, bool]] = None
+) -> dict:
+    """
+    Extract the fields of a document, or of one chunk of it, in the given mode.
+
+    A chunk in "two_step" mode takes the `flags` of its document; without
+    them `pages` is taken to be the whole document and classified here.
+
+    Raises:
+        RetryableAPIError: from either call of the two-step mode; a retry
+            starts again from the classification
+    """
+    with EXTRACTION_SECONDS.labels(mode).time():
+        if mode == "two_step" and flags is None:
+            flags = classify_document(pages)
+        if mode == "single" or flags is None:
+            return call_openai_with_pages(pages, total_pages)
+
+        result = call_openai_with_pages(pages, total_pages, targeted_instruction(flags), call="targeted")
+        return _combine(flags, result)
+
+
+async def aextract_pages(
+    pages: list[dict], total_pages: Optional[int] = None, mode: str = "single", flags: Optional[Dict[str, bool]] = None
+) -> dict:
+    """extract_pages on the async client, for the asyncio engine."""
+    with EXTRACTION_SECONDS.labels(mode).time():
+        if mode == "two_step" and flags is None:
+            flags = await aclassify_document(pages)
+        if mode == "single" or flags is None:
+            return await acall_openai_with_pages(pages, total_pages)
+
+        result = await acall_openai_with_pages(pages, total_pages, targeted_instruction(flags), call="targeted")
+        return _combine(flags, result)
@@ -0,0 +1,24 @@
+"""
+Gunicorn reads this file from the working directory. It points the
+Prometheus client of every worker at a shared directory, so /metrics on
+any worker reports the whole server, and keeps that directory in step with
+the workers: emptied when gunicorn starts and cleaned up when a worker exits.
+"""
+import os
+import shutil
+import tempfile
+
+# set in the master before any worker imports prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ocr-webapp-metrics"))
+
+
+def on_starting(server):
+    # samples left by a previous run would be added to this one's counters
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
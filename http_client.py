@@ -0,0 +1,287 @@
+import time
+import asyncio
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, IO, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    REQUEST_TIMEOUT, HTTP_POOL_HOSTS, HTTP_POOL_PER_HOST, MAX_DOWNLOAD_BYTES, DOWNLOAD_SPOOL_BYTES,
+    DOWNLOAD_CACHE_ENABLED, DOWNLOAD_CACHE_PATH, DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_MAX_AGE, ASYNC_DOWNLOAD_CONCURRENCY
+)
+from metrics import CACHE_HITS
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadTooLarge(Exception):
+    """The document is bigger than MAX_DOWNLOAD_BYTES; retrying will not help."""
+
+
+class DownloadRejected(Exception):
+    """The server answered with a client error other than 429, e.g. a missing file; retrying will not help."""
+
+
+# connection errors, timeouts and the 5xx / 429 answers _raise_for_status leaves as HTTP errors
+RETRYABLE_DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.HTTPError
+)
+ARETRYABLE_DOWNLOAD_ERRORS = (
+    httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError, httpx.HTTPStatusError
+)
+
+
+def _raise_for_status(response: Any) -> None:
+    """raise_for_status() for requests and httpx responses, raising DownloadRejected for the errors not worth retrying."""
+    status = response.status_code
+    if 400 <= status < 500 and status != 429:
+        raise DownloadRejected(f"HTTP {status} for {response.url}")
+    response.raise_for_status()
+
+
+def _make_session(pool_block: bool) -> requests.Session:
+    # keep-alive connections shared by all threads; pool_block caps concurrent connections per host
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=pool_block, max_retries=0)
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+session = _make_session(pool_block=True)
+# document indexes are fetched on their own pool: behind the blocking download pool a new request would wait for
+# a connection with no bound, since REQUEST_TIMEOUT only covers connecting and reading
+index_session = _make_session(pool_block=False)
+
+# the asyncio engine's client; waiting for a free connection is not a timeout, the engine bounds downloads itself
+async_session = httpx.AsyncClient(
+    timeout=httpx.Timeout(REQUEST_TIMEOUT, pool=None),
+    limits=httpx.Limits(max_connections=ASYNC_DOWNLOAD_CONCURRENCY, max_keepalive_connections=ASYNC_DOWNLOAD_CONCURRENCY)
+)
+# the index fetches of the asyncio engine, likewise kept out of the download pool; its pool wait is bounded
+async_index_session = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+
+
+class DocumentStore:
+    """
+    SQLite copy of downloaded documents with their ETag / Last-Modified
+    validators, so an unchanged document is revalidated with a conditional
+    request instead of being transferred again. A document unused for
+    `max_age` seconds is no longer served and is deleted on the next write;
+    the least recently used documents are evicted once the stored bytes
+    exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.not_modified = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " url TEXT PRIMARY KEY,"
+                " etag TEXT,"
+                " last_modified TEXT,"
+                " content BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_accessed ON documents (accessed_at)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def validators(self, url: str) -> Dict[str, str]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT etag, last_modified FROM documents WHERE url = ? AND accessed_at >= ?", (url, time.time() - self.max_age)
+            ).fetchone()
+        if row is None:
+            return {}
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def content(self, url: str) -> Optional[bytes]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT content FROM documents WHERE url = ? AND accessed_at >= ?", (url, time.time() - self.max_age)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE documents SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.not_modified += 1
+            CACHE_HITS.labels("download").inc()
+        return bytes(row[0])
+
+    def put(self, url: str, etag: Optional[str], last_modified: Optional[str], content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        with self._lock, self._connect() as conn:
+            self.stored += 1
+            conn.execute("DELETE FROM documents WHERE accessed_at < ?", (time.time() - self.max_age,))
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (url, etag, last_modified, content, size, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, content, len(content), time.time())
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for stored_url, size in conn.execute("SELECT url, size FROM documents ORDER BY accessed_at ASC").fetchall():
+                conn.execute("DELETE FROM documents WHERE url = ?", (stored_url,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock, self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+            return {
+                "enabled": True,
+                "not_modified": self.not_modified,
+                "stored": self.stored,
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age
+            }
+
+
+document_store = (
+    DocumentStore(DOWNLOAD_CACHE_PATH, DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_MAX_AGE) if DOWNLOAD_CACHE_ENABLED else None
+)
+
+
+def get_json(url: str) -> Any:
+    response = index_session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _stream_body(response: requests.Response, spool: IO[bytes]) -> None:
+    declared = response.headers.get("Content-Length")
+    if declared is not None and declared.isdigit() and int(declared) > MAX_DOWNLOAD_BYTES:
+        raise DownloadTooLarge(f"Document is {int(declared)} bytes, limit is {MAX_DOWNLOAD_BYTES}")
+
+    received = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        received += len(chunk)
+        if received > MAX_DOWNLOAD_BYTES:
+            raise DownloadTooLarge(f"Document exceeds the {MAX_DOWNLOAD_BYTES} byte limit")
+        spool.write(chunk)
+
+
+def download(url: str) -> IO[bytes]:
+    """
+    Stream a document into a spooled temporary file, kept in memory up to
+    DOWNLOAD_SPOOL_BYTES and on disk beyond that, and return it rewound.
+
+    Raises DownloadTooLarge past MAX_DOWNLOAD_BYTES and DownloadRejected
+    for a 4xx answer other than 429. A stored copy whose
+    validators still match (304) is returned without transferring the body.
+    """
+    headers = document_store.validators(url) if document_store is not None else {}
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+
+    try:
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True)
+        if response.status_code == 304 and headers:
+            # reading the empty body hands the keep-alive connection back to the pool
+            response.content
+            content = document_store.content(url)
+            if content is not None:
+                spool.write(content)
+                spool.seek(0)
+                return spool
+            # evicted since the validators were read; fetch the body unconditionally
+            response = session.get(url, timeout=REQUEST_TIMEOUT, stream=True)
+
+        with response:
+            _raise_for_status(response)
+            _stream_body(response, spool)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+    except BaseException:
+        spool.close()
+        raise
+
+    if document_store is not None and (etag or last_modified):
+        spool.seek(0)
+        document_store.put(url, etag, last_modified, spool.read())
+
+    spool.seek(0)
+    return spool
+
+
+async def aget_json(url: str) -> Any:
+    response = await async_index_session.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+async def _aread_body(url: str, response: httpx.Response) -> bytes:
+    _raise_for_status(response)
+    declared = response.headers.get("Content-Length")
+    if declared is not None and declared.isdigit() and int(declared) > MAX_DOWNLOAD_BYTES:
+        raise DownloadTooLarge(f"Document is {int(declared)} bytes, limit is {MAX_DOWNLOAD_BYTES}")
+
+    body = bytearray()
+    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+        body.extend(chunk)
+        if len(body) > MAX_DOWNLOAD_BYTES:
+            raise DownloadTooLarge(f"Document exceeds the {MAX_DOWNLOAD_BYTES} byte limit")
+    content = bytes(body)
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if document_store is not None and (etag or last_modified):
+        await asyncio.to_thread(document_store.put, url, etag, last_modified, content)
+    return content
+
+
+async def adownload(url: str) -> bytes:
+    """download() for the asyncio engine, returning the body as bytes; the store is read and written off the loop."""
+    headers = await asyncio.to_thread(document_store.validators, url) if document_store is not None else {}
+
+    if headers:
+        async with async_session.stream("GET", url, headers=headers) as response:
+            if response.status_code != 304:
+                return await _aread_body(url, response)
+        content = await asyncio.to_thread(document_store.content, url)
+        if content is not None:
+            return content
+        # evicted since the validators were read; fetch the body unconditionally
+
+    async with async_session.stream("GET", url) as response:
+        return await _aread_body(url, response)
+
+
+def download_stats() -> Dict[str, Any]:
+    stats = {
+        "pool": {"hosts": HTTP_POOL_HOSTS, "connections_per_host": HTTP_POOL_PER_HOST},
+        "max_download_bytes": MAX_DOWNLOAD_BYTES
+    }
+    stats["store"] = document_store.stats() if document_store is not None else {"enabled": False}
+    return stats
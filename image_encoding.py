@@ -0,0 +1,148 @@
+import base64
+from dataclasses import dataclass, asdict, replace
+from io import BytesIO
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from config import (
+    IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_EDGE, IMAGE_GRAYSCALE, IMAGE_BINARIZE, IMAGE_BYTE_BUDGET
+)
+from metrics import PAGE_ENCODE_SECONDS
+
+FORMATS = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp"
+}
+
+# quality steps tried, in order, when a page does not fit its share of the byte budget
+QUALITY_STEPS = (85, 75, 60, 45, 30)
+MIN_STEP_DOWN_EDGE = 768
+BINARIZE_THRESHOLD = 160
+
+
+@dataclass(frozen=True)
+class EncodingPolicy:
+    """
+    How rendered pages are turned into data URLs for the OpenAI request.
+
+    `byte_budget` caps the base64 payload of one OpenAI request; every page
+    gets an equal share and steps down quality (then size) until it fits.
+    """
+    format: str = "PNG"
+    quality: int = 85
+    max_edge: Optional[int] = None
+    grayscale: bool = False
+    binarize: bool = False
+    byte_budget: Optional[int] = None
+
+    def __post_init__(self):
+        if self.format not in FORMATS:
+            raise ValueError(f"Unsupported image format '{self.format}'. Use one of {', '.join(FORMATS)}.")
+        if not 1 <= self.quality <= 100:
+            raise ValueError("Image quality must be between 1 and 100.")
+        if self.max_edge is not None and self.max_edge < 64:
+            raise ValueError("max_edge must be at least 64 pixels.")
+        if self.byte_budget is not None and self.byte_budget <= 0:
+            raise ValueError("byte_budget must be positive.")
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], base: Optional["EncodingPolicy"] = None) -> "EncodingPolicy":
+        base = base or default_policy
+        unknown = set(data) - set(asdict(base))
+        if unknown:
+            raise ValueError(f"Unknown encoding options: {', '.join(sorted(unknown))}")
+
+        values = dict(data)
+        for key in ("quality", "max_edge", "byte_budget"):
+            if key in values and values[key] is not None:
+                values[key] = int(values[key])
+        for key in ("max_edge", "byte_budget"):
+            if key in values and not values[key]:
+                values[key] = None
+        for key in ("grayscale", "binarize"):
+            if key in values and not isinstance(values[key], bool):
+                raise ValueError(f"'{key}' must be true or false")
+        if "format" in values:
+            values["format"] = str(values["format"]).upper().replace("JPG", "JPEG")
+        return replace(base, **values)
+
+    def fingerprint(self) -> str:
+        return f"{self.format}:{self.quality}:{self.max_edge}:{int(self.grayscale)}:{int(self.binarize)}:{self.byte_budget}"
+
+
+def _policy_from_env() -> EncodingPolicy:
+    return EncodingPolicy(
+        format=IMAGE_FORMAT.upper(),
+        quality=IMAGE_QUALITY,
+        max_edge=IMAGE_MAX_EDGE or None,
+        grayscale=IMAGE_GRAYSCALE,
+        binarize=IMAGE_BINARIZE,
+        byte_budget=IMAGE_BYTE_BUDGET or None
+    )
+
+
+default_policy = _policy_from_env()
+
+
+def prepare_image(img: Image.Image, policy: EncodingPolicy) -> Image.Image:
+    """Apply the size and colour parts of the policy."""
+    if policy.max_edge and max(img.size) > policy.max_edge:
+        img = img.copy()
+        img.thumbnail((policy.max_edge, policy.max_edge), Image.LANCZOS)
+
+    if policy.binarize:
+        return img.convert("L").point(lambda value: 255 if value >= BINARIZE_THRESHOLD else 0)
+    if policy.grayscale:
+        return img.convert("L")
+    return img.convert("RGB") if img.mode not in ("RGB", "L") else img
+
+
+def encode_image(img: Image.Image, policy: EncodingPolicy) -> str:
+    """Encode an already prepared image as a base64 data URL."""
+    buf = BytesIO()
+    if policy.format == "PNG":
+        img.save(buf, format="PNG", optimize=policy.binarize)
+    elif policy.format == "JPEG":
+        img.save(buf, format="JPEG", quality=policy.quality, optimize=True)
+    else:
+        img.save(buf, format="WEBP", quality=policy.quality, method=4)
+
+    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+    return f"data:{FORMATS[policy.format]};base64,{b64}"
+
+
+def _step_down(policy: EncodingPolicy, width: int, height: int) -> Optional[EncodingPolicy]:
+    # lossless PNG has no quality knob, so the first step switches to JPEG
+    if policy.format == "PNG":
+        return replace(policy, format="JPEG", quality=QUALITY_STEPS[0])
+
+    lower = [quality for quality in QUALITY_STEPS if quality < policy.quality]
+    if lower:
+        return replace(policy, quality=lower[0])
+
+    edge = int((policy.max_edge or max(width, height)) * 0.75)
+    if edge >= MIN_STEP_DOWN_EDGE:
+        return replace(policy, max_edge=edge)
+    return None
+
+
+def encode_page(img: Image.Image, policy: EncodingPolicy, page_budget: Optional[int] = None) -> str:
+    """Encode one page, stepping the policy down until the data URL fits `page_budget` bytes."""
+    with PAGE_ENCODE_SECONDS.time():
+        data_url = encode_image(prepare_image(img, policy), policy)
+
+        while page_budget is not None and len(data_url) > page_budget:
+            policy = _step_down(policy, *img.size)
+            if policy is None:
+                break
+            data_url = encode_image(prepare_image(img, policy), policy)
+
+    return data_url
+
+
+def per_page_budget(policy: EncodingPolicy, page_count: int) -> Optional[int]:
+    if policy.byte_budget is None or page_count <= 0:
+        return None
+    return policy.byte_budget // page_count
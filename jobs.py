@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import contextvars
+import concurrent.futures
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+from config import (
+    JOB_DB_PATH, JOB_WORKERS, JOB_MAX_PENDING_DOCUMENTS, JOB_RETENTION, JOB_HEARTBEAT_INTERVAL, JOB_STALE_AFTER
+)
+from batch_processor import create_dict_result
+from options import AnalysisOptions, default_options
+
+log = logging.getLogger(__name__)
+
+
+class CapacityExceeded(Exception):
+    pass
+
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """
+    SQLite-backed job records.
+
+    Jobs run on the gunicorn worker that accepted them, but their progress,
+    partial results and cancel flag live in the database so that any worker
+    can answer GET /jobs/<id> and accept a cancel request. Each job records
+    the pid of its worker and a heartbeat, so a job left behind by a worker
+    that was recycled or killed is marked failed instead of running forever.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " paths_url TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " total INTEGER NOT NULL,"
+                " result_order TEXT,"
+                " error TEXT,"
+                " cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " created_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL,"
+                " owner_pid INTEGER,"
+                " heartbeat_at REAL)"
+            )
+            # databases created before jobs had an owner
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner_pid", "INTEGER"), ("heartbeat_at", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_results ("
+                " job_id TEXT NOT NULL,"
+                " document_name TEXT NOT NULL,"
+                " failed INTEGER NOT NULL,"
+                " result TEXT NOT NULL,"
+                " PRIMARY KEY (job_id, document_name))"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _fail_orphaned(self, conn: sqlite3.Connection, stale_before: float) -> None:
+        rows = conn.execute(
+            "SELECT id, owner_pid, heartbeat_at FROM jobs WHERE status IN ('pending', 'running')"
+        ).fetchall()
+        now = time.time()
+        for job_id, owner_pid, heartbeat_at in rows:
+            if heartbeat_at is not None and heartbeat_at >= stale_before and _process_alive(owner_pid):
+                continue
+            log.warning(f"[job {job_id}] Worker {owner_pid} stopped before the job finished")
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?"
+                " WHERE id = ? AND status IN ('pending', 'running')",
+                (f"Worker {owner_pid} stopped before the job finished", now, job_id)
+            )
+
+    def fail_orphaned(self, stale_before: float) -> None:
+        """Mark failed the unfinished jobs whose worker has exited or has no heartbeat since `stale_before`."""
+        with self._connect() as conn:
+            self._fail_orphaned(conn, stale_before)
+
+    def create(self, job_id: str, paths_url: str, total: int, max_pending_documents: int, stale_before: float) -> None:
+        """
+        Record a pending job owned by this process.
+
+        Raises:
+            CapacityExceeded: the unfinished jobs of all workers already hold
+                `max_pending_documents` documents, or would with this one
+        """
+        with self._connect() as conn:
+            # the count and the insert in one write transaction, so two workers cannot both take the last slots
+            conn.execute("BEGIN IMMEDIATE")
+            self._fail_orphaned(conn, stale_before)
+            pending = conn.execute(
+                "SELECT COALESCE(SUM(total), 0) FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+            if pending + total > max_pending_documents:
+                raise CapacityExceeded(
+                    f"Job queue is full ({pending} documents pending, "
+                    f"limit is {max_pending_documents}). Try again later."
+                )
+            now = time.time()
+            conn.execute(
+                "INSERT INTO jobs (id, paths_url, status, total, created_at, owner_pid, heartbeat_at)"
+                " VALUES (?, ?, 'pending', ?, ?, ?, ?)",
+                (job_id, paths_url, total, now, os.getpid(), now)
+            )
+
+    def heartbeat(self, job_ids: list[str]) -> None:
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+                [(time.time(), job_id) for job_id in job_ids]
+            )
+
+    def mark_running(self, job_id: str) -> bool:
+        """False when the job has already finished, e.g. failed as an orphan while it waited."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+                (time.time(), job_id)
+            )
+            return cursor.rowcount > 0
+
+    def add_result(self, job_id: str, document_name: str, result: Dict[str, Any]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, document_name, failed, result) VALUES (?, ?, ?, ?)",
+                (job_id, document_name, int("error" in result), json.dumps(result, ensure_ascii=False))
+            )
+
+    def finish(self, job_id: str, status: str, result_order: Optional[list[str]] = None, error: Optional[str] = None) -> bool:
+        """False when the job had already finished; its first final status is kept."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result_order = ?, error = ?, finished_at = ?"
+                " WHERE id = ? AND status IN ('pending', 'running')",
+                (status, json.dumps(result_order) if result_order is not None else None, error, time.time(), job_id)
+            )
+            return cursor.rowcount > 0
+
+    def request_cancel(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('pending', 'running')",
+                (job_id,)
+            )
+            return cursor.rowcount > 0
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def get(self, job_id: str, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT paths_url, status, total, result_order, error, cancel_requested, created_at, started_at, finished_at"
+                " FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            results = conn.execute(
+                "SELECT document_name, failed, result FROM job_results WHERE job_id = ?", (job_id,)
+            ).fetchall()
+
+        paths_url, status, total, result_order, error, cancel_requested, created_at, started_at, finished_at = row
+        failed_count = sum(failed for _, failed, _ in results)
+        job = {
+            "job_id": job_id,
+            "paths_url": paths_url,
+            "status": status,
+            "cancel_requested": bool(cancel_requested),
+            "document_count": total,
+            "done": len(results) - failed_count,
+            "failed": failed_count,
+            "pending": max(total - len(results), 0),
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "error": error
+        }
+
+        if include_results:
+            by_name = {name: json.loads(result) for name, _, result in results}
+            # completed jobs keep the date-sorted order of create_dict_result, partial ones arrival order
+            order = json.loads(result_order) if result_order else list(by_name)
+            job["result"] = {name: by_name[name] for name in order if name in by_name}
+
+        return job
+
+    def prune(self, older_than: float) -> None:
+        with self._connect() as conn:
+            expired = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,)
+            )]
+            conn.executemany("DELETE FROM job_results WHERE job_id = ?", [(job_id,) for job_id in expired])
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
+
+
+class JobManager:
+    """
+    Runs create_dict_result for background jobs on a small worker pool.
+
+    The pending document limit is shared by every worker through the store;
+    a heartbeat thread keeps the jobs of this process from being taken for
+    orphans.
+    """
+
+    def __init__(
+        self, store: JobStore, workers: int, max_pending_documents: int, retention: int,
+        heartbeat_interval: int, stale_after: int
+    ):
+        self.store = store
+        self.max_pending_documents = max_pending_documents
+        self.retention = retention
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._active: set[str] = set()
+        self._heartbeat_pid = None
+
+    def _ensure_heartbeat(self) -> None:
+        # started on first use, and again in a forked worker, which does not inherit the thread
+        with self._lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+            self._active.clear()
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                job_ids = list(self._active)
+            if not job_ids:
+                continue
+            try:
+                self.store.heartbeat(job_ids)
+            except sqlite3.Error as e:
+                log.warning(f"Job heartbeat failed: {str(e)}")
+
+    def submit(self, paths_url: str, paths: list[str], options: AnalysisOptions = default_options) -> str:
+        total_documents = len(paths)
+        self._ensure_heartbeat()
+        self.store.prune(time.time() - self.retention)
+
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, paths_url, total_documents, self.max_pending_documents, self._stale_before())
+        with self._lock:
+            self._active.add(job_id)
+        # the job logs under the correlation id of the request that queued it
+        self._executor.submit(contextvars.copy_context().run, self._run, job_id, paths_url, paths, options)
+        log.info(f"[job {job_id}] Queued {total_documents} documents from {paths_url}")
+        return job_id
+
+    def _run(self, job_id: str, paths_url: str, paths: list[str], options: AnalysisOptions) -> None:
+        try:
+            if self.store.is_cancel_requested(job_id):
+                log.info(f"[job {job_id}] Cancelled before start")
+                self.store.finish(job_id, "cancelled")
+                return
+
+            if not self.store.mark_running(job_id):
+                log.warning(f"[job {job_id}] Already finished, not starting")
+                return
+            log.info(f"[job {job_id}] Started")
+
+            result = create_dict_result(
+                paths_url,
+                options=options,
+                on_result=lambda name, res: self.store.add_result(job_id, name, res),
+                should_cancel=lambda: self.store.is_cancel_requested(job_id),
+                paths=paths
+            )
+
+            if self.store.is_cancel_requested(job_id):
+                log.info(f"[job {job_id}] Cancelled with {len(result)} documents processed")
+                self.store.finish(job_id, "cancelled", list(result))
+            else:
+                log.info(f"[job {job_id}] Completed with {len(result)} documents")
+                if not self.store.finish(job_id, "completed", list(result)):
+                    log.warning(f"[job {job_id}] Already marked finished, keeping that status")
+
+        except Exception as e:
+            log.error(f"[job {job_id}] Failed: {str(e)}")
+            self.store.finish(job_id, "failed", error=str(e))
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _stale_before(self) -> float:
+        return time.time() - self.stale_after
+
+    def get(self, job_id: str, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        self.store.fail_orphaned(self._stale_before())
+        return self.store.get(job_id, include_results)
+
+    def cancel(self, job_id: str) -> bool:
+        self.store.fail_orphaned(self._stale_before())
+        return self.store.request_cancel(job_id)
+
+
+job_manager = JobManager(
+    JobStore(JOB_DB_PATH), JOB_WORKERS, JOB_MAX_PENDING_DOCUMENTS, JOB_RETENTION, JOB_HEARTBEAT_INTERVAL, JOB_STALE_AFTER
+)
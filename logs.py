@@ -0,0 +1,142 @@
+"""
+Structured logging. Document threads hand records to a queue and a single
+listener thread writes them to stderr, so logging never blocks on the
+stream. Every record carries the correlation id of the request it belongs
+to and the document being processed, taken from context variables that
+the scheduler, job and stream threads and the asyncio engine carry along.
+"""
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from config import LOG_LEVEL, LOG_FORMAT
+
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+current_document = contextvars.ContextVar("current_document", default=None)
+
+# attributes every LogRecord has; anything else was passed with extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "correlation_id", "document"}
+
+_lock = threading.Lock()
+_listener = None
+_stream = None
+_handler = None
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@contextmanager
+def log_context(correlation: Optional[str] = None, document: Optional[str] = None) -> Iterator[None]:
+    """Tag the records logged inside the block; None keeps the surrounding value."""
+    tokens = []
+    if correlation is not None:
+        tokens.append((correlation_id, correlation_id.set(correlation)))
+    if document is not None:
+        tokens.append((current_document, current_document.set(document)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class _ContextFilter(logging.Filter):
+    # runs on the thread that logged, before the record is queued, while its context variables are current
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        record.document = current_document.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", None),
+            "document": getattr(record, "document", None),
+            "process": record.process,
+            "thread": record.threadName
+        }
+        entry.update({key: value for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(correlation_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.correlation_id = getattr(record, "correlation_id", None) or "-"
+        return super().format(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # the stock handler formats the message into a string here; the listener's formatter needs the record as is
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging() -> None:
+    """Route the root logger through the queue; safe to call more than once, e.g. from every entry point."""
+    global _stream, _handler
+    with _lock:
+        if _listener is not None:
+            return
+
+        _stream = logging.StreamHandler(sys.stderr)
+        _stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+        _handler = _QueueHandler(queue.SimpleQueue())
+        _handler.addFilter(_ContextFilter())
+
+        root = logging.getLogger()
+        root.handlers = [_handler]
+        root.setLevel(LOG_LEVEL)
+
+        _start_listener()
+        # flush what is still queued when the worker exits
+        atexit.register(_stop_listener)
+
+
+def _start_listener() -> None:
+    global _listener
+    records = queue.SimpleQueue()
+    _handler.queue = records
+    _listener = logging.handlers.QueueListener(records, _stream, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener() -> None:
+    # a worker forked from a process that already logged (gunicorn --preload) inherits the listener without
+    # its thread; it gets a listener and queue of its own, and records left in the parent's queue stay there
+    if _listener is not None:
+        _start_listener()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
@@ -0,0 +1,71 @@
+"""
+Prometheus metrics for the document pipeline, served by GET /metrics.
+
+Under gunicorn every worker, and every render process it spawns, writes
+its samples to files in PROMETHEUS_MULTIPROC_DIR and /metrics merges them,
+so any worker can answer the scrape; gunicorn.conf.py sets the directory up.
+Without it the metrics live in this process only, and page encoding done
+in render processes is not counted.
+"""
+from typing import Tuple
+
+# config loads .env, which may set PROMETHEUS_MULTIPROC_DIR; it has to be set before prometheus_client is imported
+from config import PROMETHEUS_MULTIPROC_DIR
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# documents run from well under a second (cache hits) to several minutes (long scans with retries)
+DOCUMENT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+ENCODE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+STAGE_SECONDS = Histogram(
+    "ocr_stage_seconds", "Duration of one attempt at a pipeline stage, including the wait for a stage slot",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+PAGE_ENCODE_SECONDS = Histogram(
+    "ocr_page_encode_seconds", "Time to resize and encode one page image, including re-encodes to fit the budget",
+    buckets=ENCODE_BUCKETS
+)
+OPENAI_REQUEST_SECONDS = Histogram(
+    "ocr_openai_request_seconds", "Duration of one chat completion request, excluding the rate limiter wait",
+    ["call"], buckets=STAGE_BUCKETS
+)
+EXTRACTION_SECONDS = Histogram(
+    "ocr_extraction_seconds", "Time to extract one document or chunk, over all the calls of the extraction mode",
+    ["mode"], buckets=STAGE_BUCKETS
+)
+DOCUMENT_SECONDS = Histogram(
+    "ocr_document_seconds", "Total processing time of a document", ["outcome"], buckets=DOCUMENT_BUCKETS
+)
+
+STAGE_RETRIES = Counter("ocr_stage_retries_total", "Stage attempts after the first", ["stage"])
+DOCUMENT_FAILURES = Counter(
+    "ocr_document_failures_total", "Documents that failed, by failed stage and error class", ["stage", "error_class"]
+)
+OPENAI_ERRORS = Counter("ocr_openai_errors_total", "Failed chat completion requests by status", ["status"])
+OPENAI_TOKENS = Counter(
+    "ocr_openai_tokens_total", "Tokens reported in chat completion usage, by call and kind (prompt, completion, cached_prompt)",
+    ["call", "kind"]
+)
+CACHE_HITS = Counter("ocr_cache_hits_total", "Cache lookups answered from the cache", ["cache"])
+CACHE_MISSES = Counter("ocr_cache_misses_total", "Cache lookups that missed", ["cache"])
+
+# livesum: the values of a worker that exited drop out of the sum
+DOCUMENTS_IN_FLIGHT = Gauge(
+    "ocr_documents_in_flight", "Documents being processed", ["engine"], multiprocess_mode="livesum"
+)
+QUEUE_DEPTH = Gauge(
+    "ocr_queue_depth", "Documents waiting for the scheduler or for a pipeline stage slot", ["queue"],
+    multiprocess_mode="livesum"
+)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Return the exposition payload and its content type, merged across workers in multiprocess mode."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
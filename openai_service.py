@@ -1,82 +1,367 @@
 import json
-from openai import OpenAI
-from config import OPENAI_API_KEY, MODEL, OPENAI_TIMEOUT
+import asyncio
+import hashlib
+from typing import Any, Dict, Optional, Tuple
+from openai import OpenAI, AsyncOpenAI
+from config import (
+    OPENAI_API_KEY, MODEL, OPENAI_TIMEOUT, IMAGE_TOKEN_ESTIMATE, OPENAI_EXPECTED_OUTPUT_TOKENS, OPENAI_PROMPT_CACHE_KEY
+)
+from rate_limiter import rate_limiter, classify_error
+from metrics import OPENAI_REQUEST_SECONDS, OPENAI_ERRORS, OPENAI_TOKENS
 
-client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT)
+# retries are driven by the llm stage with the shared limiter, not by the SDK's own retry loop
+client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=0)
+# used only on the asyncio engine's event loop, which its connections are bound to
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=0)
 
-def call_openai_with_images(image_urls: list[str]) -> dict:
-    """
-    Call OpenAI API with medical document images for data extraction.
-    
-    Args:
-        image_urls: List of base64 data URLs for images
-        
-    Returns:
-        Dictionary with extracted medical document data
-    """
-    if not client:
-        return {"error": "OpenAI client not initialized - check API key configuration"}
-    system_msg = "Ești un extractor de date din documente medicale. Returnează DOAR JSON valid."
 
-    instruction = (
-        "Extrage următoarele câmpuri din imaginea de document medical furnizată. "
-        "Dacă un câmp lipsește, folosește null. Daca anumite cuvinte cheie nu se regasesc, iar in prompt ti se indica sa folosesti anumite valori e.g. `True` sau `False`, foloseste-le. Nu inventa valori.\n\n"
-        
+class RetryableAPIError(Exception):
+    """An OpenAI error worth retrying (rate limit, timeout, 5xx), with the server's Retry-After if any."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+SYSTEM_MSG = "Ești un extractor de date din documente medicale. Returnează DOAR JSON valid."
+
+INSTRUCTION_HEADER = (
+    "Extrage următoarele câmpuri din imaginea de document medical furnizată. "
+    "Dacă un câmp lipsește, folosește null. Daca anumite cuvinte cheie nu se regasesc, iar in prompt ti se indica sa folosesti anumite valori e.g. `True` sau `False`, foloseste-le. Nu inventa valori.\n\n"
+)
+
+# one entry per output field, in the order the single-call prompt lists them
+FIELD_SPECS = {
+    "titlu_document": (
         "- titlu_document\n"
         "Tipurile de titluri pot fi 'Scrisoare Medicala', 'Bilet de iesire din spital', 'Bilet de iesire', 'Bilet de externare'. Inafara de acestea, exista si alte titluri care pot aparea in document si trebuie extrase.\n\n"
-
+    ),
+    "nume_prenume_pacient": (
         "- nume_prenume_pacient\n"
         "Va aprea dupa urmatoarele cuvinte cheie: 'Nume si prenume', poate aparea dupa 'Pacientul'. Intotdeauna este un nume scris cu majuscule.\n\n"
-
+    ),
+    "variabila_booleana_diagnostic_curent": (
         "- variabila_booleana_diagnostic_curent\n"
         "Va returna `True` daca 'titlu_document' contine urmatoarele cuvinte cheie: 'Scrisoare medicala', 'Bilet de iesire din spital', 'Bilet de iesire', 'Bilet de externare'. Altfel, va returna `False`.\n\n"
-
+    ),
+    "variabila_booleana_analize_medicale": (
         "- variabila_booleana_analize_medicale\n"
         "Va returna `True` daca documentul contine urmatoarele cuvinte cheie: 'hemoglobina', 'hematocrit', 'hemoleucograma'. Daca niciun cuvant nu se gaseste explicit in document, va returna `False`.\n\n"
-
+    ),
+    "variabila_booleana_examen_hispotatologic": (
         "- variabila_booleana_examen_hispotatologic\n"
         "Va returna `True` daca documentul contine urmatoarele cuvinte cheie: 'histopatologica', 'histopatologic', 'microscopie', 'macroscopie', 'imunohistochimie', 'biopsie', 'biopsic', 'biopsice', 'OncoType', 'examen imunohistochimic', 'IHC', 'EHP'. Altfel, va returna `False`.\n\n"
-
+    ),
+    "variabila_booleana_interpretari_ale_imagisticii": (
         "- variabila_booleana_interpretari_ale_imagisticii\n"
         "Va returna `True` daca documentul contine urmatoarele cuvinte cheie: 'ecografie', 'explorare ecografica', 'substanta de contrast', 'SC', 'CT', 'rezonanta magnetica', 'computer tomografie', 'computer tomograf', 'PET-CT', 'scintigrafie', 'scintigrafic', 'coronarografie', 'mamografie'. Altfel, va returna `False`.\n\n"
-
+    ),
+    "cod_numeric_personal_cod_unic_asigurare_pacient": (
         "- cod_numeric_personal_cod_unic_asigurare_pacient\n"
         "Codul va aparea dupa urmatoarele cuvinte cheie: 'CNP', 'Cod Numeric Personal' sau 'cod unic de asigurare'.\n\n"
-
+    ),
+    "data_introducere_document": (
         "- data_introducere_document\n"
         "Poate aparea in urmatorele formate: 'dd.mm.yyyy', 'dd/mm/yyyy', 'dd-mm-yyyy'. Poate aparea dupa urmatoarele cuvinte cheie: 'Data inregistrarii', 'Data emiterii', 'Introdus la data', 'data:' sau alte tipuri de expresii. Daca data include ora si minutul, exclude-le si returneaza doar ziua, luna, anul sub format specific anterior.\n\n"
-
-        "- data_rezultat\n\n"
-
+    ),
+    "data_rezultat": "- data_rezultat\n\n",
+    "diagnostic_pacient": (
         "- diagnostic_pacient\n"
         "Diagnosticul va aparea dupa cuvintele cheie: 'Diagnostic', 'Diagnosticul', 'Diagnostificat cu'\n\n"
-
+    ),
+    "rezultat_analize_medicale": (
         "- rezultat_analize_medicale\n"
         "Daca documentul contine urmatoarele cuvinte cheie: 'hemoglobina', 'hematocrit', 'hemoleucograma', extrage toate analizele medicale si valorile lor, in format tabelar, cu urmatoarele coloane: 'nume_analiza', 'valoare_masurata', 'unitate_de_masura', 'interval_de_referinta', 'data_analizei'. Fiecare analiza in parte trebuie sa fie returnata in format JSON. Daca una dintre analize contine mai multe subanalize, subanalizele trebuie incluse in analiza principala sub cheia 'subanaliza'. Daca documentul nu face parte din categoria Analize medicale, adica nu contine cuvintele cheie 'hemoglobina', 'hematocrit' sau 'hemoleucograma', returneaza null pentru acest camp. \n\n"
-
+    ),
+    "sumar_document": (
         "- sumar_document\n"
         "Genereaza un rezumat detaliat al documentului prezentand etapele de investigatie, analizele facute de pacient, starea pacientului, tratamentele care trebuie urmate si diagnosticul. Daca unul din termenii anteriori nu se regaseste in document, nu il mentiona. Rezumatul trebuie sa fie lung de 500 de caractere.\n\n"
     )
+}
+
+INSTRUCTION = INSTRUCTION_HEADER + "".join(FIELD_SPECS.values())
 
-    user_content = [{"type": "text", "text": instruction}]  
-    for url in image_urls:
-        user_content.append({"type": "image_url", "image_url": {"url": url}})
+# first call of the two-step extraction: only the document type flags, from low-detail images or text
+CLASSIFY_INSTRUCTION = (
+    "Clasifica documentul medical furnizat. Returneaza DOAR campurile de mai jos, cu valorile `True` sau `False`. "
+    "Nu extrage alte informatii.\n\n"
+) + "".join(FIELD_SPECS[name] for name in FIELD_SPECS if name.startswith("variabila_booleana_"))
 
+# sumar_document for reports (analyses, imaging, histopathology); discharge letters keep the detailed summary
+SHORT_SUMMARY_SPEC = (
+    "- sumar_document\n"
+    "Genereaza un rezumat scurt al documentului cu rezultatele, constatarile si concluziile lui. "
+    "Nu mentiona informatii care nu apar in document. Rezumatul trebuie sa aiba cel mult 250 de caractere.\n\n"
+)
+
+TEXT_PAGES_NOTE = (
+    "Unele pagini sunt furnizate ca text extras direct din PDF in locul imaginii. "
+    "Trateaza-le la fel ca paginile scanate si extrage campurile din ele.\n\n"
+)
+
+CHUNK_NOTE = (
+    "Paginile furnizate sunt doar paginile {first}-{last} din {total} ale documentului. "
+    "Extrage campurile doar din aceste pagini; pentru campurile care nu apar aici foloseste null. "
+    "In 'sumar_document' rezuma doar aceste pagini.\n\n"
+)
+
+SUMMARY_INSTRUCTION = (
+    "Urmatoarele texte sunt rezumatele partiale, in ordine, ale aceluiasi document medical. "
+    "Combina-le intr-un singur rezumat al documentului prezentand etapele de investigatie, analizele facute de pacient, starea pacientului, tratamentele care trebuie urmate si diagnosticul. "
+    "Nu inventa informatii care nu apar in rezumatele partiale. Rezumatul trebuie sa fie lung de 500 de caractere. "
+    "Returneaza JSON de forma {\"sumar_document\": \"...\"}.\n\n"
+)
+
+# Changes whenever the prompt changes, so cached extractions are not reused across prompt revisions
+PROMPT_FINGERPRINT = hashlib.sha256((
+    SYSTEM_MSG + INSTRUCTION + TEXT_PAGES_NOTE + CHUNK_NOTE + SUMMARY_INSTRUCTION + CLASSIFY_INSTRUCTION + SHORT_SUMMARY_SPEC
+).encode("utf-8")).hexdigest()[:16]
+
+# fixed cost of an image sent with "detail": "low", which the API scales down to 512x512
+LOW_DETAIL_IMAGE_TOKENS = 85
+# four True / False flags
+CLASSIFY_OUTPUT_TOKENS = 100
+
+
+def estimate_tokens(
+    image_count: int,
+    text_chars: int = 0,
+    instruction: str = INSTRUCTION,
+    image_tokens: int = IMAGE_TOKEN_ESTIMATE,
+    output_tokens: int = OPENAI_EXPECTED_OUTPUT_TOKENS
+) -> int:
+    """Rough request cost used to reserve limiter capacity; corrected from the usage once the call returns."""
+    prompt_chars = len(SYSTEM_MSG) + len(instruction) + text_chars
+    return prompt_chars // 3 + image_count * image_tokens + output_tokens
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def _completion_request(user_content: list[dict], call: str = "extract") -> Dict[str, Any]:
+    # the system message and the instruction come first and never change for a kind of call,
+    # so the provider can serve that prefix from its prompt cache
+    request = {
+        "model": MODEL,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role": "system", "content": SYSTEM_MSG},
+            {"role": "user", "content": user_content},
+        ]
+    }
+    if OPENAI_PROMPT_CACHE_KEY:
+        request["prompt_cache_key"] = f"{OPENAI_PROMPT_CACHE_KEY}-{call}"
+    return request
+
+
+def _record_usage(usage: Any, call: str) -> None:
+    if usage is None:
+        return
+    OPENAI_TOKENS.labels(call, "prompt").inc(usage.prompt_tokens or 0)
+    OPENAI_TOKENS.labels(call, "completion").inc(usage.completion_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and details.cached_tokens:
+        OPENAI_TOKENS.labels(call, "cached_prompt").inc(details.cached_tokens)
+
+
+def _parse_completion(raw_resp: Any, estimated_tokens: int, call: str = "extract") -> dict:
+    rate_limiter.update_from_headers(raw_resp.headers)
+    resp = raw_resp.parse()
+    rate_limiter.record_usage(estimated_tokens, resp.usage.total_tokens if resp.usage else None)
+    _record_usage(resp.usage, call)
+
+    raw = resp.choices[0].message.content or "{}"
     try:
-        resp = client.chat.completions.create(
-            model=MODEL,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_content},
-            ]
-        )
-        
-        raw = resp.choices[0].message.content or "{}"
         return json.loads(raw)
-        
     except json.JSONDecodeError as e:
         return {"raw_response": raw, "json_error": str(e)}
+
+
+def batch_request_line(custom_id: str, user_content: list[dict]) -> Dict[str, Any]:
+    """One line of a Batch API input file, carrying the same chat completion as a direct call."""
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": _completion_request(user_content)}
+
+
+def parse_batch_output_line(line: Dict[str, Any]) -> Tuple[str, dict, bool]:
+    """Return (custom_id, result, retryable) for one line of a Batch API output or error file."""
+    custom_id = line.get("custom_id")
+    error = line.get("error")
+    if error:
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        return custom_id, {"api_error": message}, False
+
+    response = line.get("response") or {}
+    status_code = response.get("status_code")
+    body = response.get("body") or {}
+    if status_code != 200:
+        message = (body.get("error") or {}).get("message") if isinstance(body, dict) else None
+        retryable = status_code in (408, 409, 429) or (status_code or 0) >= 500
+        return custom_id, {"api_error": f"HTTP {status_code}: {message or 'request failed'}"}, retryable
+
+    choices = body.get("choices") or [{}]
+    raw = (choices[0].get("message") or {}).get("content") or "{}"
+    try:
+        return custom_id, json.loads(raw), False
+    except json.JSONDecodeError as e:
+        return custom_id, {"raw_response": raw, "json_error": str(e)}, False
+
+
+def _completion_error(e: Exception) -> dict:
+    """Raise RetryableAPIError for errors worth retrying, otherwise return them as the result."""
+    retryable, retry_after = classify_error(e)
+    response = getattr(e, "response", None)
+    if response is not None:
+        rate_limiter.update_from_headers(response.headers)
+    if getattr(e, "status_code", None) == 429 and retryable:
+        rate_limiter.penalize(retry_after)
+    OPENAI_ERRORS.labels(str(getattr(e, "status_code", None) or type(e).__name__)).inc()
+    if retryable:
+        raise RetryableAPIError(str(e), retry_after) from e
+    return {"api_error": str(e)}
+
+
+def _complete_json(user_content: list[dict], estimated_tokens: int, call: str = "extract") -> dict:
+    """Send one JSON-mode chat completion through the shared rate limiter; `call` labels its metrics."""
+    rate_limiter.acquire(estimated_tokens)
+
+    try:
+        with OPENAI_REQUEST_SECONDS.labels(call).time():
+            raw_resp = client.chat.completions.with_raw_response.create(**_completion_request(user_content, call))
+        return _parse_completion(raw_resp, estimated_tokens, call)
+    except Exception as e:
+        return _completion_error(e)
+
+
+async def _acomplete_json(user_content: list[dict], estimated_tokens: int, call: str = "extract") -> dict:
+    """_complete_json for the asyncio engine: waits for the limiter without blocking the event loop."""
+    delay = rate_limiter.reserve(estimated_tokens)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    try:
+        with OPENAI_REQUEST_SECONDS.labels(call).time():
+            raw_resp = await async_client.chat.completions.with_raw_response.create(**_completion_request(user_content, call))
+        return _parse_completion(raw_resp, estimated_tokens, call)
     except Exception as e:
-        return {"api_error": str(e)}
+        return _completion_error(e)
+
+
+def build_page_content(
+    pages: list[dict],
+    total_pages: Optional[int] = None,
+    instruction: str = INSTRUCTION,
+    image_detail: Optional[str] = None,
+    output_tokens: int = OPENAI_EXPECTED_OUTPUT_TOKENS
+) -> Tuple[list[dict], int]:
+    """Return the user message content for the pages and its estimated token cost."""
+    # static parts first, then the chunk note that changes per call, then the pages
+    user_content = [{"type": "text", "text": instruction}]
+    if any("text" in page for page in pages):
+        user_content.append({"type": "text", "text": TEXT_PAGES_NOTE})
+    if total_pages is not None and pages and len(pages) < total_pages:
+        note = CHUNK_NOTE.format(first=pages[0]["page"] + 1, last=pages[-1]["page"] + 1, total=total_pages)
+        user_content.append({"type": "text", "text": note})
+
+    image_count = 0
+    text_chars = 0
+    for page in pages:
+        if "text" in page:
+            text = f"--- Pagina {page.get('page', 0) + 1} (text extras din PDF) ---\n{page['text']}"
+            user_content.append({"type": "text", "text": text})
+            text_chars += len(text)
+        if "image_url" in page:
+            image_url = {"url": page["image_url"]}
+            if image_detail is not None:
+                image_url["detail"] = image_detail
+            user_content.append({"type": "image_url", "image_url": image_url})
+            image_count += 1
+
+    image_tokens = LOW_DETAIL_IMAGE_TOKENS if image_detail == "low" else IMAGE_TOKEN_ESTIMATE
+    return user_content, estimate_tokens(image_count, text_chars, instruction, image_tokens, output_tokens)
+
+
+def build_summary_content(partial_summaries: list[str]) -> Tuple[list[dict], int]:
+    parts = "\n\n".join(f"--- Partea {index + 1} ---\n{summary}" for index, summary in enumerate(partial_summaries))
+    user_content = [{"type": "text", "text": SUMMARY_INSTRUCTION + parts}]
+    return user_content, estimate_tokens(0, len(user_content[0]["text"]))
+
+
+def call_openai_with_pages(
+    pages: list[dict], total_pages: Optional[int] = None, instruction: str = INSTRUCTION, call: str = "extract"
+) -> dict:
+    """
+    Call OpenAI API with the pages of a medical document for data extraction.
+    
+    Args:
+        pages: Pages in document order as built by prepare_document_pages,
+            each with a "text" layer, an "image_url" data URL, or both
+        total_pages: Page count of the whole document when `pages` is only
+            one chunk of it
+        instruction: The field list to extract, INSTRUCTION or a targeted
+            one built by the two-step extraction
+        call: Label of the call in the request and token metrics
+        
+    Returns:
+        Dictionary with extracted medical document data
+
+    Raises:
+        RetryableAPIError: for rate limits, timeouts and server errors; other
+            API errors are returned as {"api_error": ...}
+    """
+    if not client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+
+    return _complete_json(*build_page_content(pages, total_pages, instruction), call=call)
+
+
+async def acall_openai_with_pages(
+    pages: list[dict], total_pages: Optional[int] = None, instruction: str = INSTRUCTION, call: str = "extract"
+) -> dict:
+    """call_openai_with_pages on the async client, for the asyncio engine."""
+    if not async_client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+    return await _acomplete_json(*build_page_content(pages, total_pages, instruction), call=call)
+
+
+def build_classify_content(pages: list[dict]) -> Tuple[list[dict], int]:
+    # low detail: the API downsizes each image to 512x512, enough to tell the document type apart
+    return build_page_content(pages, None, CLASSIFY_INSTRUCTION, image_detail="low", output_tokens=CLASSIFY_OUTPUT_TOKENS)
+
+
+def classify_pages(pages: list[dict]) -> dict:
+    """Return the variabila_booleana_* flags of a whole document from a low-detail call."""
+    if not client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+    return _complete_json(*build_classify_content(pages), call="classify")
+
 
+async def aclassify_pages(pages: list[dict]) -> dict:
+    if not async_client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+    return await _acomplete_json(*build_classify_content(pages), call="classify")
+
+
+def call_openai_with_images(image_urls: list[str]) -> dict:
+    """
+    Call OpenAI API with medical document images for data extraction.
+    
+    Args:
+        image_urls: List of base64 data URLs for images
+        
+    Returns:
+        Dictionary with extracted medical document data
+    """
+    return call_openai_with_pages([{"page": index, "image_url": url} for index, url in enumerate(image_urls)])
+
+
+def summarize_document(partial_summaries: list[str]) -> dict:
+    """Merge the per-chunk summaries of a long document into one 'sumar_document'."""
+    if not client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+
+    return _complete_json(*build_summary_content(partial_summaries), call="summary")
+
+
+async def asummarize_document(partial_summaries: list[str]) -> dict:
+    if not async_client:
+        return {"error": "OpenAI client not initialized - check API key configuration"}
+    return await _acomplete_json(*build_summary_content(partial_summaries), call="summary")
@@ -0,0 +1,64 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict
+
+from config import TEXT_LAYER_ENABLED, MAX_PAGES, CHUNK_PAGES, CHUNK_MAX_PAGES, PAGE_FILTER, EXTRACTION_MODE
+from image_encoding import EncodingPolicy, default_policy
+from page_filter import FILTER_MODES
+from extraction import EXTRACTION_MODES
+
+
+@dataclass(frozen=True)
+class AnalysisOptions:
+    """Per-request processing options, parsed from the /analyze request body."""
+    use_cache: bool = True
+    encoding: EncodingPolicy = field(default_factory=lambda: default_policy)
+    text_layer: bool = TEXT_LAYER_ENABLED
+    chunk_pages: int = CHUNK_PAGES
+    page_filter: str = PAGE_FILTER
+    extraction: str = EXTRACTION_MODE
+
+    @classmethod
+    def from_request(cls, data: Dict[str, Any]) -> "AnalysisOptions":
+        """Raises ValueError for invalid options so the endpoint can answer 400."""
+        encoding = data.get("encoding") or {}
+        if not isinstance(encoding, dict):
+            raise ValueError("'encoding' must be an object")
+
+        text_layer = data.get("text_layer", TEXT_LAYER_ENABLED)
+        if not isinstance(text_layer, bool):
+            raise ValueError("'text_layer' must be true or false")
+
+        chunk_pages = data.get("chunk_pages", CHUNK_PAGES)
+        if isinstance(chunk_pages, bool) or not isinstance(chunk_pages, int) or chunk_pages < 0:
+            raise ValueError("'chunk_pages' must be a non-negative integer")
+
+        page_filter = data.get("page_filter", PAGE_FILTER)
+        if page_filter not in FILTER_MODES:
+            raise ValueError(f"'page_filter' must be one of {', '.join(FILTER_MODES)}")
+
+        extraction = data.get("extraction", EXTRACTION_MODE)
+        if extraction not in EXTRACTION_MODES:
+            raise ValueError(f"'extraction' must be one of {', '.join(EXTRACTION_MODES)}")
+
+        return cls(
+            use_cache=data.get("use_cache", True) is not False,
+            encoding=EncodingPolicy.from_dict(encoding),
+            text_layer=text_layer,
+            chunk_pages=chunk_pages,
+            page_filter=page_filter,
+            extraction=extraction
+        )
+
+    @property
+    def page_limit(self) -> int:
+        """Pages read from a PDF: MAX_PAGES for a single call, CHUNK_MAX_PAGES when chunking."""
+        return max(CHUNK_MAX_PAGES, MAX_PAGES) if self.chunk_pages > 0 else MAX_PAGES
+
+    def fingerprint(self) -> str:
+        """Settings that change the extraction result and therefore belong in the cache key."""
+        # "document" and "request" filtering send the same pages, "request" only counts repeats across documents
+        filtered = int(self.page_filter != "off")
+        return f"{self.encoding.fingerprint()}|text:{int(self.text_layer)}|chunk:{self.chunk_pages}x{self.page_limit}|filter:{filtered}|extract:{self.extraction}"
+
+
+default_options = AnalysisOptions()
@@ -0,0 +1,170 @@
+import zlib
+import uuid
+import hashlib
+import threading
+from typing import Any, Dict, NamedTuple, Optional
+
+from PIL import Image, ImageChops, ImageOps
+
+from config import BLANK_PAGE_INK_RATIO, DUPLICATE_PAGE_MAX_DISTANCE, DUPLICATE_PAGE_MAX_DIFF
+
+FILTER_MODES = ("off", "document", "request")
+HASH_SIZE = 16
+BLANK_SAMPLE_EDGE = 512
+# 8x8 pixel cells: a single changed digit still moves a cell mean well past re-compression noise
+DETAIL_CELL = 8
+
+
+class PageSignature(NamedTuple):
+    """Cheap per-page statistics computed on the rendered image before it is encoded."""
+    blank: bool
+    ink_ratio: float
+    dhash: int
+    detail_size: tuple[int, int]
+    detail: bytes
+
+
+def page_signature(img: Image.Image) -> PageSignature:
+    gray = img.convert("L")
+
+    sample = gray.copy()
+    sample.thumbnail((BLANK_SAMPLE_EDGE, BLANK_SAMPLE_EDGE))
+    # ink is anything clearly darker than the paper, so grey scan backgrounds and speckles do not count
+    histogram = sample.histogram()
+    pixels = sum(histogram)
+    paper = _percentile(histogram, pixels, 0.9)
+    ink = sum(histogram[:max(paper - 64, 0)])
+    ink_ratio = ink / pixels if pixels else 0.0
+
+    small = ImageOps.autocontrast(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR))
+    values = small.tobytes()
+    dhash = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            dhash = (dhash << 1) | (values[offset + col] > values[offset + col + 1])
+
+    detail = gray.resize((max(gray.width // DETAIL_CELL, 1), max(gray.height // DETAIL_CELL, 1)), Image.BOX)
+    return PageSignature(
+        ink_ratio < BLANK_PAGE_INK_RATIO, ink_ratio, dhash, detail.size, zlib.compress(detail.tobytes(), 1)
+    )
+
+
+def _percentile(histogram: list[int], total: int, fraction: float) -> int:
+    seen = 0
+    for value, count in enumerate(histogram):
+        seen += count
+        if seen >= total * fraction:
+            return value
+    return len(histogram) - 1
+
+
+def text_fingerprint(text: str) -> str:
+    return hashlib.sha1(" ".join(text.split()).lower().encode("utf-8")).hexdigest()
+
+
+def _is_near_duplicate(a: PageSignature, b: PageSignature) -> bool:
+    """
+    The perceptual hash only finds candidates: on printed forms pages with
+    different values hash alike, so the cell grids must also match closely.
+    """
+    if (a.dhash ^ b.dhash).bit_count() > DUPLICATE_PAGE_MAX_DISTANCE or a.detail_size != b.detail_size:
+        return False
+    first = Image.frombytes("L", a.detail_size, zlib.decompress(a.detail))
+    second = Image.frombytes("L", b.detail_size, zlib.decompress(b.detail))
+    return ImageChops.difference(first, second).getextrema()[1] <= DUPLICATE_PAGE_MAX_DIFF
+
+
+class PageFilter:
+    """
+    Drops blank pages and collapses near-duplicate pages before the model call.
+
+    One filter is shared by the documents of a request. Pages are only
+    dropped for repeating an earlier page of the same document. The opt-in
+    "request" mode also counts, as cross_document_duplicate, pages already
+    sent with another document of the request, but still sends them: the
+    page may hold this document's title, patient or dates, and which
+    document got it first depends on thread timing.
+    """
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._images = []
+        self._texts = set()
+        self.skipped = {"blank": 0, "duplicate": 0, "cross_document_duplicate": 0}
+        # in "request" mode the skip counts depend on the other documents of the request, so work done
+        # under this filter is only shared within it
+        self.scope = uuid.uuid4().hex if mode == "request" else mode
+
+    def filter_pages(self, pages: list[dict]) -> tuple[list[dict], Dict[str, int]]:
+        """Return the pages to send, without their signatures, and the skip counts for this document."""
+        skipped = {"blank": 0, "duplicate": 0, "cross_document_duplicate": 0}
+        if self.mode == "off":
+            return [_strip(page) for page in pages], skipped
+
+        kept = []
+        own_images = []
+        own_texts = set()
+        for page in pages:
+            signature: Optional[PageSignature] = page.get("signature")
+            if "text" in page:
+                fingerprint = text_fingerprint(page["text"])
+                if fingerprint in own_texts:
+                    skipped["duplicate"] += 1
+                    continue
+                own_texts.add(fingerprint)
+            elif signature is not None:
+                if signature.blank:
+                    skipped["blank"] += 1
+                    continue
+                if any(_is_near_duplicate(signature, other) for other in own_images):
+                    skipped["duplicate"] += 1
+                    continue
+                own_images.append(signature)
+            kept.append(page)
+
+        if not kept:
+            # an all-blank document still gets one call so it yields a result with null fields
+            kept = pages[:1]
+            skipped["blank"] -= 1
+
+        if self.mode == "request":
+            with self._lock:
+                skipped["cross_document_duplicate"] = sum(1 for page in kept if self._seen(page))
+                for page in kept:
+                    self._remember(page)
+
+        with self._lock:
+            for reason, count in skipped.items():
+                self.skipped[reason] += count
+        return [_strip(page) for page in kept], skipped
+
+    def _seen(self, page: dict) -> bool:
+        if "text" in page:
+            return text_fingerprint(page["text"]) in self._texts
+        signature = page.get("signature")
+        return signature is not None and any(_is_near_duplicate(signature, other) for other in self._images)
+
+    def _remember(self, page: dict) -> None:
+        if "text" in page:
+            self._texts.add(text_fingerprint(page["text"]))
+        elif page.get("signature") is not None:
+            self._images.append(page["signature"])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"mode": self.mode, "skipped_pages": dict(self.skipped)}
+
+
+def skipped_page_totals(results: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+    """Sum the per-document skip counts of a request's results."""
+    totals = {"blank": 0, "duplicate": 0, "cross_document_duplicate": 0}
+    for result in results.values():
+        for reason, count in result.get("processing", {}).get("skipped_pages", {}).items():
+            totals[reason] = totals.get(reason, 0) + count
+    return totals
+
+
+def _strip(page: dict) -> dict:
+    return {key: value for key, value in page.items() if key != "signature"}
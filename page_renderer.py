@@ -0,0 +1,262 @@
+import os
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+from collections import OrderedDict, deque
+from io import BytesIO
+from typing import Any, Dict, Iterator, Optional
+
+import pypdfium2 as pdfium
+from PIL import Image
+
+from config import (
+    DPI, MAX_PAGES, PAGE_CACHE_MAX_BYTES, RENDER_LOOKAHEAD, TEXT_LAYER_MIN_CHARS, TEXT_LAYER_MIN_ALNUM_RATIO
+)
+from image_encoding import EncodingPolicy, default_policy, encode_page, per_page_budget
+from page_filter import PageSignature, page_signature
+from metrics import CACHE_HITS, CACHE_MISSES
+
+# documents kept open inside each render process, so consecutive pages skip re-parsing the PDF
+WORKER_DOCUMENT_SLOTS = 4
+_worker_documents = OrderedDict()
+
+
+def _open_pdf(source: str | bytes) -> pdfium.PdfDocument:
+    if isinstance(source, bytes):
+        return pdfium.PdfDocument(source)
+
+    pdf = _worker_documents.get(source)
+    if pdf is None:
+        pdf = pdfium.PdfDocument(source)
+        _worker_documents[source] = pdf
+        while len(_worker_documents) > WORKER_DOCUMENT_SLOTS:
+            _, evicted = _worker_documents.popitem(last=False)
+            evicted.close()
+    else:
+        _worker_documents.move_to_end(source)
+    return pdf
+
+
+def render_pdf_page(
+    source: str | bytes, page_index: int, scale: float, policy: EncodingPolicy, budget: Optional[int]
+) -> tuple[str, PageSignature]:
+    """Render and encode one PDF page. `source` is a file path inside render processes, bytes inline."""
+    pdf = _open_pdf(source)
+    page = pdf[page_index]
+    bitmap = page.render(scale=scale)
+    try:
+        pil_img = bitmap.to_pil().convert("RGB")
+        return encode_page(pil_img, policy, budget), page_signature(pil_img)
+    finally:
+        # drop the full-resolution bitmap before the next page is rendered
+        bitmap.close()
+        page.close()
+        if isinstance(source, bytes):
+            pdf.close()
+
+
+def extract_page_texts(content: bytes, limit: Optional[int]) -> list[str]:
+    """Text layer of the first `limit` pages; empty strings for pages without one (scans)."""
+    pdf = pdfium.PdfDocument(content)
+    try:
+        pages_to_read = len(pdf) if limit is None else min(limit, len(pdf))
+        texts = []
+        for index in range(pages_to_read):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                texts.append(textpage.get_text_range())
+            finally:
+                textpage.close()
+                page.close()
+        return texts
+    finally:
+        pdf.close()
+
+
+def is_usable_text(text: str) -> bool:
+    """A text layer is usable when it has enough characters and most of them are letters or digits."""
+    stripped = "".join(text.split())
+    if len(stripped) < TEXT_LAYER_MIN_CHARS:
+        return False
+    readable = sum(1 for char in stripped if char.isalnum())
+    return readable / len(stripped) >= TEXT_LAYER_MIN_ALNUM_RATIO
+
+
+def render_image(content: bytes, policy: EncodingPolicy, budget: Optional[int]) -> tuple[str, PageSignature]:
+    img = Image.open(BytesIO(content)).convert("RGB")
+    return encode_page(img, policy, budget), page_signature(img)
+
+
+def pdf_page_sizes(content: bytes, limit: Optional[int]) -> list[tuple[float, float]]:
+    """Width and height in points of the first `limit` pages, read without rendering them."""
+    pdf = pdfium.PdfDocument(content)
+    try:
+        pages_to_read = len(pdf) if limit is None else min(limit, len(pdf))
+        return [pdf.get_page_size(index) for index in range(pages_to_read)]
+    finally:
+        pdf.close()
+
+
+def count_pdf_pages(content: bytes) -> int:
+    pdf = pdfium.PdfDocument(content)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+class PageCache:
+    """In-memory LRU of encoded pages and their signatures, bounded by the total size of the data URLs."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[tuple[str, PageSignature]]:
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is None:
+                self.misses += 1
+                CACHE_MISSES.labels("page").inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS.labels("page").inc()
+            return rendered
+
+    def put(self, key: tuple, rendered: tuple[str, PageSignature]) -> None:
+        if _rendered_size(rendered) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= _rendered_size(previous)
+            self._entries[key] = rendered
+            self._size += _rendered_size(rendered)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= _rendered_size(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.max_bytes > 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+
+def _rendered_size(rendered: tuple[str, PageSignature]) -> int:
+    data_url, signature = rendered
+    return len(data_url) + len(signature.detail)
+
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+
+def iter_document_pages(*args: Any, **kwargs: Any) -> Iterator[str]:
+    """Yield only the data URLs of iter_rendered_pages."""
+    for data_url, _ in iter_rendered_pages(*args, **kwargs):
+        yield data_url
+
+
+def iter_rendered_pages(
+    doc_type: str,
+    content: bytes,
+    policy: Optional[EncodingPolicy] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+    dpi: int = DPI,
+    limit: Optional[int] = MAX_PAGES,
+    page_indexes: Optional[list[int]] = None,
+    pages_per_request: Optional[int] = None
+) -> Iterator[tuple[str, PageSignature]]:
+    """
+    Yield (data URL, signature) for the pages of a document in page order,
+    or only for the PDF pages in `page_indexes` when given.
+
+    The byte budget is shared by the pages of one request, so chunked
+    documents pass `pages_per_request` to size it per chunk rather than
+    per document.
+
+    With an executor, up to RENDER_LOOKAHEAD pages render in parallel while
+    the caller consumes the earlier ones; without one, pages render lazily
+    on the calling thread. Pages already in the page cache are not rendered
+    again.
+    """
+    policy = policy or default_policy
+    scale = float(dpi) / 72.0
+    doc_hash = hashlib.sha256(content).hexdigest()
+
+    if doc_type == "image":
+        budget = per_page_budget(policy, 1)
+        key = (doc_hash, 0, None, policy.fingerprint(), budget)
+        rendered = page_cache.get(key)
+        if rendered is None:
+            if executor is None:
+                rendered = render_image(content, policy, budget)
+            else:
+                rendered = executor.submit(render_image, content, policy, budget).result()
+            page_cache.put(key, rendered)
+        yield rendered
+        return
+
+    if page_indexes is None:
+        total_pages = count_pdf_pages(content)
+        page_indexes = list(range(total_pages if limit is None else min(limit, total_pages)))
+    pages_to_render = len(page_indexes)
+    budget = per_page_budget(policy, min(pages_to_render, pages_per_request or pages_to_render))
+    keys = [(doc_hash, index, scale, policy.fingerprint(), budget) for index in page_indexes]
+
+    if executor is None:
+        for index, key in zip(page_indexes, keys):
+            rendered = page_cache.get(key)
+            if rendered is None:
+                rendered = render_pdf_page(content, index, scale, policy, budget)
+                page_cache.put(key, rendered)
+            yield rendered
+        return
+
+    # render processes open the PDF from a file instead of receiving the bytes with every page
+    source = None
+    in_flight = deque()
+    try:
+        next_index = 0
+        while next_index < pages_to_render or in_flight:
+            while next_index < pages_to_render and len(in_flight) < RENDER_LOOKAHEAD:
+                key = keys[next_index]
+                cached = page_cache.get(key)
+                if cached is not None:
+                    in_flight.append((key, cached))
+                else:
+                    if source is None:
+                        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                            tmp.write(content)
+                        source = tmp.name
+                    in_flight.append((key, executor.submit(render_pdf_page, source, page_indexes[next_index], scale, policy, budget)))
+                next_index += 1
+
+            key, pending = in_flight.popleft()
+            if isinstance(pending, tuple):
+                yield pending
+                continue
+
+            rendered = pending.result()
+            page_cache.put(key, rendered)
+            yield rendered
+
+    finally:
+        for _, pending in in_flight:
+            if not isinstance(pending, tuple):
+                pending.cancel()
+        if source is not None:
+            concurrent.futures.wait([pending for _, pending in in_flight if not isinstance(pending, tuple)])
+            os.unlink(source)
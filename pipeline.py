@@ -0,0 +1,157 @@
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from config import (
+    MAX_WORKERS, DOWNLOAD_CONCURRENCY, RENDER_PROCESSES, LLM_CONCURRENCY, STAGE_QUEUE_SIZE
+)
+from metrics import QUEUE_DEPTH
+
+
+class Stage:
+    """
+    One step of the document pipeline with a fixed number of workers and a
+    bounded queue in front of it.
+
+    Document threads carry their work through the stages. A thread waits in
+    the stage queue until a worker slot frees up, and if the queue itself is
+    full it blocks before entering, which pushes back on the previous stage.
+    I/O stages run the work on the calling thread; the render stage hands it
+    to a process pool so pdfium and PNG encoding do not fight over the GIL.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, executor_factory: Optional[Callable[[], concurrent.futures.Executor]] = None):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor_factory = executor_factory
+        self._executor = None
+
+        self._admission = threading.BoundedSemaphore(workers + queue_size)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+        self._blocked = 0
+        self._queued = 0
+        self._active = 0
+        self._peak_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+        self._wait_seconds = 0.0
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.Executor]:
+        """The stage's worker pool, or None when work runs on the calling thread."""
+        if self._executor_factory is None:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._executor_factory()
+            return self._executor
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Wait for a worker slot and account the time spent holding it."""
+        enqueued_at = time.time()
+
+        with self._lock:
+            self._blocked += 1
+        self._admission.acquire()
+        with self._lock:
+            self._blocked -= 1
+            self._queued += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+            QUEUE_DEPTH.labels(self.name).set(self._queued)
+
+        try:
+            self._slots.acquire()
+            started_at = time.time()
+            with self._lock:
+                self._queued -= 1
+                QUEUE_DEPTH.labels(self.name).set(self._queued)
+                self._active += 1
+                self._wait_seconds += started_at - enqueued_at
+
+            try:
+                yield
+            except BrokenProcessPool:
+                # a crashed render process poisons the pool; start a fresh one for the next document
+                with self._lock:
+                    self._failed += 1
+                    self._executor = None
+                raise
+            except BaseException:
+                with self._lock:
+                    self._failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+                    self._busy_seconds += time.time() - started_at
+                self._slots.release()
+
+        finally:
+            self._admission.release()
+
+    def run(self, fn: Callable, *args: Any) -> Any:
+        with self.slot():
+            executor = self.executor
+            if executor is None:
+                return fn(*args)
+            return executor.submit(fn, *args).result()
+
+    def shutdown(self) -> None:
+        """Stop the worker pool, if one was started; the next document starts a fresh one."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.time() - self._started_at, 1e-9)
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self._queued,
+                "peak_queue_depth": self._peak_queued,
+                "blocked_upstream": self._blocked,
+                "active": self._active,
+                "completed": self._completed,
+                "failed": self._failed,
+                "utilisation": self._busy_seconds / (self.workers * elapsed),
+                "avg_busy_seconds": self._busy_seconds / self._completed if self._completed else 0.0,
+                "avg_wait_seconds": self._wait_seconds / self._completed if self._completed else 0.0
+            }
+
+
+def _render_pool() -> concurrent.futures.Executor:
+    # spawn instead of fork: the parent is multi-threaded and forking it can deadlock the children
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+download_stage = Stage("download", DOWNLOAD_CONCURRENCY, STAGE_QUEUE_SIZE)
+if RENDER_PROCESSES > 0:
+    render_stage = Stage("render", RENDER_PROCESSES, STAGE_QUEUE_SIZE, _render_pool)
+else:
+    # RENDER_PROCESSES=0 renders on the document threads, e.g. where worker processes are not allowed
+    render_stage = Stage("render", MAX_WORKERS, STAGE_QUEUE_SIZE)
+llm_stage = Stage("llm", LLM_CONCURRENCY, STAGE_QUEUE_SIZE)
+
+STAGES = (download_stage, render_stage, llm_stage)
+
+
+def pipeline_stats() -> Dict[str, Any]:
+    stats = {stage.name: stage.stats() for stage in STAGES}
+    busiest = max(STAGES, key=lambda stage: stats[stage.name]["utilisation"])
+    stats["bottleneck"] = busiest.name if stats[busiest.name]["completed"] else None
+    return stats
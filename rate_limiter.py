@@ -0,0 +1,201 @@
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import openai
+
+from config import (
+    OPENAI_RPM, OPENAI_TPM, OPENAI_LIMITER_PROCESSES, BACKOFF_BASE, BACKOFF_MAX
+)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as '20ms', '1s' or '6m0s' into seconds."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_SECONDS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Delay before retry number `attempt` (1-based): the server's Retry-After when
+    given, otherwise exponential backoff with jitter so workers do not retry in lockstep.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    ceiling = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(attempt - 1, 0)))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def classify_error(error: Exception) -> Tuple[bool, Optional[float]]:
+    """Return (retryable, retry_after seconds) for an exception raised by the OpenAI client."""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True, None
+
+    if isinstance(error, openai.APIStatusError):
+        retry_after = parse_retry_after(error.response.headers if error.response is not None else None)
+        if isinstance(error, openai.RateLimitError):
+            # an exhausted quota is also a 429 but no amount of waiting fixes it
+            if getattr(error, "code", None) == "insufficient_quota":
+                return False, None
+            return True, retry_after
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return True, retry_after
+        return False, None
+
+    return False, None
+
+
+class TokenBucket:
+    """Thread-safe token bucket that lets callers reserve capacity ahead and tells them how long to wait."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self._tokens = per_minute
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    def resize(self, per_minute: float) -> None:
+        if per_minute > 0 and per_minute != self.capacity:
+            self.capacity = per_minute
+            self.rate = per_minute / 60.0
+            self._tokens = min(self._tokens, per_minute)
+
+    def clamp(self, remaining: float) -> None:
+        self._tokens = min(self._tokens, remaining)
+
+
+class RateLimiter:
+    """
+    Client-side limiter for OpenAI requests and tokens.
+
+    Both limits are split evenly across OPENAI_LIMITER_PROCESSES worker
+    processes. The x-ratelimit-* response headers describe the whole
+    organisation's quota, so every response re-sizes the buckets and clamps
+    them to the remaining share. A 429 pauses all callers in the process
+    until its Retry-After has passed.
+    """
+
+    def __init__(self, rpm: int, tpm: int, processes: int):
+        self.processes = max(processes, 1)
+        self.requests = TokenBucket(rpm / self.processes)
+        self.tokens = TokenBucket(tpm / self.processes)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+        self.waited_seconds = 0.0
+        self.throttled_calls = 0
+        self.rate_limited = 0
+
+    def reserve(self, estimated_tokens: int) -> float:
+        """Take capacity for one request and return how long the caller must wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            delay = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(estimated_tokens, now),
+                self._paused_until - now
+            )
+            if delay > 0:
+                self.throttled_calls += 1
+                self.waited_seconds += delay
+            return max(delay, 0.0)
+
+    def acquire(self, estimated_tokens: int) -> None:
+        delay = self.reserve(estimated_tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is None:
+            return
+        with self._lock:
+            # positive difference gives back over-reserved tokens, negative takes the shortfall
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]) -> None:
+        if not headers:
+            return
+        with self._lock:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    if limit is not None:
+                        bucket.resize(float(limit) / self.processes)
+                    if remaining is not None:
+                        bucket.clamp(float(remaining) / self.processes)
+                except ValueError:
+                    continue
+
+    def penalize(self, retry_after: Optional[float]) -> None:
+        """Pause every caller after a 429, for Retry-After seconds or one backoff step."""
+        pause = retry_after if retry_after is not None else backoff_delay(1)
+        with self._lock:
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "requests_per_minute": self.requests.capacity,
+                "tokens_per_minute": self.tokens.capacity,
+                "throttled_calls": self.throttled_calls,
+                "waited_seconds": self.waited_seconds,
+                "rate_limited_responses": self.rate_limited,
+                "paused_for_seconds": max(self._paused_until - time.monotonic(), 0.0)
+            }
+
+
+rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM, OPENAI_LIMITER_PROCESSES)
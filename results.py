@@ -0,0 +1,114 @@
+"""
+Document results as both engines and the bulk runner report them: merged
+chunk results, success and failure records with their metrics, the
+request-level log lines and the final ordering of a request's results.
+"""
+import time
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from config import (
+    MAX_RETRIES, RETRY_DELAY, DOCUMENT_TIMEOUT, REQUEST_TIMEOUT, OPENAI_TIMEOUT, OPENAI_MAX_RETRIES
+)
+from chunking import merge_chunk_results
+from options import AnalysisOptions
+from cache import result_cache, is_cacheable
+from stages import StageError
+from utils import parse_date
+from metrics import DOCUMENT_SECONDS, DOCUMENT_FAILURES
+
+log = logging.getLogger(__name__)
+
+
+def merge_chunks(results: list[dict]) -> Tuple[dict, Optional[list[str]]]:
+    """Merge the chunk results in page order; also return the partial summaries still to be condensed."""
+    merged = merge_chunk_results(results)
+    if len(merged.get("chunk_errors", [])) == len(results):
+        return results[0], None
+    return merged, merged.pop("partial_summaries", None)
+
+
+def apply_summary(merged: dict, partial_summaries: list[str], summary: dict) -> None:
+    if summary.get("sumar_document"):
+        merged["sumar_document"] = summary["sumar_document"]
+    else:
+        merged["sumar_document"] = " ".join(partial_summaries)
+        error = summary.get("api_error") or summary.get("json_error") or summary.get("error") or "empty summary"
+        merged.setdefault("chunk_errors", []).append({"chunk": "summary", "error": error})
+
+
+def should_cache(result: dict, cache_key: Optional[str]) -> bool:
+    # a bypassed lookup still refreshes the entry with the new extraction
+    return cache_key is not None and is_cacheable(result)
+
+
+def log_start(document_name: str) -> None:
+    log.info(f"[{document_name}] Starting processing...")
+    log.info(f"[{document_name}] Timeouts - Request: {REQUEST_TIMEOUT}s, OpenAI: {OPENAI_TIMEOUT}s, Document: {DOCUMENT_TIMEOUT}s")
+    log.info(f"[{document_name}] Retry configuration - Max retries per stage: {MAX_RETRIES} (OpenAI: {OPENAI_MAX_RETRIES} with backoff), Retry delay: {RETRY_DELAY}s")
+
+
+def failure_result(document_name: str, e: StageError, attempts: Dict[str, int], start_time: float) -> Dict[str, Any]:
+    total_time = time.time() - start_time
+    DOCUMENT_SECONDS.labels("failed").observe(total_time)
+    DOCUMENT_FAILURES.labels(e.stage, e.error_class).inc()
+    log.warning(f"[{document_name}] {e.stage} stage failed after {attempts.get(e.stage, 0)} attempts ({total_time:.2f}s total) - {e.message}")
+    return {
+        "error": e.message,
+        "failed_stage": e.stage,
+        "stage_attempts": attempts,
+        "attempts": attempts.get(e.stage, 0),
+        "final_failure": True
+    }
+
+
+def success_result(
+    document_name: str, result: dict, cache_hit: bool, coalesced: bool, attempts: Dict[str, int], start_time: float
+) -> Dict[str, Any]:
+    total_time = time.time() - start_time
+    DOCUMENT_SECONDS.labels("cache_hit" if cache_hit else "coalesced" if coalesced else "succeeded").observe(total_time)
+    retried = [f"{stage} x{count}" for stage, count in attempts.items() if count > 1]
+    if retried:
+        log.info(f"[{document_name}] Successfully processed in {total_time:.2f}s after retrying {', '.join(retried)}")
+    else:
+        log.info(f"[{document_name}] Successfully processed on first attempt in {total_time:.2f}s")
+
+    result = dict(result)
+    result["processing"] = {
+        **result.get("processing", {}),
+        "cache_hit": cache_hit,
+        "coalesced": coalesced,
+        "stage_attempts": attempts
+    }
+    return result
+
+
+def log_request(total_documents: int, options: AnalysisOptions) -> None:
+    log.info(f"Total documents to process: {total_documents}")
+    log.info(f"Configuration: Request timeout: {REQUEST_TIMEOUT}s, OpenAI timeout: {OPENAI_TIMEOUT}s, Document timeout: {DOCUMENT_TIMEOUT}s")
+    log.info(f"Retry configuration: Max retries: {MAX_RETRIES}, Retry delay: {RETRY_DELAY}s")
+    log.info(f"Result cache: {'enabled' if result_cache is not None else 'disabled'}{'' if options.use_cache else ' (bypassed for this request)'}")
+    log.info(f"Image encoding: {options.encoding.fingerprint()}")
+
+
+def finalize_results(openai_results: Dict[str, Any]) -> Dict[str, Any]:
+    """Sort a request's results newest document first, failures last, and log the totals."""
+    openai_results_sorted = dict(sorted(
+        openai_results.items(),
+        key=lambda item: parse_date(
+            item[1].get("data_introducere_document") or item[1].get("data_rezultat", "")
+        ) if "error" not in item[1] else datetime.min,
+        reverse=True
+    ))
+
+    successful_count = sum(1 for r in openai_results_sorted.values() if "error" not in r)
+    failed_count = len(openai_results_sorted) - successful_count
+    retry_failures = sum(1 for r in openai_results_sorted.values() if r.get("final_failure", False))
+
+    log.info(f"Processing complete! Total results: {len(openai_results_sorted)}")
+    log.info(f"Successful: {successful_count}, Failed: {failed_count}")
+    if retry_failures > 0:
+        log.warning(f"Failed after all retries: {retry_failures}")
+
+    return openai_results_sorted
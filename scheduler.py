@@ -0,0 +1,157 @@
+import time
+import threading
+import contextvars
+import concurrent.futures
+from collections import deque
+from typing import Any, Callable, Dict
+
+from config import GLOBAL_MAX_IN_FLIGHT, REQUEST_WINDOW, ESTIMATED_DOCUMENT_SECONDS
+from metrics import DOCUMENTS_IN_FLIGHT, QUEUE_DEPTH
+
+# weight of the latest document in the moving average of document run times
+DOCUMENT_SECONDS_SMOOTHING = 0.1
+
+
+class RequestTicket:
+    """Per-request queue of documents waiting for a slot in the shared scheduler."""
+
+    def __init__(self, scheduler: "DocumentScheduler", name: str, window: int):
+        self.scheduler = scheduler
+        self.name = name
+        self.window = window
+        self.pending = deque()
+        self.in_flight = 0
+
+    def submit(self, fn: Callable, *args: Any) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        # the document runs with the submitter's context variables, e.g. the correlation id of its request
+        context = contextvars.copy_context()
+        with self.scheduler._lock:
+            self.pending.append((future, context.run, (fn, *args)))
+            self.scheduler._activate(self)
+            self.scheduler._dispatch()
+        return future
+
+    def cancel_pending(self) -> int:
+        with self.scheduler._lock:
+            cancelled = 0
+            while self.pending:
+                future, _, _ = self.pending.popleft()
+                if future.cancel():
+                    cancelled += 1
+            self.scheduler._publish()
+            return cancelled
+
+    def close(self) -> None:
+        self.cancel_pending()
+        with self.scheduler._lock:
+            self.scheduler._tickets.discard(self)
+
+
+class DocumentScheduler:
+    """
+    Sliding-window scheduler shared by every request in the process.
+
+    A single long-lived executor runs at most `max_in_flight` documents in
+    total. Each request keeps up to its own window in flight and refills a
+    slot as soon as one of its documents completes. Free slots are handed
+    to requests round-robin so a large request cannot starve the others.
+    """
+
+    def __init__(self, max_in_flight: int, default_window: int):
+        self.max_in_flight = max_in_flight
+        self.default_window = default_window
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="document"
+        )
+        self._lock = threading.Lock()
+        self._active = deque()
+        self._tickets = set()
+        self._in_flight = 0
+        self._completed = 0
+        self._document_seconds = None
+
+    def open_request(self, name: str, window: int | None = None) -> RequestTicket:
+        ticket = RequestTicket(self, name, min(window or self.default_window, self.max_in_flight))
+        with self._lock:
+            self._tickets.add(ticket)
+        return ticket
+
+    def _activate(self, ticket: RequestTicket) -> None:
+        if ticket not in self._active:
+            self._active.append(ticket)
+
+    def _dispatch(self) -> None:
+        # caller holds self._lock
+        while self._in_flight < self.max_in_flight and self._active:
+            ticket = self._active.popleft()
+            if not ticket.pending:
+                continue
+            if ticket.in_flight >= ticket.window:
+                # re-activated by _on_done when one of its documents finishes
+                continue
+
+            future, fn, args = ticket.pending.popleft()
+            if ticket.pending:
+                self._active.append(ticket)
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            ticket.in_flight += 1
+            self._in_flight += 1
+            self._executor.submit(self._run, ticket, future, fn, args)
+        self._publish()
+
+    def _publish(self) -> None:
+        # caller holds self._lock
+        DOCUMENTS_IN_FLIGHT.labels("threads").set(self._in_flight)
+        QUEUE_DEPTH.labels("scheduler").set(sum(len(ticket.pending) for ticket in self._tickets))
+
+    def _run(self, ticket: RequestTicket, future: concurrent.futures.Future, fn: Callable, args: tuple) -> None:
+        started_at = time.time()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            seconds = time.time() - started_at
+            with self._lock:
+                if self._document_seconds is None:
+                    self._document_seconds = seconds
+                else:
+                    self._document_seconds += DOCUMENT_SECONDS_SMOOTHING * (seconds - self._document_seconds)
+                ticket.in_flight -= 1
+                self._in_flight -= 1
+                self._completed += 1
+                if ticket.pending:
+                    self._activate(ticket)
+                self._dispatch()
+
+    def estimate_seconds(self, document_count: int, window: int | None = None) -> float:
+        """
+        Wall time for a new request of `document_count` documents: rounds of
+        its window, or of the whole process when documents are already queued,
+        times the measured average document run time. Until a document has
+        finished in this process, ESTIMATED_DOCUMENT_SECONDS stands in.
+        """
+        window = min(window or self.default_window, self.max_in_flight)
+        with self._lock:
+            per_document = self._document_seconds if self._document_seconds is not None else ESTIMATED_DOCUMENT_SECONDS
+            ahead = self._in_flight + sum(len(ticket.pending) for ticket in self._tickets)
+        rounds = max(-(-document_count // window), -(-(document_count + ahead) // self.max_in_flight))
+        return rounds * per_document
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "default_window": self.default_window,
+                "in_flight": self._in_flight,
+                "open_requests": len(self._tickets),
+                "queued_documents": sum(len(ticket.pending) for ticket in self._tickets),
+                "completed_documents": self._completed,
+                "avg_document_seconds": self._document_seconds
+            }
+
+
+scheduler = DocumentScheduler(GLOBAL_MAX_IN_FLIGHT, REQUEST_WINDOW)
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+from config import SINGLEFLIGHT_MODE, SINGLEFLIGHT_DIR
+
+MODES = ("off", "thread", "file")
+# result files older than this are no longer in flight for anyone
+RESULT_TTL = 600
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    work and later callers wait for its result instead of repeating it.
+
+    "thread" coalesces across the threads of this worker process. "file"
+    additionally coordinates gunicorn workers through an flock()ed file per
+    key in SINGLEFLIGHT_DIR: a worker that finds the lock held waits for it
+    and reuses the JSON result the holder left behind, as long as that
+    result was written after it started waiting. Only work in flight is
+    shared; a caller arriving after the work finished runs it again.
+    """
+
+    def __init__(self, mode: str, lock_dir: str):
+        if mode not in MODES:
+            raise ValueError(f"SINGLEFLIGHT_MODE must be one of {', '.join(MODES)}")
+        self.mode = mode
+        self.lock_dir = Path(lock_dir)
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, concurrent.futures.Future] = {}
+        self._last_prune = 0.0
+
+        self.leaders = 0
+        self.coalesced = 0
+        self.coalesced_across_processes = 0
+
+        if mode == "file":
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+
+    def do(self, key: str, fn: Callable, *args: Any) -> Tuple[Any, bool]:
+        """Return (result, shared), where shared tells whether another caller did the work."""
+        if self.mode == "off":
+            return fn(*args), False
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            if self.mode == "file":
+                result, shared = self._do_across_processes(key, fn, *args)
+            else:
+                result, shared = fn(*args), False
+            future.set_result(result)
+            return result, shared
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _do_across_processes(self, key: str, fn: Callable, *args: Any) -> Tuple[Any, bool]:
+        import fcntl
+
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        lock_path = self.lock_dir / f"{name}.lock"
+        result_path = self.lock_dir / f"{name}.json"
+        arrived_at = time.time()
+
+        with open(lock_path, "a+") as lock_file:
+            # blocks while another worker is processing the same key
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # a fresh mtime keeps the lock file from being pruned while it is in use
+                os.utime(lock_path)
+                try:
+                    if result_path.stat().st_mtime >= arrived_at:
+                        with self._lock:
+                            self.coalesced_across_processes += 1
+                        return json.loads(result_path.read_text()), True
+                except (FileNotFoundError, ValueError):
+                    pass
+
+                result = fn(*args)
+                tmp_path = result_path.with_suffix(f".{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps(result, ensure_ascii=False, default=str))
+                os.replace(tmp_path, result_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._prune()
+        return result, False
+
+    def _prune(self) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < RESULT_TTL:
+                return
+            self._last_prune = now
+        for path in self.lock_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > RESULT_TTL:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "in_flight": len(self._in_flight),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "coalesced_across_processes": self.coalesced_across_processes
+            }
+
+
+single_flight = SingleFlight(SINGLEFLIGHT_MODE, SINGLEFLIGHT_DIR)
@@ -0,0 +1,161 @@
+"""
+The stage accounting shared by the threaded engine, the asyncio engine and
+the bulk runner: how a stage is retried, how its errors are described and
+classified, and how rendering runs in the render stage.
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+import requests
+
+from config import MAX_RETRIES, RETRY_DELAY
+from document_processor import prepare_document_pages
+from http_client import DownloadRejected
+from openai_service import RetryableAPIError
+from rate_limiter import backoff_delay
+from options import AnalysisOptions
+from pipeline import render_stage
+from metrics import STAGE_SECONDS, STAGE_RETRIES
+
+log = logging.getLogger(__name__)
+
+STAGES = ("download", "render", "llm")
+
+
+class StageError(Exception):
+    """A pipeline stage that still failed after its own retries."""
+
+    def __init__(self, stage: str, message: str, error_class: str = "processing"):
+        super().__init__(message)
+        self.stage = stage
+        self.message = message
+        self.error_class = error_class
+        # stage attempts of the caller that raised it, for the callers that waited on its work
+        self.attempts: Optional[Dict[str, int]] = None
+
+
+def describe_error(e: Exception) -> str:
+    if isinstance(e, DownloadRejected):
+        return f"Network error: {str(e)}"
+    if isinstance(e, requests.exceptions.Timeout):
+        return f"Network timeout: {str(e)}"
+    if isinstance(e, requests.exceptions.RequestException):
+        return f"Network error: {str(e)}"
+    if isinstance(e, httpx.TimeoutException):
+        return f"Network timeout: {str(e)}"
+    if isinstance(e, httpx.HTTPError):
+        return f"Network error: {str(e)}"
+    if isinstance(e, RetryableAPIError):
+        return f"OpenAI error: {str(e)}"
+    return f"Processing error: {str(e)}"
+
+
+def error_class(e: Optional[Exception]) -> str:
+    """The kind of error describe_error reports, as a low-cardinality metrics label."""
+    if isinstance(e, (requests.exceptions.Timeout, httpx.TimeoutException)):
+        return "network_timeout"
+    if isinstance(e, (requests.exceptions.RequestException, httpx.HTTPError, DownloadRejected)):
+        return "network"
+    if isinstance(e, RetryableAPIError):
+        return "openai"
+    return "processing"
+
+
+def retry_delay(attempt: int, error: Optional[Exception]) -> float:
+    if isinstance(error, RetryableAPIError):
+        return backoff_delay(attempt, error.retry_after)
+    return RETRY_DELAY
+
+
+def stage_error(e: Exception, stage: str) -> StageError:
+    return StageError(stage, describe_error(e), error_class(e))
+
+
+def run_stage(
+    document_name: str,
+    stage: str,
+    attempts: Dict[str, int],
+    fn: Callable,
+    *args: Any,
+    retry_on: tuple = (Exception,),
+    max_retries: int = MAX_RETRIES
+) -> Any:
+    """Run one stage, retrying only that stage; the outputs of earlier stages are kept by the caller."""
+    last_error = None
+    last_exception = None
+
+    for attempt in range(max_retries + 1):
+        attempts[stage] = attempt + 1
+
+        if attempt > 0:
+            delay = retry_delay(attempt, last_exception)
+            log.warning(f"[{document_name}] Retrying {stage} stage in {delay:.1f}s, attempt {attempt}/{max_retries}")
+            STAGE_RETRIES.labels(stage).inc()
+            time.sleep(delay)
+
+        started_at = time.time()
+        try:
+            return fn(*args)
+        except retry_on as e:
+            last_exception = e
+            last_error = describe_error(e)
+            log.warning(f"[{document_name}] {stage} attempt {attempt + 1} failed - {last_error}")
+        except Exception as e:
+            raise stage_error(e, stage)
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.time() - started_at)
+
+    raise StageError(stage, last_error, error_class(last_exception))
+
+
+async def arun_stage(
+    document_name: str,
+    stage: str,
+    attempts: Dict[str, int],
+    fn: Callable[..., Awaitable],
+    *args: Any,
+    retry_on: tuple = (Exception,),
+    max_retries: int = MAX_RETRIES
+) -> Any:
+    """run_stage for a coroutine function, waiting between attempts without blocking the loop."""
+    last_error = None
+    last_exception = None
+
+    for attempt in range(max_retries + 1):
+        attempts[stage] = attempt + 1
+
+        if attempt > 0:
+            delay = retry_delay(attempt, last_exception)
+            log.warning(f"[{document_name}] Retrying {stage} stage in {delay:.1f}s, attempt {attempt}/{max_retries}")
+            STAGE_RETRIES.labels(stage).inc()
+            await asyncio.sleep(delay)
+
+        started_at = time.time()
+        try:
+            return await fn(*args)
+        except retry_on as e:
+            last_exception = e
+            last_error = describe_error(e)
+            log.warning(f"[{document_name}] {stage} attempt {attempt + 1} failed - {last_error}")
+        except Exception as e:
+            raise stage_error(e, stage)
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.time() - started_at)
+
+    raise StageError(stage, last_error, error_class(last_exception))
+
+
+def stage_attempts(attempts: Dict[str, int], stages: Tuple[str, ...]) -> Dict[str, int]:
+    """The attempts of a coalescing leader at `stages`, handed to the callers that waited on it."""
+    return {stage: attempts[stage] for stage in stages}
+
+
+def render_pages(doc_type: str, content: bytes, options: AnalysisOptions) -> Tuple[list[dict], str]:
+    with render_stage.slot():
+        return prepare_document_pages(
+            doc_type, content, options.encoding, use_text_layer=options.text_layer, executor=render_stage.executor,
+            limit=options.page_limit, pages_per_request=options.chunk_pages or None
+        )
@@ -0,0 +1,120 @@
+import json
+import time
+import queue
+import logging
+import threading
+import contextvars
+from typing import Any, Dict, Iterator
+
+from config import STREAM_HEARTBEAT_INTERVAL
+from batch_processor import create_dict_result
+from options import AnalysisOptions, default_options
+from page_filter import skipped_page_totals
+
+log = logging.getLogger(__name__)
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+SSE_MIMETYPE = "text/event-stream"
+
+_DONE = object()
+
+
+def format_frame(frame: Dict[str, Any], fmt: str) -> str:
+    payload = json.dumps(frame, ensure_ascii=False, default=str)
+    if fmt == "sse":
+        return f"event: {frame['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+def _heartbeat(fmt: str) -> str:
+    # SSE comments are ignored by EventSource; NDJSON readers get an explicit frame to skip
+    if fmt == "sse":
+        return ": keepalive\n\n"
+    return format_frame({"type": "heartbeat", "timestamp": time.time()}, fmt)
+
+
+def stream_results(
+    paths_url: str,
+    paths: list[str],
+    options: AnalysisOptions = default_options,
+    fmt: str = "ndjson"
+) -> Iterator[str]:
+    """
+    Run create_dict_result on a helper thread and yield one frame per finished
+    document, followed by a summary frame with the counts and date-sorted order.
+
+    If the client goes away the generator is closed, which cancels the
+    documents that have not started yet.
+    """
+    total_documents = len(paths)
+    frames = queue.Queue()
+    cancelled = threading.Event()
+    outcome = {}
+    start_time = time.time()
+
+    def on_result(name: str, result: Dict[str, Any]) -> None:
+        frames.put((name, result))
+
+    def run() -> None:
+        try:
+            outcome["result"] = create_dict_result(
+                paths_url, options=options, on_result=on_result, should_cancel=cancelled.is_set, paths=paths
+            )
+        except Exception as e:
+            outcome["error"] = str(e)
+        finally:
+            frames.put(_DONE)
+
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(run,), name="analyze-stream", daemon=True)
+    worker.start()
+
+    try:
+        yield format_frame({"type": "start", "paths_url": paths_url, "document_count": total_documents}, fmt)
+
+        index = 0
+        while True:
+            try:
+                item = frames.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield _heartbeat(fmt)
+                continue
+
+            if item is _DONE:
+                break
+
+            name, result = item
+            index += 1
+            yield format_frame({
+                "type": "result",
+                "document": name,
+                "index": index,
+                "total": total_documents,
+                "result": result
+            }, fmt)
+
+        if "error" in outcome:
+            log.error(f"Streaming analysis failed: {outcome['error']}")
+            yield format_frame({"type": "error", "error": outcome["error"]}, fmt)
+            return
+
+        result = outcome["result"]
+        successful_count = sum(1 for res in result.values() if "error" not in res)
+        processing_time = time.time() - start_time
+        log.info(f"Total streaming processing time: {processing_time:.2f} seconds")
+
+        yield format_frame({
+            "type": "summary",
+            "ok": True,
+            "order": list(result),
+            "processing_time_seconds": processing_time,
+            "document_count": len(result),
+            "successful_documents": successful_count,
+            "failed_documents": len(result) - successful_count,
+            "retry_failures": sum(1 for res in result.values() if res.get("final_failure", False)),
+            "skipped_pages": skipped_page_totals(result)
+        }, fmt)
+
+    finally:
+        if worker.is_alive():
+            log.warning(f"Stream for {paths_url} closed early, cancelling remaining documents")
+            cancelled.set()
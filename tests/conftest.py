@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+# config.py reads the environment on import; keep the tests off the real API and out of the .cache directory
+_state = Path(tempfile.mkdtemp(prefix="ocr-tests-"))
+_settings = {
+    "OPENAI_API_KEY": "test",
+    "MODEL": "test-model",
+    "DPI": "100",
+    "MAX_PAGES": "6",
+    "REQUEST_TIMEOUT": "10",
+    "OPENAI_TIMEOUT": "10",
+    "DOCUMENT_TIMEOUT": "60",
+    "MAX_RETRIES": "2",
+    "RETRY_DELAY": "0",
+    "BATCH_SIZE": "4",
+    "MAX_WORKERS": "4",
+    "LOG_FORMAT": "text"
+}
+for name, value in _settings.items():
+    os.environ.setdefault(name, value)
+os.environ.setdefault("CACHE_ENABLED", "False")
+os.environ.setdefault("CACHE_PATH", str(_state / "results.sqlite3"))
+os.environ.setdefault("DOWNLOAD_CACHE_ENABLED", "False")
+os.environ.setdefault("JOB_DB_PATH", str(_state / "jobs.sqlite3"))
+os.environ.setdefault("BULK_WORK_DIR", str(_state / "bulk"))
+os.environ.setdefault("SINGLEFLIGHT_DIR", str(_state / "singleflight"))
+os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
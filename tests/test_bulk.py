@@ -0,0 +1,113 @@
+import json
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from bulk import BulkRun
+from batch_backend import FakeBatchBackend
+from options import AnalysisOptions
+from document_server import _text_pdf
+
+# the fake backend's answer to the one-text-part summary request
+SUMMARY = "Extractie de test din 0 imagini si 1 blocuri de text."
+
+
+@pytest.fixture
+def documents(tmp_path):
+    directory = tmp_path / "documents"
+    directory.mkdir()
+    (directory / "long.pdf").write_bytes(_text_pdf(1, 3))
+    (directory / "short.pdf").write_bytes(_text_pdf(2, 1))
+    Image.new("RGB", (600, 800), "white").save(directory / "scan.png")
+    return sorted(str(path) for path in directory.iterdir())
+
+
+def _bulk_run(work_dir: Path) -> BulkRun:
+    options = AnalysisOptions.from_request({"chunk_pages": 1, "page_filter": "off", "use_cache": False})
+    return BulkRun(str(work_dir), "fake", options, poll_interval=0)
+
+
+def test_interrupted_run_resumes_through_the_summary_batch(tmp_path, documents):
+    work_dir = tmp_path / "work"
+
+    # first run: prepared and submitted, then interrupted before the batch was polled
+    first = _bulk_run(work_dir)
+    first.state.add_documents(documents)
+    first.prepare()
+    first.submit_queued()
+    counts = first.state.counts()
+    assert counts["prepared"] == 3
+    assert counts["open_batches"] == 1
+    assert counts["queued_requests"] == 0
+
+    # a new process picks up the open batch, then sends the long document's summary in a batch of its own
+    second = _bulk_run(work_dir)
+    submitted = []
+    submit = second.backend.submit
+    second.backend.submit = lambda input_path: submitted.append(input_path.read_text()) or submit(input_path)
+    second.run(documents)
+
+    counts = second.state.counts()
+    assert counts["done"] == 3
+    assert counts["open_batches"] == 0
+    assert len(submitted) == 1 and len(submitted[0].splitlines()) == 1
+
+    results = dict(second.state.finished_documents())
+    long_result = results[documents[0]]
+    assert long_result["processing"]["chunks"] == 3
+    assert long_result["sumar_document"] == SUMMARY
+    assert "chunk_errors" not in long_result
+    requests = second.state.document_requests(documents[0])
+    assert [request["kind"] for request in requests] == ["chunk", "chunk", "chunk", "summary"]
+    assert all(request["status"] == "done" for request in requests)
+    assert results[documents[1]]["processing"]["chunks"] == 1
+    # prepared request files are removed once their document is done
+    assert not list((work_dir / "requests").iterdir())
+
+
+def test_export_writes_each_document_once(tmp_path, documents):
+    run = _bulk_run(tmp_path / "work")
+    run.run(documents)
+
+    output = tmp_path / "out.jsonl"
+    assert run.export(str(output)) == 3
+    # running the same command again re-exports without duplicating lines
+    run.run(documents)
+    assert run.export(str(output)) == 3
+
+    lines = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [line["path"] for line in lines] == documents
+    assert {line["document"] for line in lines} == {"long.pdf", "scan.png", "short.pdf"}
+    assert all("error" not in line["result"] for line in lines)
+
+
+def test_requests_lost_by_a_batch_are_requeued(tmp_path, documents):
+    run = _bulk_run(tmp_path / "work")
+    lost = []
+
+    class LossyBackend(FakeBatchBackend):
+        def poll(self, batch_id):
+            status, lines, error = super().poll(batch_id)
+            if not lost and lines:
+                lost.append(lines.pop(0)["custom_id"])
+            return status, lines, error
+
+    run.backend = LossyBackend(str(tmp_path / "work"))
+    run.run(documents)
+
+    assert run.state.counts()["done"] == 3
+    with run.state._connect() as conn:
+        attempts = conn.execute("SELECT attempts FROM requests WHERE custom_id = ?", (lost[0],)).fetchone()[0]
+    assert attempts == 2
+
+
+def test_unsupported_documents_fail_without_a_request(tmp_path):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("not a document")
+    run = _bulk_run(tmp_path / "work")
+    run.run([str(notes)])
+
+    results = dict(run.state.finished_documents())
+    assert results[str(notes)]["failed_stage"] == "input"
+    assert run.state.counts()["failed"] == 1
@@ -0,0 +1,64 @@
+from chunking import split_chunks, merge_chunk_results, chunk_page_range
+
+
+def _pages(count):
+    return [{"page": index} for index in range(count)]
+
+
+def test_split_chunks():
+    assert split_chunks(_pages(5), 0) == [_pages(5)]
+    assert split_chunks(_pages(5), 5) == [_pages(5)]
+    assert [len(chunk) for chunk in split_chunks(_pages(5), 2)] == [2, 2, 1]
+
+
+def test_chunk_page_range_is_one_based():
+    assert chunk_page_range([{"page": 2}, {"page": 3}]) == "3-4"
+
+
+def test_flags_are_ored_including_string_values():
+    merged = merge_chunk_results([
+        {"variabila_booleana_analize_medicale": "False", "variabila_booleana_diagnostic_curent": "True"},
+        {"variabila_booleana_analize_medicale": "true", "variabila_booleana_diagnostic_curent": False},
+    ])
+    assert merged["variabila_booleana_analize_medicale"] is True
+    assert merged["variabila_booleana_diagnostic_curent"] is True
+
+
+def test_identity_fields_take_the_first_value_present():
+    merged = merge_chunk_results([
+        {"nume_prenume_pacient": None, "titlu_document": "Scrisoare Medicala"},
+        {"nume_prenume_pacient": "POPESCU ION", "titlu_document": "Anexa"},
+    ])
+    assert merged["nume_prenume_pacient"] == "POPESCU ION"
+    assert merged["titlu_document"] == "Scrisoare Medicala"
+
+
+def test_lab_results_are_concatenated_in_page_order():
+    merged = merge_chunk_results([
+        {"rezultat_analize_medicale": [{"nume_analiza": "Hemoglobina"}]},
+        {"rezultat_analize_medicale": None},
+        {"rezultat_analize_medicale": {"nume_analiza": "Hematocrit"}},
+    ])
+    assert merged["rezultat_analize_medicale"] == [{"nume_analiza": "Hemoglobina"}, {"nume_analiza": "Hematocrit"}]
+
+    assert merge_chunk_results([{"rezultat_analize_medicale": []}])["rezultat_analize_medicale"] is None
+
+
+def test_summaries():
+    single = merge_chunk_results([{"sumar_document": "unu"}, {"sumar_document": ""}])
+    assert single["sumar_document"] == "unu"
+    assert "partial_summaries" not in single
+
+    several = merge_chunk_results([{"sumar_document": "unu"}, {"sumar_document": "doi"}])
+    assert several["sumar_document"] is None
+    assert several["partial_summaries"] == ["unu", "doi"]
+
+
+def test_failed_chunks_are_reported_and_skipped():
+    merged = merge_chunk_results([
+        {"api_error": "boom", "nume_prenume_pacient": "IGNORAT"},
+        {"nume_prenume_pacient": "POPESCU ION", "processing": {"chunks": 2}},
+    ])
+    assert merged["chunk_errors"] == [{"chunk": 0, "error": "boom"}]
+    assert merged["nume_prenume_pacient"] == "POPESCU ION"
+    assert "processing" not in merged
@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_client
+from config import HTTP_POOL_PER_HOST
+
+
+class _Handler(BaseHTTPRequestHandler):
+    release = threading.Event()
+
+    def do_GET(self):
+        if self.path == "/index":
+            body = json.dumps({"documents": [{"document_url": "http://example/a.pdf"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # a slow document: the headers arrive, the body only once the test lets it
+        self.send_response(200)
+        self.send_header("Content-Length", "4")
+        self.end_headers()
+        self.wfile.flush()
+        self.release.wait(10)
+        self.wfile.write(b"%PDF")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _Handler.release.clear()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    _Handler.release.set()
+    httpd.shutdown()
+
+
+def test_index_fetch_does_not_wait_for_the_download_pool(server):
+    # every pooled connection to the host is held by a streaming download
+    downloads = [http_client.session.get(f"{server}/document/{index}", stream=True, timeout=10) for index in range(HTTP_POOL_PER_HOST)]
+    try:
+        started_at = time.time()
+        assert http_client.get_json(f"{server}/index")["documents"][0]["document_url"] == "http://example/a.pdf"
+        assert time.time() - started_at < 5
+    finally:
+        _Handler.release.set()
+        for response in downloads:
+            response.close()
+
+
+def test_rejected_downloads_are_not_retried():
+    class Response:
+        url = "http://example/a.pdf"
+
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def raise_for_status(self):
+            raise http_client.requests.exceptions.HTTPError(f"HTTP {self.status_code}")
+
+    with pytest.raises(http_client.DownloadRejected):
+        http_client._raise_for_status(Response(404))
+    for status in (429, 503):
+        with pytest.raises(http_client.RETRYABLE_DOWNLOAD_ERRORS):
+            http_client._raise_for_status(Response(status))
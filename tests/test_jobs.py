@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from jobs import JobStore, CapacityExceeded
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def _exited_pid() -> int:
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    return child.pid
+
+
+def _set_owner(store, job_id, owner_pid, heartbeat_at):
+    with store._connect() as conn:
+        conn.execute("UPDATE jobs SET owner_pid = ?, heartbeat_at = ? WHERE id = ?", (owner_pid, heartbeat_at, job_id))
+
+
+def test_jobs_record_their_owner(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    with store._connect() as conn:
+        owner_pid, heartbeat_at = conn.execute("SELECT owner_pid, heartbeat_at FROM jobs WHERE id = 'a'").fetchone()
+    assert owner_pid == os.getpid()
+    assert heartbeat_at <= time.time()
+
+
+def test_jobs_of_an_exited_worker_are_failed(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    store.mark_running("a")
+    _set_owner(store, "a", _exited_pid(), time.time())
+
+    store.fail_orphaned(time.time() - 60)
+    job = store.get("a", include_results=False)
+    assert job["status"] == "failed"
+    assert "stopped before the job finished" in job["error"]
+    assert job["finished_at"] is not None
+
+
+def test_jobs_without_a_recent_heartbeat_are_failed(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    store.create("b", "http://paths", 2, 10, time.time() - 60)
+    _set_owner(store, "a", os.getpid(), time.time() - 120)
+
+    store.fail_orphaned(time.time() - 60)
+    assert store.get("a", include_results=False)["status"] == "failed"
+    assert store.get("b", include_results=False)["status"] == "pending"
+
+
+def test_heartbeat_keeps_a_job_alive(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    _set_owner(store, "a", os.getpid(), time.time() - 120)
+    store.heartbeat(["a"])
+
+    store.fail_orphaned(time.time() - 60)
+    assert store.get("a", include_results=False)["status"] == "pending"
+
+
+def test_finished_jobs_are_left_alone(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    store.finish("a", "completed", [])
+    _set_owner(store, "a", _exited_pid(), time.time() - 120)
+
+    store.fail_orphaned(time.time() - 60)
+    assert store.get("a", include_results=False)["status"] == "completed"
+
+
+def test_capacity_is_shared_through_the_database(tmp_path):
+    # two stores on one file stand in for two gunicorn workers
+    first = JobStore(str(tmp_path / "jobs.sqlite3"))
+    second = JobStore(str(tmp_path / "jobs.sqlite3"))
+    first.create("a", "http://paths", 6, 10, time.time() - 60)
+    with pytest.raises(CapacityExceeded, match="6 documents pending"):
+        second.create("b", "http://paths", 5, 10, time.time() - 60)
+
+    first.finish("a", "completed", [])
+    second.create("b", "http://paths", 5, 10, time.time() - 60)
+
+
+def test_orphaned_jobs_release_their_capacity(store):
+    store.create("a", "http://paths", 10, 10, time.time() - 60)
+    _set_owner(store, "a", _exited_pid(), time.time())
+
+    store.create("b", "http://paths", 10, 10, time.time() - 60)
+    assert store.get("a", include_results=False)["status"] == "failed"
+
+
+def test_older_databases_gain_the_owner_columns(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, paths_url TEXT NOT NULL, status TEXT NOT NULL, total INTEGER NOT NULL,"
+        " result_order TEXT, error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL,"
+        " started_at REAL, finished_at REAL)"
+    )
+    conn.execute("INSERT INTO jobs (id, paths_url, status, total, created_at) VALUES ('old', 'x', 'running', 1, 0)")
+    conn.commit()
+    conn.close()
+
+    store = JobStore(str(path))
+    store.create("a", "http://paths", 1, 10, time.time() - 60)
+    # a job from before the upgrade has no heartbeat, so its worker is taken for gone
+    assert store.get("old", include_results=False)["status"] == "failed"
+    assert store.get("a", include_results=False)["status"] == "pending"
+
+
+def test_a_live_job_failed_as_an_orphan_stays_failed(store):
+    store.create("a", "http://paths", 2, 10, time.time() - 60)
+    _set_owner(store, "a", os.getpid(), time.time() - 120)
+    store.fail_orphaned(time.time() - 60)
+
+    # the owner is still alive and carries on: it can neither restart nor complete the job
+    assert store.mark_running("a") is False
+    assert store.finish("a", "completed", []) is False
+    job = store.get("a", include_results=False)
+    assert job["status"] == "failed"
+    assert job["started_at"] is None
+
+    # and the failed job no longer counts against the capacity
+    store.create("b", "http://paths", 10, 10, time.time() - 60)
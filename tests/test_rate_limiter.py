@@ -0,0 +1,168 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import openai
+import pytest
+
+from config import BACKOFF_BASE, BACKOFF_MAX
+from rate_limiter import RateLimiter, TokenBucket, backoff_delay, classify_error, parse_duration, parse_retry_after
+from fake_openai_server import FakeOpenAIState, serve
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def _status_error(cls, status: int, headers: dict = None, body: dict = None):
+    response = httpx.Response(status, headers=headers or {}, request=REQUEST)
+    return cls("error", response=response, body=body)
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("20ms", 0.02),
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("1h2m3s", 3723.0),
+    ("1.5s", 1.5),
+    ("2.5", 2.5),
+    ("", None),
+    (None, None),
+    ("soon", None),
+])
+def test_parse_duration(value, seconds):
+    if seconds is None:
+        assert parse_duration(value) is None
+    else:
+        assert parse_duration(value) == pytest.approx(seconds)
+
+
+def test_parse_retry_after_prefers_milliseconds():
+    assert parse_retry_after({"retry-after-ms": "250", "retry-after": "7"}) == pytest.approx(0.25)
+
+
+def test_parse_retry_after_seconds_and_http_date():
+    assert parse_retry_after({"retry-after": "7"}) == 7.0
+    assert parse_retry_after({"retry-after": "-3"}) == 0.0
+
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= parse_retry_after({"retry-after": later}) <= 30
+
+
+def test_parse_retry_after_missing_or_invalid():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({"retry-after": "whenever"}) is None
+    assert parse_retry_after({"retry-after-ms": "x", "retry-after": "2"}) == 2.0
+
+
+def test_backoff_delay_uses_retry_after_plus_jitter():
+    for _ in range(20):
+        assert 5.0 <= backoff_delay(3, retry_after=5.0) <= 5.0 + BACKOFF_BASE
+
+
+def test_backoff_delay_grows_and_is_capped():
+    for attempt in range(1, 12):
+        ceiling = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+        for _ in range(20):
+            assert ceiling / 2 <= backoff_delay(attempt) <= ceiling
+
+
+def test_classify_error_retries_timeouts_and_connection_errors():
+    assert classify_error(openai.APITimeoutError(request=REQUEST)) == (True, None)
+    assert classify_error(openai.APIConnectionError(request=REQUEST)) == (True, None)
+
+
+def test_classify_error_rate_limit_carries_retry_after():
+    error = _status_error(openai.RateLimitError, 429, {"retry-after": "12"})
+    assert classify_error(error) == (True, 12.0)
+
+
+def test_classify_error_exhausted_quota_is_final():
+    error = _status_error(openai.RateLimitError, 429, body={"code": "insufficient_quota"})
+    assert classify_error(error) == (False, None)
+
+
+def test_classify_error_server_errors_retry_client_errors_do_not():
+    assert classify_error(_status_error(openai.InternalServerError, 503))[0] is True
+    assert classify_error(_status_error(openai.APIStatusError, 408))[0] is True
+    assert classify_error(_status_error(openai.BadRequestError, 400)) == (False, None)
+    assert classify_error(_status_error(openai.AuthenticationError, 401)) == (False, None)
+    assert classify_error(ValueError("not an API error")) == (False, None)
+
+
+def test_bucket_waits_for_refill():
+    bucket = TokenBucket(60)
+    now = time.monotonic()
+    assert bucket.reserve(60, now) == 0.0
+    # one token per second
+    assert bucket.reserve(2, now) == pytest.approx(2.0)
+
+
+def test_headers_resize_and_clamp_the_process_share():
+    limiter = RateLimiter(rpm=600, tpm=100000, processes=2)
+    limiter.update_from_headers({
+        "x-ratelimit-limit-requests": "1000",
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-limit-tokens": "200000",
+        "x-ratelimit-remaining-tokens": "50000"
+    })
+    assert limiter.requests.capacity == 500
+    assert limiter.tokens.capacity == 100000
+    # 5 of the remaining 10 requests are this process's share; the sixth has to wait
+    for _ in range(5):
+        assert limiter.reserve(1) == 0.0
+    assert limiter.reserve(1) > 0
+
+
+def test_invalid_headers_are_ignored():
+    limiter = RateLimiter(rpm=60, tpm=1000, processes=1)
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "lots", "x-ratelimit-limit-tokens": "2000"})
+    assert limiter.requests.capacity == 60
+    assert limiter.tokens.capacity == 2000
+
+
+def test_record_usage_refunds_and_charges_the_difference():
+    limiter = RateLimiter(rpm=60, tpm=1000, processes=1)
+    limiter.reserve(800)
+    limiter.record_usage(800, 200)
+    assert limiter.reserve(700) == 0.0
+    limiter.record_usage(100, 400)
+    assert limiter.reserve(100) > 0
+
+
+def test_penalize_pauses_every_caller():
+    limiter = RateLimiter(rpm=6000, tpm=10_000_000, processes=1)
+    limiter.penalize(2.0)
+    assert 1.5 < limiter.reserve(1) <= 2.0
+    assert limiter.stats()["rate_limited_responses"] == 1
+    # a shorter Retry-After does not shorten the pause already in place
+    limiter.penalize(0.5)
+    assert limiter.reserve(1) > 1.5
+
+
+def test_penalize_without_retry_after_backs_off():
+    limiter = RateLimiter(rpm=6000, tpm=10_000_000, processes=1)
+    limiter.penalize(None)
+    assert BACKOFF_BASE / 2 - 0.1 <= limiter.reserve(1) <= BACKOFF_BASE
+
+
+def test_against_the_fake_server_quota():
+    server = serve("127.0.0.1", 0, FakeOpenAIState(1, 10000, 0.0, 0.0, 0.0, 0.0))
+    try:
+        client = openai.OpenAI(
+            base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key="test", max_retries=0
+        )
+        limiter = RateLimiter(rpm=60, tpm=10000, processes=1)
+        request = {"model": "fake", "messages": [{"role": "user", "content": "- titlu_document\n"}]}
+
+        raw = client.chat.completions.with_raw_response.create(**request)
+        limiter.update_from_headers(raw.headers)
+        assert limiter.requests.capacity == 1
+        assert limiter.reserve(1) > 0
+
+        with pytest.raises(openai.RateLimitError) as caught:
+            client.chat.completions.create(**request)
+        retryable, retry_after = classify_error(caught.value)
+        assert retryable and 50 < retry_after <= 60
+    finally:
+        server.shutdown()
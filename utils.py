@@ -1,10 +1,10 @@
 import base64
-import requests
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
+from typing import IO
 from PIL import Image
-from config import REQUEST_TIMEOUT
+from http_client import get_json, download, aget_json
 
 
 def img_to_data_url(img: Image.Image) -> str:
@@ -42,16 +42,18 @@ def parse_date(date_time_string):
 
 
 def fetch_document_links(api_url: str) -> list[str]:
-    response = requests.get(api_url, timeout=REQUEST_TIMEOUT)
-    response.raise_for_status()
-    data = response.json()
+    data = get_json(api_url)
     documents = data.get("documents", [])
     links = [doc["document_url"] for doc in documents if "document_url" in doc]
     return links
 
 
-def download_file_from_url(url: str) -> BytesIO:
-    """Download file from URL and return as BytesIO object."""
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
-    response.raise_for_status()
-    return BytesIO(response.content)
+async def afetch_document_links(api_url: str) -> list[str]:
+    data = await aget_json(api_url)
+    documents = data.get("documents", [])
+    return [doc["document_url"] for doc in documents if "document_url" in doc]
+
+
+def download_file_from_url(url: str) -> IO[bytes]:
+    """Download file from URL over the shared session and return it as a rewound file object."""
+    return download(url)